@@ -0,0 +1,132 @@
+import os
+import json
+import math
+import time
+import logging
+import threading
+from dotenv import load_dotenv
+
+from metrics import collect, TASKS_PUBLISHED
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Turn away new sends with 429 while the backlog would take too long to drain
+ADMISSION_CONTROL = os.getenv('ADMISSION_CONTROL', 'true').lower() == 'true'
+# Backlog allowed, in seconds of work at the measured drain rate
+ADMISSION_MAX_DRAIN_SECONDS = float(os.getenv('ADMISSION_MAX_DRAIN_SECONDS', '600'))
+# Queue depth at which sends are turned away even when no drain rate has been measured yet
+ADMISSION_MAX_QUEUE_DEPTH = int(os.getenv('ADMISSION_MAX_QUEUE_DEPTH', '100000'))
+# Seconds between queue depth samples, and the span the drain rate is averaged over
+ADMISSION_SAMPLE_INTERVAL = float(os.getenv('ADMISSION_SAMPLE_INTERVAL', '1'))
+ADMISSION_RATE_WINDOW = float(os.getenv('ADMISSION_RATE_WINDOW', '30'))
+# Bounds on the Retry-After header, in seconds
+ADMISSION_MIN_RETRY_AFTER = int(os.getenv('ADMISSION_MIN_RETRY_AFTER', '1'))
+ADMISSION_MAX_RETRY_AFTER = int(os.getenv('ADMISSION_MAX_RETRY_AFTER', '300'))
+# Comma-separated priority classes that are never turned away
+ADMISSION_EXEMPT_PRIORITIES = {p.strip() for p in os.getenv('ADMISSION_EXEMPT_PRIORITIES', 'transactional').split(',')
+                               if p.strip()}
+
+
+def published_total(queue):
+    # Tasks published to queue by every process writing to METRICS_DIR, or by this one alone without it
+    values = collect().get(TASKS_PUBLISHED.name, {})
+    return sum(value for labels, value in values.items() if json.loads(labels)[1:] == [queue])
+
+
+class AdmissionController:
+    # A background thread per process samples the queue depth and the publish count; requests only
+    # read the cached result. Tasks consumed in an interval are the depth change plus what was published,
+    # smoothed into a drain rate. Without METRICS_DIR only this process's publishes are seen, which
+    # under-reads the drain rate and so errs towards shedding.
+    def __init__(self, app, queue=None, max_drain_seconds=ADMISSION_MAX_DRAIN_SECONDS,
+                 max_depth=ADMISSION_MAX_QUEUE_DEPTH, interval=ADMISSION_SAMPLE_INTERVAL,
+                 window=ADMISSION_RATE_WINDOW):
+        self.app = app
+        self.queue = queue or app.conf.task_default_queue
+        self.max_drain_seconds = max_drain_seconds
+        self.max_depth = max_depth
+        self.interval = interval
+        self.window = window
+        self.depth = None
+        self.drain_rate = None
+        self.sampled_at = 0.0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._connection = None
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._connection = None
+            self.depth = self.drain_rate = None
+            threading.Thread(target=self._sample_forever, name='admission-sampler', daemon=True).start()
+
+    def _queue_depth(self):
+        if self._connection is None:
+            self._connection = self.app.connection_for_write()
+        try:
+            # Passive declare reports the message count without creating the queue
+            _, messages, _ = self._connection.default_channel.queue_declare(queue=self.queue, passive=True)
+        except self._connection.channel_errors:
+            return 0
+        return messages
+
+    def _sample_forever(self):
+        previous = None
+        while True:
+            try:
+                depth = self._queue_depth()
+                published = published_total(self.queue)
+            except Exception as e:
+                logging.warning(f'Sampling queue {self.queue} for admission control failed: {e}')
+                if self._connection is not None:
+                    try:
+                        self._connection.release()
+                    except Exception:
+                        pass
+                    self._connection = None
+                previous = None
+                time.sleep(self.interval)
+                continue
+            now = time.monotonic()
+            if previous is not None:
+                elapsed = now - previous[0]
+                rate = max(0.0, previous[1] - depth + published - previous[2]) / elapsed
+                weight = min(1.0, elapsed / self.window)
+                self.drain_rate = rate if self.drain_rate is None else self.drain_rate + weight * (rate - self.drain_rate)
+            self.depth = depth
+            self.sampled_at = now
+            previous = (now, depth, published)
+            time.sleep(self.interval)
+
+    def check(self, priority=None):
+        # Returns None to admit the send, or the seconds the client should wait before retrying
+        if not ADMISSION_CONTROL or priority in ADMISSION_EXEMPT_PRIORITIES:
+            return None
+        self._start()
+        depth, rate = self.depth, self.drain_rate
+        if depth is None or time.monotonic() - self.sampled_at > self.interval * 5:
+            # No recent sample: the broker itself will refuse the publish if it is down
+            return None
+        if rate:
+            excess = depth / rate - self.max_drain_seconds
+            if excess <= 0 and depth < self.max_depth:
+                return None
+            # Until the backlog is back under its drain time limit
+            wait = max(excess, (depth - self.max_depth) / rate)
+        elif depth >= self.max_depth:
+            wait = ADMISSION_MAX_RETRY_AFTER
+        else:
+            return None
+        return min(ADMISSION_MAX_RETRY_AFTER, max(ADMISSION_MIN_RETRY_AFTER, math.ceil(wait)))
+
+    def stats(self):
+        return {
+            'queue': self.queue,
+            'depth': self.depth,
+            'drain_rate': self.drain_rate,
+            'drain_seconds': self.depth / self.drain_rate if self.depth is not None and self.drain_rate else None,
+        }
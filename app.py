@@ -1,11 +1,31 @@
 import os
+import json
+import math
+import time
 import logging
-from flask import Flask, request, jsonify
-from datetime import datetime
+from flask import Flask, Response, request, jsonify
+from datetime import datetime, timezone
+from email.utils import parseaddr
 from dotenv import load_dotenv
-from celery import Celery
-from tasks import send_email
-from celery.result import AsyncResult
+from logging_config import configure_logging
+from celery import Celery, group
+from tasks import send_email, send_email_batch, route, DEFAULT_TEMPLATE, EMAIL_QUEUE_BULK
+from task_status import fetch_states, StatusWatcher, TERMINAL_STATES
+from dead_letter import dead_letters
+from recipient_groups import recipient_domain
+from idempotency import idempotency_key, idempotency_guard
+from metrics import render as render_metrics, ADMISSION_REJECTED, SUPPRESSED_RECIPIENTS
+from publisher import BatchPublisher, ENQUEUE_BATCHING
+from outbox import Outbox, OUTBOX_MODE
+from template_engine import templates, TemplateError
+from blob_store import blobs
+from suppression import suppressions
+from bounces import deliveries
+from attachments import attachment_cache, AttachmentError
+from scheduler import scheduled_sends, SCHEDULER_TICK, SCHEDULER_MAX_DELAY
+from admission import AdmissionController
+from ingest import EMAIL_PATTERN
+from kombu.utils.uuid import uuid
 
 # Load environment variables from .env file
 load_dotenv()
@@ -20,84 +40,535 @@ celery = Celery(
     backend=os.getenv('CELERY_RESULT_BACKEND')
 )
 
-# Configure logging
-log_path = '/var/log/messaging_system.log'
-print(f"Log file path: {log_path}")
+# Configure logging (see logging_config.py for LOG_PATH, LOG_LEVEL and LOG_MODE)
+configure_logging()
 
-logging.basicConfig(
-    filename=log_path,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    level=logging.DEBUG,  # Set to DEBUG to capture all log levels
-    filemode='a'  # Append mode to prevent overwriting
-)
+# Number of recipients handed to each send_email_batch task
+BATCH_CHUNK_SIZE = int(os.getenv('BATCH_CHUNK_SIZE', '500'))
+
+# Most task ids accepted by one POST /task_status call
+TASK_STATUS_BATCH_LIMIT = int(os.getenv('TASK_STATUS_BATCH_LIMIT', '1000'))
+
+# Most dead letters listed or replayed per request
+DEAD_LETTER_PAGE_LIMIT = int(os.getenv('DEAD_LETTER_PAGE_LIMIT', '1000'))
+
+# Largest variables object accepted by POST /send, as JSON bytes; task payloads stay small
+TEMPLATE_VARIABLES_LIMIT = int(os.getenv('TEMPLATE_VARIABLES_LIMIT', '4096'))
+# Largest ad hoc content ({"subject", "text", "html"}) accepted by POST /send and /send_batch, as JSON bytes
+CONTENT_LIMIT = int(os.getenv('CONTENT_LIMIT', str(1024 * 1024)))
+# Comma-separated From addresses ad hoc content may use besides EMAIL; any other "from" is refused
+CONTENT_ALLOWED_SENDERS = {address.strip().lower() for address in
+                           [os.getenv('EMAIL') or ''] + os.getenv('CONTENT_ALLOWED_SENDERS', '').split(',')
+                           if address.strip()}
+# Most attachments accepted by one POST /send
+ATTACHMENT_LIMIT = int(os.getenv('ATTACHMENT_LIMIT', '10'))
+
+# Longest a long-poll request or event stream is held open, in seconds
+LONG_POLL_TIMEOUT = float(os.getenv('LONG_POLL_TIMEOUT', '30'))
+EVENT_STREAM_TIMEOUT = float(os.getenv('EVENT_STREAM_TIMEOUT', '300'))
+EVENT_STREAM_HEARTBEAT = 15
+
+# Single shared poller feeding every waiting client in this process
+status_watcher = StatusWatcher(celery)
+
+# With ENQUEUE_BATCHING, concurrent requests share one publish and one round of broker confirms
+batch_publisher = BatchPublisher(send_email.app)
+
+# With OUTBOX_MODE, sends are spooled to local disk and published by a background flusher
+outbox = Outbox(send_email.app)
+
+# Sheds new sends while the bulk queue's backlog would take too long to drain; transactional sends are exempt
+admission = AdmissionController(send_email.app, EMAIL_QUEUE_BULK)
 
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.DEBUG)  # Set to DEBUG to capture all log levels
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-console_handler.setFormatter(formatter)
-logging.getLogger().addHandler(console_handler)
+NDJSON_TYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
 
-print("Logging is configured")
+def parse_recipients(req):
+    # Accepts a JSON list, {"recipients": [...]} or NDJSON with one address or object per line
+    if req.mimetype in NDJSON_TYPES:
+        items = [json.loads(line) for line in req.get_data(as_text=True).splitlines() if line.strip()]
+    else:
+        payload = req.get_json(silent=True)
+        items = payload.get('recipients', []) if isinstance(payload, dict) else payload or []
+        if not isinstance(items, list):
+            raise ValueError('Recipients must be a JSON list.')
+
+    recipients = []
+    for item in items:
+        email = item.get('email') if isinstance(item, dict) else item
+        if not isinstance(email, str):
+            raise ValueError('Each recipient must be an address or an object with an email.')
+        if email.strip():
+            recipients.append(email.strip())
+    return list(dict.fromkeys(recipients))
+
+def store_content(content):
+    # Stores the content once in the blob store; tasks carry only the returned digest.
+    # Returns (digest, compiled content), or raises TemplateError
+    fields = ('subject', 'text', 'html', 'from')
+    if (not isinstance(content, dict) or not all(isinstance(content.get(field), str) for field in ('subject', 'text'))
+            or not all(isinstance(content.get(field) or '', str) for field in fields)):
+        raise TemplateError('content must be an object with subject and text strings, and optionally html and from.')
+    content = {field: content[field] for field in fields if content.get(field)}
+    if any('\r' in content.get(field, '') or '\n' in content.get(field, '') for field in ('subject', 'from')):
+        raise TemplateError('content subject and from must be a single line.')
+    if 'from' in content and parseaddr(content['from'])[1].lower() not in CONTENT_ALLOWED_SENDERS:
+        raise TemplateError('content from is not an allowed sender.')
+    if len(json.dumps(content)) > CONTENT_LIMIT:
+        raise TemplateError(f'content must be under {CONTENT_LIMIT} bytes.')
+    digest = blobs.put_json(content)
+    return digest, templates.content(digest)
+
+def shed_load(endpoint, priority=None):
+    # A 429 response when the backlog is over its limit, None to go ahead
+    retry_after = admission.check(priority)
+    if retry_after is None:
+        return None
+    ADMISSION_REJECTED.inc(endpoint)
+    logging.warning(f'Shedding {endpoint} request, queue backlog is over its limit; retry after {retry_after}s')
+    return Response('Too many emails are queued, retry later.', status=429,
+                    headers={'Retry-After': str(retry_after)}, mimetype='text/plain')
+
+def finite_send_at(timestamp):
+    # NaN fails every comparison, so it would be neither scheduled nor rejected
+    if not math.isfinite(timestamp):
+        raise ValueError('send_at must be a finite timestamp.')
+    return timestamp
+
+def parse_send_at(value):
+    # Unix seconds or ISO 8601; a time without an offset is taken as UTC
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return finite_send_at(float(value))
+    if not isinstance(value, str):
+        raise ValueError('send_at must be a timestamp or an ISO 8601 time.')
+    try:
+        timestamp = float(value)
+    except ValueError:
+        pass
+    else:
+        return finite_send_at(timestamp)
+    try:
+        when = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError('send_at must be a timestamp or an ISO 8601 time.') from None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return when.timestamp()
+
+def enqueue_email(recipient, template_id, kwargs=None, send_at=None, priority=None):
+    # Every single-recipient entry point comes through here, so the address is checked once for all of them
+    if not EMAIL_PATTERN.fullmatch(recipient):
+        return 'The recipient is not a valid email address.', 400
+    try:
+        options = route(priority)
+    except ValueError as e:
+        return str(e), 400
+    if suppressions.is_suppressed(recipient):
+        SUPPRESSED_RECIPIENTS.inc('send')
+        logging.info(f'Not queueing email to suppressed address {recipient}')
+        return 'The recipient address is on the suppression list.', 422
+    if send_at is not None and send_at > time.time() + SCHEDULER_MAX_DELAY:
+        return f'send_at must be within {SCHEDULER_MAX_DELAY:.0f} seconds.', 400
+    # Sends due within a tick are published now
+    scheduled = send_at is not None and send_at > time.time() + SCHEDULER_TICK
+    if scheduled:
+        # The same email at another time is a different email
+        template_id = f'{template_id}@{send_at:.0f}'
+    # Retried or double-submitted requests get the original task id back instead of a second email
+    key = idempotency_key(request.headers.get('Idempotency-Key'), recipient, template_id)
+    task_id = uuid()
+    existing = idempotency_guard.claim(key, task_id)
+    if existing:
+        logging.info(f'Duplicate request for task id: {existing}')
+        return jsonify({
+            'message': 'Email task has already been queued.',
+            'task_id': existing
+        }), 200
+
+    try:
+        if scheduled:
+            # Held in the scheduler's store, not as a broker ETA task in some worker's memory
+            scheduled_sends.add(task_id, send_email.name, args=[recipient], kwargs=kwargs, due=send_at,
+                                options=options)
+            task = send_email.AsyncResult(task_id)
+        elif OUTBOX_MODE:
+            task = outbox.append(send_email.name, args=[recipient], kwargs=kwargs, task_id=task_id, options=options)
+        elif ENQUEUE_BATCHING:
+            task = batch_publisher.publish(send_email, args=[recipient], kwargs=kwargs, task_id=task_id, **options)
+        else:
+            task = send_email.apply_async(args=[recipient], kwargs=kwargs, task_id=task_id, **options)
+    except Exception:
+        idempotency_guard.release(key, task_id)
+        raise
+    if scheduled:
+        logging.info(f'Email task scheduled for {send_at:.0f} with task id: {task.id}')
+        return jsonify({
+            'message': 'Email task has been scheduled.',
+            'task_id': task.id,
+            'send_at': datetime.fromtimestamp(send_at, timezone.utc).isoformat()
+        }), 200
+    logging.info(f'Email task queued with task id: {task.id}')
+    return jsonify({
+        'message': 'Email task has been queued.',
+        'task_id': task.id
+    }), 200
 
 @app.route('/')
 def index():
     logging.info('Accessed index route.')
-    print('Accessed index route.')
+    priority = request.args.get('priority')
+    shed = shed_load('index', priority)
+    if shed:
+        return shed
     sendmail = request.args.get('sendmail')
     talktome = request.args.get('talktome')
+    try:
+        send_at = parse_send_at(request.args.get('send_at'))
+    except ValueError as e:
+        return str(e), 400
 
     if sendmail and talktome:
-        task = send_email.delay(sendmail)
-        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        logging.info(f'Email task queued with task id: {task.id}')
-        print(f'Email task queued with task id: {task.id}')
-        return jsonify({
-            'message': 'Email task has been queued.',
-            'task_id': task.id
-        }), 200
+        return enqueue_email(sendmail, DEFAULT_TEMPLATE[0], send_at=send_at, priority=priority)
     logging.warning('Both sendmail and talktome parameters are required.')
-    print('Both sendmail and talktome parameters are required.')
     return 'Both sendmail and talktome parameters are required.', 400
 
-@app.route('/task_status/<task_id>')
-def get_task_status(task_id):
-    result = AsyncResult(task_id, app=celery)
-    logging.info(f'Checking status for task id: {task_id}')
-    print(f'Checking status for task id: {task_id}')
-    status = result.state
-    logging.info(f'Task status for {task_id}: {status}')
-    print(f'Task status for {task_id}: {status}')
-
+@app.route('/send', methods=['POST'])
+def send():
+    # {"email": "...", "template": "welcome", "variables": {"name": "Ada"}, "attachments": ["terms.pdf"],
+    #  "send_at": "2030-01-01T09:00:00Z", "priority": "transactional"}
+    # or "content": {"subject": "...", "text": "Hi {{ name }}", "html": "..."} in place of "template"
+    logging.info('Accessed send route.')
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or not isinstance(payload.get('email'), str) or not payload['email'].strip():
+        return 'A JSON object with an email is required.', 400
+    shed = shed_load('send', payload.get('priority'))
+    if shed:
+        return shed
+    variables = payload.get('variables') or {}
+    if not isinstance(variables, dict):
+        return 'variables must be a JSON object.', 400
+    if len(json.dumps(variables)) > TEMPLATE_VARIABLES_LIMIT:
+        return f'variables must be under {TEMPLATE_VARIABLES_LIMIT} bytes.', 413
+    attachments = payload.get('attachments') or []
+    if not isinstance(attachments, list) or not all(isinstance(name, str) for name in attachments):
+        return 'attachments must be a list of file names.', 400
+    if len(attachments) > ATTACHMENT_LIMIT:
+        return f'At most {ATTACHMENT_LIMIT} attachments are allowed.', 400
+    try:
+        # Only the names travel with the task; workers read and encode the files
+        for name in attachments:
+            attachment_cache.resolve(name)
+    except AttachmentError as e:
+        return str(e), 400
+    try:
+        send_at = parse_send_at(payload.get('send_at'))
+    except ValueError as e:
+        return str(e), 400
+
+    kwargs = {'attachments': attachments} if attachments else {}
+    template_id = payload.get('template')
+    if payload.get('content') is not None:
+        if template_id:
+            return 'Give either a template or content, not both.', 400
+        try:
+            digest, compiled = store_content(payload['content'])
+        except TemplateError as e:
+            return str(e), 400
+        missing = compiled.missing(variables)
+        if missing:
+            return f'Missing template variables: {", ".join(missing)}', 400
+        dedupe_id = f'content:{digest}:{json.dumps(variables, sort_keys=True)}'
+        kwargs.update(content=digest, variables=variables)
+    elif not template_id:
+        dedupe_id = DEFAULT_TEMPLATE[0]
+    else:
+        try:
+            # Workers render the version that was current at enqueue time
+            template = templates.get(template_id)
+        except TemplateError as e:
+            return str(e), 400
+        missing = template.missing(variables)
+        if missing:
+            return f'Missing template variables: {", ".join(missing)}', 400
+        # Same recipient and template with different variables is a different email
+        dedupe_id = f'{template_id}:{json.dumps(variables, sort_keys=True)}'
+        kwargs.update(template=template_id, version=template.version, variables=variables)
+    if attachments:
+        dedupe_id = f'{dedupe_id}:{json.dumps(attachments)}'
+    return enqueue_email(payload['email'].strip(), dedupe_id, kwargs or None, send_at, payload.get('priority'))
+
+@app.route('/send_batch', methods=['POST'])
+def send_batch():
+    logging.info('Accessed send_batch route.')
+    shed = shed_load('send_batch')
+    if shed:
+        return shed
+    try:
+        recipients = parse_recipients(request)
+    except json.JSONDecodeError:
+        logging.warning('Invalid JSON in send_batch request.')
+        return 'Invalid JSON payload.', 400
+    except ValueError as e:
+        logging.warning(f'Invalid recipients in send_batch request: {e}')
+        return str(e), 400
+
+    if not recipients:
+        logging.warning('No recipients supplied to send_batch.')
+        return 'At least one recipient is required.', 400
+    invalid = [email for email in recipients if not EMAIL_PATTERN.fullmatch(email)]
+    if invalid:
+        logging.warning(f'send_batch request with {len(invalid)} invalid addresses.')
+        return jsonify({'message': 'Some recipients are not valid addresses.', 'invalid': invalid[:100]}), 400
+
+    recipients, suppressed = suppressions.partition(recipients)
+    if suppressed:
+        SUPPRESSED_RECIPIENTS.inc('send_batch', amount=len(suppressed))
+    if not recipients:
+        return 'Every recipient is on the suppression list.', 422
+
+    # {"recipients": [...], "content": {...}}: one stored copy of the campaign content for every chunk
+    payload = request.get_json(silent=True) if request.mimetype not in NDJSON_TYPES else None
+    options = {'grouped': False}
+    if isinstance(payload, dict) and payload.get('content') is not None:
+        try:
+            digest, compiled = store_content(payload['content'])
+        except TemplateError as e:
+            return str(e), 400
+        if compiled.variables:
+            return 'Batch content cannot use template variables.', 400
+        options['content'] = digest
+
+    # mode=grouped sends one transaction per domain group instead of one per recipient
+    grouped = options['grouped'] = request.args.get('mode') == 'grouped'
+    if grouped:
+        # Keep each domain's recipients together so chunks split into as few groups as possible
+        recipients.sort(key=recipient_domain)
+
+    chunks = [recipients[i:i + BATCH_CHUNK_SIZE] for i in range(0, len(recipients), BATCH_CHUNK_SIZE)]
+    result = group(send_email_batch.s(chunk, **options) for chunk in chunks).apply_async(**route('bulk'))
+    logging.info(f'Batch {result.id} queued: {len(recipients)} recipients in {len(chunks)} chunks')
+    return jsonify({
+        'message': 'Email batch has been queued.',
+        'batch_id': result.id,
+        'recipients': len(recipients),
+        'suppressed': len(suppressed),
+        'task_ids': [chunk_result.id for chunk_result in result.results]
+    }), 200
+
+def describe_status(status, result_data):
     if status == 'SUCCESS':
-        result_data = result.result
-        logging.info(f'Email sent successfully to {result_data["email"]}')
-        print(f'Email sent successfully to {result_data["email"]}')
-        return jsonify({
+        if 'sent' in result_data:
+            # send_email_batch chunk
+            payload = {
+                'status': 'SUCCESS',
+                'message': f'Sent {result_data["sent"]} emails',
+                'failed': result_data['failed']
+            }
+            if 'rcpt' in result_data:
+                payload['rcpt'] = result_data['rcpt']
+            return payload, 200
+        return {
             'status': 'SUCCESS',
             'message': f'Email sent successfully to {result_data["email"]}'
-        }), 200
+        }, 200
     elif status == 'FAILURE':
-        result_data = result.result
-        logging.error(f'Failed to send email: {result_data["error"]}')
-        print(f'Failed to send email: {result_data["error"]}')
-        return jsonify({
+        error = result_data['error'] if isinstance(result_data, dict) else result_data
+        return {
             'status': 'FAILURE',
-            'message': f'Failed to send email: {result_data["error"]}'
-        }), 400
-    elif status in ['PENDING', 'RECEIVED', 'STARTED']:
-        logging.info('Email sending in progress')
-        print('Email sending in progress')
-        return jsonify({
+            'message': f'Failed to send email: {error}'
+        }, 400
+    elif status in ['PENDING', 'RECEIVED', 'STARTED', 'RETRY']:
+        return {
             'status': 'PENDING',
             'message': 'Email sending in progress'
-        }), 202
+        }, 202
     else:
-        logging.warning('Task status unknown')
-        print('Task status unknown')
-        return jsonify({
+        return {
             'status': 'UNKNOWN',
             'message': 'Task status unknown'
-        }), 500
+        }, 500
+
+@app.route('/task_status/<task_id>')
+def get_task_status(task_id):
+    logging.info(f'Checking status for task id: {task_id}')
+    status, result_data = fetch_states(celery, [task_id])[task_id]
+    logging.info(f'Task status for {task_id}: {status}')
+
+    payload, code = describe_status(status, result_data)
+    if code == 500:
+        logging.warning(payload['message'])
+    elif code == 400:
+        logging.error(payload['message'])
+    else:
+        logging.info(payload['message'])
+    return jsonify(payload), code
+
+def status_transitions(task_id, timeout):
+    # Yields (state, result) now and on every change until the task finishes or the timeout passes
+    if not math.isfinite(timeout) or timeout < 0:
+        # NaN would never count down, and the watcher would wait on it forever
+        raise ValueError('timeout must be a finite, non-negative number of seconds.')
+    deadline = time.monotonic() + timeout
+    state = fetch_states(celery, [task_id])[task_id]
+    yield state
+    while state[0] not in TERMINAL_STATES:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        changed = status_watcher.wait(task_id, state[0], min(remaining, EVENT_STREAM_HEARTBEAT))
+        if changed is None:
+            yield None
+            continue
+        state = changed
+        yield state
+
+@app.route('/task_status/<task_id>/wait')
+def wait_task_status(task_id):
+    # Long-poll: answers as soon as the task finishes, or with the current state after the timeout
+    timeout = request.args.get('timeout', LONG_POLL_TIMEOUT, type=float)
+    if not math.isfinite(timeout) or timeout < 0:
+        return 'timeout must be a finite, non-negative number of seconds.', 400
+    timeout = min(timeout, LONG_POLL_TIMEOUT)
+    logging.info(f'Waiting up to {timeout}s for task id: {task_id}')
+    status, result_data = None, None
+    for state in status_transitions(task_id, timeout):
+        if state is not None:
+            status, result_data = state
+    payload, code = describe_status(status, result_data)
+    return jsonify(payload), code
+
+@app.route('/task_status/<task_id>/events')
+def task_status_events(task_id):
+    logging.info(f'Streaming status events for task id: {task_id}')
+
+    def stream():
+        last_payload = None
+        for state in status_transitions(task_id, EVENT_STREAM_TIMEOUT):
+            if state is None:
+                # Comment line keeps nginx and client idle timeouts from closing the stream
+                yield ': keepalive\n\n'
+                continue
+            payload, _ = describe_status(*state)
+            if payload != last_payload:
+                last_payload = payload
+                yield f'event: status\ndata: {json.dumps(payload)}\n\n'
+
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # Stop nginx from buffering the stream
+    })
+
+@app.route('/task_status', methods=['POST'])
+def get_task_statuses():
+    payload = request.get_json(silent=True) or {}
+    task_ids = payload.get('task_ids') if isinstance(payload, dict) else None
+    if not isinstance(task_ids, list) or not task_ids:
+        logging.warning('task_ids list is required.')
+        return 'A non-empty task_ids list is required.', 400
+    if len(task_ids) > TASK_STATUS_BATCH_LIMIT:
+        logging.warning(f'Rejected status lookup for {len(task_ids)} task ids.')
+        return f'At most {TASK_STATUS_BATCH_LIMIT} task ids per request.', 400
+    if not all(isinstance(task_id, str) for task_id in task_ids):
+        logging.warning('Rejected status lookup with non-string task ids.')
+        return 'task_ids must be a list of strings.', 400
+
+    task_ids = list(dict.fromkeys(task_ids))
+    found = fetch_states(celery, task_ids)
+    logging.info(f'Checked status for {len(task_ids)} task ids')
+    return jsonify({
+        'statuses': {task_id: describe_status(*found[task_id])[0] for task_id in task_ids}
+    }), 200
+
+@app.route('/suppressions', methods=['POST'])
+def add_suppressions():
+    # {"addresses": ["..."], "reason": "unsubscribed"}
+    payload = request.get_json(silent=True)
+    addresses = payload.get('addresses') if isinstance(payload, dict) else None
+    if not isinstance(addresses, list) or not all(isinstance(address, str) and address.strip() for address in addresses):
+        return 'A list of addresses is required.', 400
+    reason = str(payload.get('reason') or 'unsubscribed')
+    suppressions.add_many(((address, reason) for address in addresses), 'api')
+    logging.info(f'Suppressed {len(addresses)} addresses: {reason}')
+    return jsonify({'message': f'Suppressed {len(addresses)} addresses.'}), 200
+
+@app.route('/suppressions/<path:address>', methods=['GET', 'DELETE'])
+def suppression_entry(address):
+    if request.method == 'DELETE':
+        if not suppressions.remove(address):
+            return 'The address is not suppressed.', 404
+        logging.info(f'Removed {address} from the suppression list')
+        return jsonify({'message': 'The address is no longer suppressed.'}), 200
+    entry = suppressions.get(address)
+    if entry is None:
+        return 'The address is not suppressed.', 404
+    return jsonify(entry), 200
+
+@app.route('/deliveries/<task_id>')
+def delivery_events(task_id):
+    # Outcomes reported back by DSNs for the task's recipients, as recorded by bounces.py
+    events = deliveries.for_task(task_id)
+    logging.info(f'Found {len(events)} delivery events for task {task_id}')
+    return jsonify({'task_id': task_id, 'events': events}), 200
+
+@app.route('/dead_letters')
+def list_dead_letters():
+    limit = min(request.args.get('limit', 100, type=int), DEAD_LETTER_PAGE_LIMIT)
+    entries = dead_letters.pending(limit=limit)
+    logging.info(f'Listed {len(entries)} dead letters')
+    return jsonify({'dead_letters': entries}), 200
+
+@app.route('/dead_letters/replay', methods=['POST'])
+def replay_dead_letters():
+    # Re-queues the given ids, or the oldest pending entries when no ids are supplied
+    payload = request.get_json(silent=True) or {}
+    if not isinstance(payload, dict):
+        return 'A JSON object is required.', 400
+    ids = payload.get('ids')
+    if ids is not None and (not isinstance(ids, list) or
+                            not all(isinstance(i, int) and not isinstance(i, bool) for i in ids)):
+        return 'ids must be a list of dead letter ids.', 400
+    limit = payload.get('limit', 100)
+    if not isinstance(limit, int) or isinstance(limit, bool) or limit < 1:
+        return 'limit must be a positive integer.', 400
+    entries = dead_letters.pending(limit=min(limit, DEAD_LETTER_PAGE_LIMIT), ids=ids)
+
+    # An address may have hard-bounced since the send failed; those entries are closed without sending,
+    # so they do not come back at the head of every later replay
+    _, suppressed = suppressions.partition({entry['args'][0] for entry in entries})
+    suppressed = set(suppressed)
+    skipped = [entry['id'] for entry in entries if entry['args'][0] in suppressed]
+    if skipped:
+        SUPPRESSED_RECIPIENTS.inc('replay', amount=len(skipped))
+        dead_letters.mark_replayed(skipped)
+    task_ids = {}
+    for entry in entries:
+        if entry['args'][0] in suppressed:
+            continue
+        # Through the tasks app, which declares the queues with their arguments
+        task = send_email.app.send_task(entry['task_name'], args=entry['args'], **route('bulk'))
+        task_ids[entry['id']] = task.id
+    dead_letters.mark_replayed(list(task_ids))
+    logging.info(f'Replayed {len(task_ids)} dead letters, skipped {len(skipped)} to suppressed addresses')
+    return jsonify({
+        'message': f'Replayed {len(task_ids)} dead letters.',
+        'task_ids': task_ids,
+        'suppressed': skipped
+    }), 200
+
+@app.route('/stats')
+def stats():
+    return jsonify({
+        'idempotency': idempotency_guard.stats(),
+        'outbox_pending_bytes': outbox.pending() if OUTBOX_MODE else 0,
+        'scheduled_pending': scheduled_sends.pending(),
+        'admission': admission.stats()
+    }), 200
+
+@app.route('/metrics')
+def metrics():
+    # Prometheus scrape target; set METRICS_DIR to include the Celery workers' counters
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
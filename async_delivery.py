@@ -0,0 +1,221 @@
+import os
+import re
+import ssl
+import base64
+import socket
+import asyncio
+import logging
+import smtplib
+from dotenv import load_dotenv
+
+from smtp_pool import timed_phase, SMTP_STARTTLS, TRANSACTION_ERRORS
+from rate_limit import AdaptiveConcurrency
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Concurrent SMTP sessions per worker process
+ASYNC_SMTP_CONCURRENCY = int(os.getenv('ASYNC_SMTP_CONCURRENCY', '20'))
+SMTP_TIMEOUT = float(os.getenv('SMTP_TIMEOUT', '30'))
+
+
+class AsyncSMTPSession:
+    def __init__(self, host, port, username=None, password=None, starttls=SMTP_STARTTLS,
+                 ssl_context=None, timeout=SMTP_TIMEOUT, local_hostname='localhost'):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.ssl_context = ssl_context or ssl.create_default_context()
+        self.timeout = timeout
+        self.local_hostname = local_hostname
+        self.reader = None
+        self.writer = None
+
+    async def _reply(self):
+        lines = []
+        while True:
+            line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            if not line:
+                raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+            lines.append(line[4:].strip())
+            if line[3:4] != b'-':
+                return int(line[:3]), b'\n'.join(lines)
+
+    async def command(self, line):
+        # As smtplib.putcmd: an address with a line break would otherwise smuggle in another command
+        if '\r' in line or '\n' in line:
+            raise ValueError('command and arguments contain prohibited newline characters')
+        self.writer.write(line.encode('ascii') + b'\r\n')
+        await self.writer.drain()
+        return await self._reply()
+
+    async def _ehlo(self):
+        code, reply = await self.command(f'EHLO {self.local_hostname}')
+        if code != 250:
+            raise smtplib.SMTPHeloError(code, reply)
+        return reply.upper()
+
+    async def connect(self):
+        with timed_phase('dns'):
+            addresses = await asyncio.wait_for(asyncio.get_running_loop().getaddrinfo(
+                self.host, self.port, type=socket.SOCK_STREAM), self.timeout)
+        with timed_phase('connect'):
+            family, _, _, _, address = addresses[0]
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(address[0], address[1], family=family), self.timeout)
+            code, reply = await self._reply()
+            if code != 220:
+                raise smtplib.SMTPConnectError(code, reply)
+            features = await self._ehlo()
+
+        if self.starttls:
+            with timed_phase('starttls'):
+                code, reply = await self.command('STARTTLS')
+                if code != 220:
+                    raise smtplib.SMTPNotSupportedError(f'STARTTLS refused: {code} {reply}')
+                await self.writer.start_tls(self.ssl_context, server_hostname=self.host)
+                features = await self._ehlo()
+
+        if self.username:
+            with timed_phase('login'):
+                token = base64.b64encode(f'\0{self.username}\0{self.password}'.encode()).decode('ascii')
+                code, reply = await self.command(f'AUTH PLAIN {token}')
+                if code not in (235, 503):
+                    raise smtplib.SMTPAuthenticationError(code, reply)
+        return features
+
+    async def sendmail(self, from_addr, to_addrs, msg):
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        code, reply = await self.command(f'MAIL FROM:<{from_addr}>')
+        if code != 250:
+            await self.rset()
+            raise smtplib.SMTPSenderRefused(code, reply, from_addr)
+
+        refused = {}
+        for to_addr in to_addrs:
+            code, reply = await self.command(f'RCPT TO:<{to_addr}>')
+            if code not in (250, 251):
+                refused[to_addr] = (code, reply)
+        if len(refused) == len(to_addrs):
+            await self.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        code, reply = await self.command('DATA')
+        if code != 354:
+            await self.rset()
+            raise smtplib.SMTPDataError(code, reply)
+        # Same line ending and dot-stuffing rules as smtplib.SMTP.sendmail()
+        if isinstance(msg, str):
+            msg = re.sub(r'(?:\r\n|\n|\r(?!\n))', '\r\n', msg).encode('ascii')
+        msg = re.sub(br'(?m)^\.', b'..', msg)
+        if not msg.endswith(b'\r\n'):
+            msg += b'\r\n'
+        self.writer.write(msg + b'.\r\n')
+        await self.writer.drain()
+        code, reply = await self._reply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, reply)
+        return refused
+
+    async def rset(self):
+        return await self.command('RSET')
+
+    async def quit(self):
+        try:
+            await self.command('QUIT')
+        except Exception:
+            pass
+        self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class AsyncDeliveryEngine:
+    def __init__(self, host, port, username=None, password=None,
+                 concurrency=ASYNC_SMTP_CONCURRENCY, limiter=None, **session_options):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.concurrency = concurrency
+        # Optional shared AdaptiveRateLimiter; the session count itself adapts through AIMD
+        self.limiter = limiter
+        self.adaptive = AdaptiveConcurrency(concurrency)
+        self.session_options = session_options
+        self._active = 0
+        self._slots = None
+
+    def _session(self):
+        return AsyncSMTPSession(self.host, self.port, self.username, self.password,
+                                **self.session_options)
+
+    async def _acquire_slot(self):
+        async with self._slots:
+            await self._slots.wait_for(lambda: self._active < self.adaptive.allowed())
+            self._active += 1
+        if self.limiter is not None:
+            delay = self.limiter.reserve()
+            if delay:
+                await asyncio.sleep(delay)
+
+    async def _release_slot(self, exc=None):
+        self.adaptive.record(exc)
+        if self.limiter is not None:
+            self.limiter.record(exc)
+        async with self._slots:
+            self._active -= 1
+            self._slots.notify_all()
+
+    async def _worker(self, queue, from_addr, results):
+        session = None
+        try:
+            while True:
+                try:
+                    to_addr, msg = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                await self._acquire_slot()
+                error = None
+                try:
+                    if session is None:
+                        session = self._session()
+                        await session.connect()
+                    with timed_phase('send'):
+                        await session.sendmail(from_addr, to_addr, msg)
+                except TRANSACTION_ERRORS as e:
+                    error = e
+                except Exception as e:
+                    # The session is unusable; the next message opens a fresh one
+                    logging.error(f'Async SMTP session to {self.host}:{self.port} failed: {e}')
+                    error = e
+                    if session is not None:
+                        session.close()
+                        session = None
+                results[to_addr] = error
+                await self._release_slot(error)
+        finally:
+            if session is not None:
+                await session.quit()
+
+    async def deliver(self, from_addr, messages):
+        # messages is an iterable of (recipient, serialized message) pairs
+        queue = asyncio.Queue()
+        for item in messages:
+            queue.put_nowait(item)
+        results = {}
+        self._slots = asyncio.Condition()
+        workers = min(self.concurrency, queue.qsize())
+        await asyncio.gather(*(self._worker(queue, from_addr, results) for _ in range(workers)))
+        return results
+
+
+def deliver_batch(host, port, username, password, from_addr, messages, **options):
+    # Sync entry point for Celery tasks: maps each recipient to None (sent) or the exception raised
+    engine = AsyncDeliveryEngine(host, port, username, password, **options)
+    return asyncio.run(engine.deliver(from_addr, messages))
@@ -0,0 +1,130 @@
+import os
+import mmap
+import hashlib
+import binascii
+import mimetypes
+import threading
+from urllib.parse import quote
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Attachments are named relative to this directory when enqueued; nothing outside it can be attached
+ATTACHMENT_DIR = os.getenv('ATTACHMENT_DIR', 'attachments')
+ATTACHMENT_MAX_BYTES = int(os.getenv('ATTACHMENT_MAX_BYTES', str(25 * 1024 * 1024)))
+# Encoded parts kept per worker process, in bytes
+ATTACHMENT_CACHE_BYTES = int(os.getenv('ATTACHMENT_CACHE_BYTES', str(256 * 1024 * 1024)))
+
+CRLF = b'\r\n'
+
+# 57 input bytes make one 76 character base64 line; encode a few thousand lines per slice of the mapping
+LINE_BYTES = 57
+SLICE_BYTES = LINE_BYTES * 4096
+
+
+class AttachmentError(ValueError):
+    pass
+
+
+class EncodedAttachment:
+    def __init__(self, digest, filename, part):
+        self.digest = digest
+        self.filename = filename
+        # MIME part headers and base64 body, CRLF terminated; sent as is, never copied per message
+        self.part = part
+        self.view = memoryview(part)
+
+
+def content_disposition(filename):
+    if filename.isascii() and '"' not in filename and '\\' not in filename:
+        return f'attachment; filename="{filename}"'
+    # RFC 2231 for anything that cannot go in a quoted string
+    return f"attachment; filename*=utf-8''{quote(filename)}"
+
+
+def encode_file(path, filename=None):
+    # Hashes and base64-encodes the file through a read-only mapping, one slice at a time
+    filename = filename or os.path.basename(path)
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    head = (f'Content-Type: {content_type}\r\n'
+            f'Content-Disposition: {content_disposition(filename)}\r\n'
+            f'Content-Transfer-Encoding: base64\r\n\r\n').encode('ascii')
+    digest = hashlib.sha256()
+    lines = [head]
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size > ATTACHMENT_MAX_BYTES:
+            raise AttachmentError(f'{filename} is {size} bytes, over the {ATTACHMENT_MAX_BYTES} byte limit')
+        if size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                with memoryview(data) as view:
+                    for start in range(0, size, SLICE_BYTES):
+                        # Slices of the mapping are views, not copies; release each before the mapping closes
+                        with view[start:start + SLICE_BYTES] as chunk:
+                            digest.update(chunk)
+                            encoded = binascii.b2a_base64(chunk, newline=False)
+                        lines.extend(encoded[i:i + 76] + CRLF for i in range(0, len(encoded), 76))
+    return digest.hexdigest(), b''.join(lines)
+
+
+def attachment_parts(boundary, attachments):
+    # The tail of a multipart/mixed body: one part per attachment and the closing delimiter
+    parts = []
+    for attachment in attachments:
+        parts.append(b'--' + boundary + CRLF)
+        parts.append(attachment.view)
+    parts.append(b'--' + boundary + b'--' + CRLF)
+    return parts
+
+
+class AttachmentCache:
+    # Encoded parts by content hash and file name, evicted least recently used once over max_bytes.
+    # A file is only read and hashed again when its size or mtime changes.
+    def __init__(self, directory=ATTACHMENT_DIR, max_bytes=ATTACHMENT_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._parts = OrderedDict()
+        self._digests = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def resolve(self, name):
+        root = os.path.realpath(self.directory)
+        path = os.path.realpath(os.path.join(root, name))
+        if os.path.commonpath([root, path]) != root or not os.path.isfile(path):
+            raise AttachmentError(f'Unknown attachment: {name}')
+        return path
+
+    def get(self, name):
+        path = self.resolve(name)
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        filename = os.path.basename(name)
+        with self._lock:
+            digest = self._digests.get(key)
+            attachment = self._parts.get((digest, filename))
+            if attachment is not None:
+                self._parts.move_to_end((digest, filename))
+                return attachment
+
+        # Encode outside the lock; a concurrent encode of the same file is harmless
+        digest, part = encode_file(path, filename)
+        with self._lock:
+            self._digests[key] = digest
+            attachment = self._parts.get((digest, filename))
+            if attachment is None:
+                attachment = self._parts[(digest, filename)] = EncodedAttachment(digest, filename, part)
+                self._bytes += len(part)
+            self._parts.move_to_end((digest, filename))
+            while self._bytes > self.max_bytes and len(self._parts) > 1:
+                _, evicted = self._parts.popitem(last=False)
+                self._bytes -= len(evicted.part)
+        return attachment
+
+    def get_many(self, names):
+        return [self.get(name) for name in names or ()]
+
+
+attachment_cache = AttachmentCache()
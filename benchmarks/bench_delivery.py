@@ -0,0 +1,94 @@
+import ssl
+import time
+import smtplib
+import argparse
+
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+
+from async_delivery import deliver_batch
+from message_cache import message_cache
+from smtp_pool import SMTPConnectionPool
+from benchmarks.smtp_sink import SMTPSink, make_self_signed_cert
+
+# Compares the old connection-per-task path with the pooled and asyncio delivery paths.
+# Run from the project root: python -m benchmarks.bench_delivery --messages 500 --latency 0.002
+
+SENDER = 'bench@example.com'
+
+
+def build_message():
+    msg = MIMEMultipart()
+    msg['From'] = SENDER
+    msg['Subject'] = "Subject: Test"
+    msg.attach(MIMEText("This is the stage 3 task given by HNG internship.", 'plain'))
+    return msg
+
+
+def recipients(count):
+    return [f'user{i}@example.com' for i in range(count)]
+
+
+def render(email):
+    return message_cache.get('bench', 1, build_message, domain='example.com').render(email)
+
+
+def connection_per_message(sink, emails):
+    for email in emails:
+        server = smtplib.SMTP(sink.host, sink.port)
+        server.starttls()
+        server.login(SENDER, 'secret')
+        server.sendmail(SENDER, email, render(email))
+        server.quit()
+
+
+def pooled(sink, emails):
+    pool = SMTPConnectionPool(sink.host, sink.port, SENDER, 'secret')
+    for email in emails:
+        with pool.connection() as server:
+            server.sendmail(SENDER, email, render(email))
+    pool.close_all()
+
+
+def async_engine(sink, emails, concurrency):
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    results = deliver_batch(sink.host, sink.port, SENDER, 'secret', SENDER,
+                            ((email, render(email)) for email in emails),
+                            concurrency=concurrency, ssl_context=context)
+    failed = [email for email, error in results.items() if error is not None]
+    if failed:
+        raise RuntimeError(f'{len(failed)} messages failed, first: {results[failed[0]]}')
+
+
+def run(name, sink, func, *args):
+    before = sink.messages
+    started = time.perf_counter()
+    func(sink, *args)
+    elapsed = time.perf_counter() - started
+    sent = sink.messages - before
+    print(f'{name:<28} {sent:>6} msgs {elapsed:>8.3f}s {sent / elapsed:>10.1f} msg/s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SMTP delivery path benchmark')
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.001,
+                        help='seconds the sink waits before each reply')
+    parser.add_argument('--concurrency', type=int, default=20)
+    args = parser.parse_args()
+
+    certfile, keyfile = make_self_signed_cert()
+    sink = SMTPSink(latency=args.latency, certfile=certfile, keyfile=keyfile).start()
+    emails = recipients(args.messages)
+    try:
+        run('connection per message', sink, connection_per_message, emails)
+        run('pooled session', sink, pooled, emails)
+        run(f'asyncio x{args.concurrency}', sink, async_engine, emails, args.concurrency)
+    finally:
+        sink.stop()
+
+
+if __name__ == '__main__':
+    main()
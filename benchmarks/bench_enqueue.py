@@ -0,0 +1,97 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# Enqueue throughput and latency of GET /?sendmail=... under each publish setup, with concurrent
+# keep-alive clients against a threaded server. Run from the project root:
+#   python -m benchmarks.bench_enqueue --requests 5000 --clients 32 [--broker amqp://guest@localhost//]
+#
+#   pool-1   one pooled producer connection shared by every request thread
+#   pooled   BROKER_POOL_LIMIT sized to the client count
+#   batched  ENQUEUE_BATCHING: requests are published together by one thread, one round of confirms per batch
+#
+# The default memory:// broker has no network round-trip and no publisher confirms, so it only shows the
+# in-process cost of each path; pass --broker to measure against a real broker.
+
+MODES = {
+    'pool-1': {'BROKER_POOL_LIMIT': '1'},
+    'pooled': {},
+    'batched': {'ENQUEUE_BATCHING': 'true'},
+}
+
+
+def child(args):
+    from benchmarks.load_test import Client, start_http_server, percentiles
+    import app
+
+    server = start_http_server(app.app)
+    client = Client(server.server_port)
+    latencies = []
+
+    def enqueue(i):
+        started = time.perf_counter()
+        status, _ = client.get(f'/?sendmail=user{i}@example.com&talktome=bench')
+        latencies.append(time.perf_counter() - started)
+        return status
+
+    with ThreadPoolExecutor(args.clients) as pool:
+        list(pool.map(enqueue, range(-args.clients * 10, 0)))
+        latencies.clear()
+        started = time.perf_counter()
+        statuses = list(pool.map(enqueue, range(args.requests)))
+        seconds = time.perf_counter() - started
+    server.shutdown()
+
+    result = dict(percentiles(latencies), requests_per_second=args.requests / seconds,
+                  errors=sum(status != 200 for status in statuses))
+    sys.__stderr__.write('RESULT ' + json.dumps(result) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Enqueue path benchmark')
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--broker', default='memory://')
+    parser.add_argument('--mode', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        child(args)
+        return
+
+    workdir = tempfile.mkdtemp(prefix='bench-enqueue-')
+    print(f'{"mode":<8} {"req/s":>8} {"p50 ms":>8} {"p90 ms":>8} {"p99 ms":>8} {"errors":>7}')
+    for mode, settings in MODES.items():
+        env = dict(os.environ)
+        env.update({
+            'BROKER_POOL_LIMIT': str(args.clients),
+            'CELERY_BROKER_URL': args.broker,
+            'CELERY_RESULT_BACKEND': 'cache+memory://',
+            'LOG_PATH': os.path.join(workdir, f'{mode}.log'),
+            'LOG_LEVEL': 'WARNING',
+            'IDEMPOTENCY_DB': os.path.join(workdir, f'{mode}-idempotency.db'),
+            'SMTP_PORT': os.getenv('SMTP_PORT', '25'),
+        })
+        env.update(settings)
+        with open(os.path.join(workdir, f'{mode}.out'), 'w') as out:
+            proc = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.bench_enqueue', '--mode', mode, '--requests', str(args.requests),
+                 '--clients', str(args.clients), '--broker', args.broker],
+                env=env, stdout=out, stderr=out)
+        with open(os.path.join(workdir, f'{mode}.out')) as out:
+            lines = [line for line in out if line.startswith('RESULT ')]
+        if proc.returncode or not lines:
+            print(f'{mode:<8} failed, see {workdir}/{mode}.out')
+            continue
+        result = json.loads(lines[-1][len('RESULT '):])
+        print(f'{mode:<8} {result["requests_per_second"]:>8.0f} {result["p50"] * 1000:>8.2f} '
+              f'{result["p90"] * 1000:>8.2f} {result["p99"] * 1000:>8.2f} {result["errors"]:>7}')
+
+
+if __name__ == '__main__':
+    main()
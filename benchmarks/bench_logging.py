@@ -0,0 +1,91 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+# Per-request cost of index() and get_task_status() under each logging setup.
+# Run from the project root: python -m benchmarks.bench_logging --requests 2000
+#
+#   legacy  synchronous file + console handlers at DEBUG plus a print() for every log line (the old setup)
+#   sync    synchronous file + console handlers, no print()
+#   queue   QueueHandler on the request thread, formatting and I/O on the listener thread
+#   off     logging below CRITICAL disabled, the floor the other modes are compared against
+
+MODES = {
+    'legacy': {'LOG_MODE': 'sync', 'LOG_LEVEL': 'DEBUG'},
+    'sync': {'LOG_MODE': 'sync', 'LOG_LEVEL': 'INFO'},
+    'queue': {'LOG_MODE': 'queue', 'LOG_LEVEL': 'INFO'},
+    'off': {'LOG_MODE': 'sync', 'LOG_LEVEL': 'CRITICAL'},
+}
+REPEATS = 5
+
+
+def measure(client, path, requests):
+    # Best of several rounds, which filters out scheduler noise
+    timings = []
+    for _ in range(REPEATS):
+        started = time.perf_counter()
+        for _ in range(requests):
+            client.get(path)
+        timings.append((time.perf_counter() - started) / requests * 1e6)
+    return min(timings)
+
+
+def child(mode, requests):
+    import logging
+    import app
+
+    if mode == 'legacy':
+        # Stands in for the print() that used to follow every log call
+        echo = logging.StreamHandler(sys.stdout)
+        echo.setFormatter(logging.Formatter('%(message)s'))
+        logging.getLogger().addHandler(echo)
+
+    app.celery.backend.store_result('bench-task', {'status': 'SUCCESS', 'email': 'bench@example.com'}, 'SUCCESS')
+    client = app.app.test_client()
+    measure(client, '/?sendmail=bench@example.com&talktome=hi', 100)
+    result = {
+        'index_us': measure(client, '/?sendmail=bench@example.com&talktome=hi', requests),
+        'task_status_us': measure(client, '/task_status/bench-task', requests),
+    }
+    sys.__stderr__.write(json.dumps(result) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Logging overhead benchmark')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--mode', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        child(args.mode, args.requests)
+        return
+
+    workdir = tempfile.mkdtemp(prefix='bench-logging-')
+    print(f'{"mode":<8} {"index() us/req":>16} {"task_status() us/req":>22}')
+    for mode, settings in MODES.items():
+        env = dict(os.environ, **settings,
+                   LOG_PATH=os.path.join(workdir, f'{mode}.log'),
+                   CELERY_BROKER_URL='memory://',
+                   CELERY_RESULT_BACKEND='cache+memory://',
+                   SMTP_PORT=os.getenv('SMTP_PORT', '25'))
+        # Console output goes to a real file so its write cost is counted
+        with open(os.path.join(workdir, f'{mode}.out'), 'w') as out:
+            proc = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.bench_logging', '--mode', mode,
+                 '--requests', str(args.requests)],
+                env=env, stdout=out, stderr=out)
+        with open(os.path.join(workdir, f'{mode}.out')) as out:
+            lines = [line for line in out if line.startswith('{"index_us"')]
+        if proc.returncode or not lines:
+            print(f'{mode:<8} failed, see {workdir}/{mode}.out')
+            continue
+        result = json.loads(lines[-1])
+        print(f'{mode:<8} {result["index_us"]:>16.1f} {result["task_status_us"]:>22.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+from contextlib import ExitStack
+
+from benchmarks.smtp_sink import SMTPSink
+
+# Transactional send latency while a bulk backlog drains, with embedded workers and an SMTP sink.
+# Run from the project root:
+#   python -m benchmarks.bench_priority --bulk 3000 --transactional 200 --workers 8
+#
+#   shared  both classes in one queue, every worker on it: transactional sends wait behind the backlog
+#   split   separate queues, with --transactional-workers of the workers kept for transactional mail
+#
+# Latency is from publish to the end of the task, so it includes SMTP time.
+
+MODES = ('shared', 'split')
+
+
+def child(args):
+    from benchmarks.load_test import percentiles
+    sink = SMTPSink(latency=args.smtp_latency).start()
+    os.environ.update({'SMTP_SERVER': sink.host, 'SMTP_PORT': str(sink.port)})
+
+    import tasks
+    from celery.signals import task_postrun
+    from celery.contrib.testing.worker import start_worker
+
+    published = {}
+    finished = {}
+
+    @task_postrun.connect
+    def record(task_id=None, **kwargs):
+        finished[task_id] = time.perf_counter()
+
+    def run_workers():
+        if args.mode == 'shared':
+            return [start_worker(tasks.celery, pool='threads', concurrency=args.workers,
+                                 queues=[tasks.EMAIL_QUEUE_BULK], perform_ping_check=False)]
+        return [start_worker(tasks.celery, pool='threads', concurrency=args.workers - args.transactional_workers,
+                             queues=[tasks.EMAIL_QUEUE_BULK], perform_ping_check=False, hostname='bulk@bench'),
+                start_worker(tasks.celery, pool='threads', concurrency=args.transactional_workers,
+                             queues=[tasks.EMAIL_QUEUE_TRANSACTIONAL], perform_ping_check=False,
+                             hostname='transactional@bench')]
+
+    bulk_ids = []
+    with tasks.celery.producer_or_acquire() as producer:
+        for i in range(args.bulk):
+            result = tasks.send_email.apply_async(args=[f'bulk{i}@example.com'], producer=producer,
+                                                  **tasks.route('bulk'))
+            bulk_ids.append(result.id)
+    started = time.perf_counter()
+
+    transactional_ids = []
+    with ExitStack() as stack:
+        for worker in run_workers():
+            stack.enter_context(worker)
+        # A steady trickle of transactional sends while the backlog drains
+        for i in range(args.transactional):
+            result = tasks.send_email.apply_async(args=[f'tx{i}@example.com'], **tasks.route('transactional'))
+            published[result.id] = time.perf_counter()
+            transactional_ids.append(result.id)
+            time.sleep(1 / args.rate)
+        deadline = time.monotonic() + args.timeout
+        while time.monotonic() < deadline and not all(task_id in finished for task_id in bulk_ids + transactional_ids):
+            time.sleep(0.05)
+    sink.stop()
+
+    latencies = [finished[task_id] - published[task_id] for task_id in transactional_ids if task_id in finished]
+    bulk_done = [finished[task_id] for task_id in bulk_ids if task_id in finished]
+    result = dict(percentiles(latencies), delivered=len(latencies),
+                  bulk_delivered=len(bulk_done), bulk_seconds=max(bulk_done) - started if bulk_done else None)
+    sys.__stderr__.write('RESULT ' + json.dumps(result) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Transactional latency under a bulk backlog')
+    parser.add_argument('--bulk', type=int, default=3000, help='bulk sends queued before the workers start')
+    parser.add_argument('--transactional', type=int, default=200)
+    parser.add_argument('--rate', type=float, default=50, help='transactional sends per second')
+    parser.add_argument('--workers', type=int, default=8, help='worker threads in total')
+    parser.add_argument('--transactional-workers', type=int, default=2)
+    parser.add_argument('--smtp-latency', type=float, default=0.001)
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--mode', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        child(args)
+        return
+
+    workdir = tempfile.mkdtemp(prefix='bench-priority-')
+    print(f'{"mode":<7} {"tx p50 ms":>10} {"tx p90 ms":>10} {"tx p99 ms":>10} {"tx sent":>8} {"bulk s":>8}')
+    for mode in MODES:
+        env = dict(os.environ)
+        env.update({
+            'EMAIL': 'bench@example.com',
+            'PASSWORD': '',
+            'SMTP_PORT': '25',
+            'SMTP_STARTTLS': 'false',
+            'CELERY_BROKER_URL': 'memory://',
+            'CELERY_RESULT_BACKEND': 'cache+memory://',
+            'LOG_PATH': os.path.join(workdir, f'{mode}.log'),
+            'LOG_LEVEL': 'WARNING',
+            'DEAD_LETTER_DB': os.path.join(workdir, f'{mode}-dead_letters.db'),
+            'RATE_LIMIT_DIR': os.path.join(workdir, f'{mode}-rate-limit'),
+            'SCHEDULER_DB': os.path.join(workdir, f'{mode}-scheduler.db'),
+            'SUPPRESSION_DB': os.path.join(workdir, f'{mode}-suppressions.db'),
+            'DELIVERY_DB': os.path.join(workdir, f'{mode}-deliveries.db'),
+            'OUTBOX_DIR': os.path.join(workdir, f'{mode}-outbox'),
+            'BLOB_DIR': os.path.join(workdir, f'{mode}-blobs'),
+            'SMTP_RATE_LIMIT': '100000',
+            'SMTP_RATE_BURST': '100000',
+            'SMTP_RATE_MAX': '100000',
+        })
+        if mode == 'shared':
+            env['EMAIL_QUEUE_TRANSACTIONAL'] = env['EMAIL_QUEUE_BULK'] = 'email'
+        with open(os.path.join(workdir, f'{mode}.out'), 'w') as out:
+            proc = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.bench_priority', '--mode', mode] + sys.argv[1:],
+                env=env, stdout=out, stderr=out)
+        with open(os.path.join(workdir, f'{mode}.out')) as out:
+            lines = [line for line in out if line.startswith('RESULT ')]
+        if proc.returncode or not lines:
+            print(f'{mode:<7} failed, see {workdir}/{mode}.out')
+            continue
+        result = json.loads(lines[-1][len('RESULT '):])
+        if not result.get('count'):
+            print(f'{mode:<7} no transactional sends finished, see {workdir}/{mode}.out')
+            continue
+        print(f'{mode:<7} {result["p50"] * 1000:>10.1f} {result["p90"] * 1000:>10.1f} {result["p99"] * 1000:>10.1f} '
+              f'{result["delivered"]:>8} {result["bulk_seconds"] or 0:>8.1f}')
+
+
+if __name__ == '__main__':
+    main()
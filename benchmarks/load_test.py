@@ -0,0 +1,261 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.smtp_sink import SMTPSink, make_self_signed_cert
+
+# End-to-end load test: Flask app + embedded Celery worker + in-process SMTP sink, all in one process.
+# Run from the project root:
+#   python -m benchmarks.load_test --requests 2000 --clients 16 --workers 8 --smtp-latency 0.002
+# Each run is written as JSON to benchmarks/results/ (or --output) so runs can be compared.
+
+TERMINAL = ('SUCCESS', 'FAILURE')
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def pick(p):
+        return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values),
+        'p50': pick(50),
+        'p90': pick(90),
+        'p99': pick(99),
+        'max': values[-1],
+    }
+
+
+def configure_environment(args, workdir, sink):
+    # Must run before app/tasks are imported, since both read their settings at import time
+    os.environ.update({
+        'SMTP_SERVER': sink.host,
+        'SMTP_PORT': str(sink.port),
+        'SMTP_STARTTLS': 'true' if args.tls else 'false',
+        'EMAIL': 'loadtest@example.com',
+        'PASSWORD': 'secret',
+        'CELERY_BROKER_URL': 'memory://',
+        # Shared between the app's and the worker's Celery instances. Writes are not atomic, so a poll
+        # can occasionally catch a half-written file; those show up under 'errors' in the report
+        'CELERY_RESULT_BACKEND': f'file://{workdir}/results',
+        'LOG_PATH': os.path.join(workdir, 'messaging_system.log'),
+        'LOG_LEVEL': 'WARNING',
+        'DEAD_LETTER_DB': os.path.join(workdir, 'dead_letters.db'),
+        'IDEMPOTENCY_DB': os.path.join(workdir, 'idempotency.db'),
+        'RATE_LIMIT_DIR': os.path.join(workdir, 'rate-limit'),
+        'SCHEDULER_DB': os.path.join(workdir, 'scheduler.db'),
+        'SUPPRESSION_DB': os.path.join(workdir, 'suppressions.db'),
+        'DELIVERY_DB': os.path.join(workdir, 'deliveries.db'),
+        'OUTBOX_DIR': os.path.join(workdir, 'outbox'),
+        'BLOB_DIR': os.path.join(workdir, 'blobs'),
+        'SMTP_RATE_LIMIT': str(args.smtp_rate),
+        'SMTP_RATE_BURST': str(args.smtp_rate),
+        'SMTP_RATE_MAX': str(args.smtp_rate),
+        'RETRY_BASE_DELAY': '0.5',
+        'THROTTLE_BASE_DELAY': '1',
+        'RETRY_MAX_DELAY': '5',
+    })
+    os.makedirs(os.path.join(workdir, 'results'), exist_ok=True)
+
+
+def start_http_server(flask_app):
+    import logging
+    from werkzeug.serving import make_server
+
+    # Per-request access logging would dominate the measurement
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    server = make_server('127.0.0.1', 0, flask_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class Client:
+    # One keep-alive HTTP connection per load generator thread
+    def __init__(self, port):
+        self.port = port
+        self._local = threading.local()
+
+    def get(self, path):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            return response.status, json.loads(response.read() or b'null')
+        except (http.client.HTTPException, OSError):
+            self._local.conn = None
+            raise
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='load-test-')
+    certfile = keyfile = None
+    if args.tls:
+        certfile, keyfile = make_self_signed_cert(workdir)
+    sink = SMTPSink(latency=args.smtp_latency, certfile=certfile, keyfile=keyfile,
+                    fail_rate=args.fail_rate, fail_code=args.fail_code, seed=1).start()
+    configure_environment(args, workdir, sink)
+
+    import app
+    import tasks
+    import smtp_pool
+    from celery.contrib.testing.worker import start_worker
+
+    phases = defaultdict(list)
+    phases_lock = threading.Lock()
+
+    def record_phase(phase, seconds):
+        with phases_lock:
+            phases[phase].append(seconds)
+
+    smtp_pool.phase_observers.append(record_phase)
+
+    server = start_http_server(app.app)
+    client = Client(server.server_port)
+    enqueue_latencies = []
+    status_latencies = []
+    errors = defaultdict(int)
+    errors_lock = threading.Lock()
+
+    def count_error(name):
+        with errors_lock:
+            errors[name] += 1
+
+    def enqueue(i):
+        started = time.perf_counter()
+        try:
+            status, body = client.get(f'/?sendmail=user{i}@example.com&talktome=loadtest')
+        except Exception as e:
+            count_error(type(e).__name__)
+            return None
+        enqueue_latencies.append(time.perf_counter() - started)
+        if status != 200:
+            count_error(f'http_{status}')
+            return None
+        return body['task_id']
+
+    def poll(task_id, deadline):
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                _, body = client.get(f'/task_status/{task_id}')
+            except Exception as e:
+                count_error(type(e).__name__)
+                continue
+            status_latencies.append(time.perf_counter() - started)
+            if body['status'] in TERMINAL:
+                return body['status'], time.monotonic()
+            time.sleep(args.poll_interval)
+        return 'TIMEOUT', time.monotonic()
+
+    with start_worker(tasks.celery, pool='threads', concurrency=args.workers,
+                      perform_ping_check=False, shutdown_timeout=30):
+        started = time.monotonic()
+        with ThreadPoolExecutor(args.clients) as pool:
+            task_ids = [task_id for task_id in pool.map(enqueue, range(args.requests)) if task_id]
+        enqueue_seconds = time.monotonic() - started
+
+        deadline = time.monotonic() + args.timeout
+        with ThreadPoolExecutor(args.clients) as pool:
+            outcomes = list(pool.map(lambda task_id: poll(task_id, deadline), task_ids))
+        finished = max((at for _, at in outcomes), default=time.monotonic())
+
+    server.shutdown()
+    sink.stop()
+
+    states = defaultdict(int)
+    for state, _ in outcomes:
+        states[state] += 1
+    delivery_seconds = finished - started
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'git_revision': git_revision(),
+        'config': vars(args),
+        'requests': args.requests,
+        'enqueued': len(task_ids),
+        'states': dict(states),
+        'errors': dict(errors),
+        'sink': {'messages': sink.messages, 'connections': sink.connections, 'injected_failures': sink.failures},
+        'enqueue': {
+            'seconds': enqueue_seconds,
+            'requests_per_second': len(task_ids) / enqueue_seconds if enqueue_seconds else 0,
+            'latency': percentiles(enqueue_latencies),
+        },
+        'task_status_latency': percentiles(status_latencies),
+        'delivery': {
+            'seconds': delivery_seconds,
+            'messages_per_second': sink.messages / delivery_seconds if delivery_seconds else 0,
+        },
+        'smtp_phases': {phase: dict(percentiles(values), total=sum(values)) for phase, values in phases.items()},
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report):
+    ms = 1000
+    enqueue = report['enqueue']
+    print(f'enqueued {report["enqueued"]}/{report["requests"]} in {enqueue["seconds"]:.2f}s '
+          f'({enqueue["requests_per_second"]:.0f} req/s), states: {report["states"]}')
+    if report['errors']:
+        print(f'errors: {report["errors"]}')
+    latency = enqueue['latency']
+    if latency:
+        print(f'enqueue latency ms: p50 {latency["p50"] * ms:.2f}  p90 {latency["p90"] * ms:.2f}  '
+              f'p99 {latency["p99"] * ms:.2f}  max {latency["max"] * ms:.2f}')
+    delivery = report['delivery']
+    print(f'delivered {report["sink"]["messages"]} in {delivery["seconds"]:.2f}s '
+          f'({delivery["messages_per_second"]:.0f} msg/s), SMTP connections {report["sink"]["connections"]}')
+    for phase, stats in report['smtp_phases'].items():
+        print(f'  {phase:<9} n={stats["count"]:<6} total {stats["total"]:.2f}s  '
+              f'p50 {stats["p50"] * ms:.2f}ms  p99 {stats["p99"] * ms:.2f}ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end load test')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--clients', type=int, default=16, help='concurrent HTTP clients')
+    parser.add_argument('--workers', type=int, default=8, help='embedded Celery worker threads')
+    parser.add_argument('--smtp-latency', type=float, default=0.001, help='sink delay per SMTP reply, seconds')
+    parser.add_argument('--smtp-rate', type=float, default=100000, help='SMTP_RATE_LIMIT for the run')
+    parser.add_argument('--no-tls', dest='tls', action='store_false', help='disable STARTTLS on the sink')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='fraction of RCPT TO commands to reject')
+    parser.add_argument('--fail-code', type=int, default=451)
+    parser.add_argument('--poll-interval', type=float, default=0.05)
+    parser.add_argument('--timeout', type=float, default=120, help='seconds to wait for delivery')
+    parser.add_argument('--output', help='JSON report path')
+    args = parser.parse_args()
+
+    report = run(args)
+    print_report(report)
+
+    output = args.output or os.path.join('benchmarks', 'results', f'load-{time.strftime("%Y%m%d-%H%M%S")}.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'report written to {output}')
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
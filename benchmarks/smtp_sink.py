@@ -0,0 +1,110 @@
+import os
+import ssl
+import random
+import asyncio
+import tempfile
+import threading
+import subprocess
+
+# Minimal in-process SMTP server that accepts and discards mail, for benchmarks
+
+
+def make_self_signed_cert(directory=None):
+    directory = directory or tempfile.mkdtemp(prefix='smtp-sink-')
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    subprocess.run(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+         '-subj', '/CN=localhost', '-keyout', keyfile, '-out', certfile],
+        check=True, capture_output=True)
+    return certfile, keyfile
+
+
+class SMTPSink:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, certfile=None, keyfile=None,
+                 fail_rate=0.0, fail_code=451, seed=None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        # Fraction of RCPT TO commands answered with fail_code instead of 250
+        self.fail_rate = fail_rate
+        self.fail_code = fail_code
+        self.random = random.Random(seed)
+        self.failures = 0
+        self.ssl_context = None
+        if certfile:
+            self.ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            self.ssl_context.load_cert_chain(certfile, keyfile)
+        self.messages = 0
+        self.connections = 0
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    async def _send(self, writer, line):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        writer.write(line.encode('ascii') + b'\r\n')
+        await writer.drain()
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        await self._send(writer, '220 localhost SMTP sink ready')
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                verb = line.strip().split(b' ', 1)[0].upper()
+                if verb in (b'EHLO', b'HELO'):
+                    features = ['250-localhost', '250-PIPELINING', '250-8BITMIME']
+                    if self.ssl_context and writer.get_extra_info('sslcontext') is None:
+                        features.append('250-STARTTLS')
+                    features.append('250 AUTH PLAIN LOGIN')
+                    await self._send(writer, '\r\n'.join(features))
+                elif verb == b'STARTTLS' and self.ssl_context:
+                    await self._send(writer, '220 Ready to start TLS')
+                    await writer.start_tls(self.ssl_context)
+                elif verb == b'AUTH':
+                    await self._send(writer, '235 Authentication successful')
+                elif verb == b'DATA':
+                    await self._send(writer, '354 End data with <CR><LF>.<CR><LF>')
+                    while (await reader.readline()) not in (b'.\r\n', b''):
+                        pass
+                    self.messages += 1
+                    await self._send(writer, '250 OK queued')
+                elif verb == b'QUIT':
+                    await self._send(writer, '221 Bye')
+                    return
+                elif verb == b'RCPT' and self.fail_rate and self.random.random() < self.fail_rate:
+                    self.failures += 1
+                    await self._send(writer, f'{self.fail_code} Injected failure')
+                elif verb in (b'MAIL', b'RCPT', b'RSET', b'NOOP'):
+                    await self._send(writer, '250 OK')
+                else:
+                    await self._send(writer, '502 Command not implemented')
+        except (ConnectionError, ssl.SSLError):
+            pass
+        finally:
+            writer.close()
+
+    def start(self):
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._handle, self.host, self.port))
+            self.port = self._server.sockets[0].getsockname()[1]
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._server.close)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
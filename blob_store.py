@@ -0,0 +1,113 @@
+import os
+import json
+import hashlib
+import importlib
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Where message content is kept, by sha256; must be shared by the web tier and every worker
+BLOB_DIR = os.getenv('BLOB_DIR', 'blobs')
+# "module:Class" of another backend (e.g. one over S3 or Redis), built with no arguments; the default is BLOB_DIR
+BLOB_BACKEND = os.getenv('BLOB_BACKEND')
+# Content kept in memory per process, in bytes
+BLOB_CACHE_BYTES = int(os.getenv('BLOB_CACHE_BYTES', str(64 * 1024 * 1024)))
+
+
+class BlobNotFound(LookupError):
+    pass
+
+
+def blob_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class FileBackend:
+    # One file per blob under a two-level fan-out, written to a temporary name and renamed into place
+    def __init__(self, directory=BLOB_DIR):
+        self.directory = directory
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest[2:4], digest)
+
+    def exists(self, digest):
+        return os.path.exists(self._path(digest))
+
+    def get(self, digest):
+        try:
+            with open(self._path(digest), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            raise BlobNotFound(digest) from None
+
+    def put(self, digest, data):
+        path = self._path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+
+def load_backend():
+    if not BLOB_BACKEND:
+        return FileBackend()
+    module, _, name = BLOB_BACKEND.partition(':')
+    return getattr(importlib.import_module(module), name)()
+
+
+class BlobStore:
+    # Content-addressed: the same bytes always get the same digest, so storing them again is a no-op
+    # and a cached copy can never be stale. Reads go through an LRU bounded by max_bytes.
+    def __init__(self, backend=None, max_bytes=BLOB_CACHE_BYTES):
+        self.backend = backend
+        self.max_bytes = max_bytes
+        self._cache = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _backend(self):
+        if self.backend is None:
+            self.backend = load_backend()
+        return self.backend
+
+    def put(self, data):
+        digest = blob_digest(data)
+        backend = self._backend()
+        if not backend.exists(digest):
+            backend.put(digest, data)
+        return digest
+
+    def get(self, digest):
+        with self._lock:
+            data = self._cache.get(digest)
+            if data is not None:
+                self._cache.move_to_end(digest)
+                return data
+
+        data = self._backend().get(digest)
+        if blob_digest(data) != digest:
+            raise BlobNotFound(f'{digest} is corrupt')
+        with self._lock:
+            if digest not in self._cache:
+                self._cache[digest] = data
+                self._bytes += len(data)
+            while self._bytes > self.max_bytes and len(self._cache) > 1:
+                _, evicted = self._cache.popitem(last=False)
+                self._bytes -= len(evicted)
+        return data
+
+    def put_json(self, value):
+        # Sorted keys, so equal content gets the same digest however it was sent
+        return self.put(json.dumps(value, sort_keys=True, separators=(',', ':')).encode())
+
+    def get_json(self, digest):
+        return json.loads(self.get(digest))
+
+
+blobs = BlobStore()
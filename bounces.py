@@ -0,0 +1,390 @@
+import os
+import re
+import json
+import time
+import email
+import heapq
+import socket
+import hashlib
+import logging
+import sqlite3
+import argparse
+import threading
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ProcessPoolExecutor
+from dotenv import load_dotenv
+
+from suppression import suppressions
+from metrics import BOUNCE_MESSAGES, DELIVERY_EVENTS, maybe_flush
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Reads delivery status notifications (RFC 3464) that come back to the EMAIL mailbox and records each
+# recipient's outcome against the task that sent it:
+#   python bounces.py [--once]
+# The mailbox is a maildir (a directory with new/ and cur/) or an mbox file, as left by the local MDA or
+# fetchmail. The read position is committed with the outcomes, so a restart resumes where it stopped.
+
+# Maildir directory or mbox file to read
+BOUNCE_MAILBOX = os.getenv('BOUNCE_MAILBOX')
+# Outcomes per task and recipient, and the read position of each mailbox
+DELIVERY_DB = os.getenv('DELIVERY_DB', 'deliveries.db')
+# Seconds between scans once the mailbox has been read to the end
+BOUNCE_POLL_INTERVAL = float(os.getenv('BOUNCE_POLL_INTERVAL', '10'))
+# Messages parsed and written per transaction
+BOUNCE_BATCH_SIZE = int(os.getenv('BOUNCE_BATCH_SIZE', '1000'))
+# Parser processes; 1 parses in the scanning process
+BOUNCE_PARSE_PROCESSES = int(os.getenv('BOUNCE_PARSE_PROCESSES', str(os.cpu_count() or 1)))
+# Mail modified more recently than this many seconds may still be being delivered and is left for the next scan
+BOUNCE_SETTLE_SECONDS = float(os.getenv('BOUNCE_SETTLE_SECONDS', '5'))
+# Add recipients with permanent addressing failures to the suppression list
+BOUNCE_SUPPRESS = os.getenv('BOUNCE_SUPPRESS', 'true').lower() == 'true'
+# Domain of the Message-IDs stamped by the workers; bounces for other Message-IDs are not correlated
+MESSAGE_ID_DOMAIN = os.getenv('MESSAGE_ID_DOMAIN') or (os.getenv('EMAIL') or '').rpartition('@')[2] or socket.getfqdn()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS delivery_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    task_id TEXT,
+    message_id TEXT,
+    recipient TEXT NOT NULL,
+    action TEXT NOT NULL,
+    status TEXT,
+    diagnostic TEXT,
+    reported_at REAL NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS delivery_events_task ON delivery_events (task_id);
+CREATE TABLE IF NOT EXISTS mailbox_positions (
+    mailbox TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+# Permanent addressing failures (no such mailbox, bad domain, bad syntax): the DSN counterpart of
+# suppression.HARD_BOUNCE_CODES. Other 5.x.x failures are about the message, not the address.
+HARD_BOUNCE_STATUS_PREFIX = '5.1.'
+
+MESSAGE_ID_PATTERN = re.compile(r'<([^<>@\s]+)@([^<>\s]+)>')
+STATUS_PATTERN = re.compile(r'\d\.\d{1,3}\.\d{1,3}')
+ORIGINAL_TYPES = ('message/rfc822', 'text/rfc822-headers', 'message/rfc822-headers')
+
+
+def make_message_id(task_id, domain=MESSAGE_ID_DOMAIN, recipient=None):
+    # The task id leads the local part, so a bounce can be traced back to the task that sent it;
+    # one task sending a message per recipient adds a per-recipient part to keep each Message-ID unique
+    if not task_id:
+        return None
+    if recipient is None:
+        return f'<{task_id}@{domain}>'
+    part = hashlib.blake2b(recipient.strip().lower().encode(), digest_size=6).hexdigest()
+    return f'<{task_id}.{part}@{domain}>'
+
+
+def task_id_from_message_id(value, domain=MESSAGE_ID_DOMAIN):
+    for local, found in MESSAGE_ID_PATTERN.findall(value or ''):
+        if found.lower() == domain.lower():
+            return local.partition('.')[0]
+    return None
+
+
+def dsn_field(block, name):
+    # "rfc822; user@example.com" -> "user@example.com", with folded lines joined
+    value = block.get(name)
+    if value is None:
+        return None
+    value = ' '.join(str(value).split())
+    kind, sep, rest = value.partition(';')
+    return rest.strip() if sep else value
+
+
+def original_message_id(part):
+    payload = part.get_payload()
+    if isinstance(payload, list):
+        # message/rfc822: the returned message itself
+        return payload[0].get('Message-ID') if payload else None
+    if isinstance(payload, str):
+        # text/rfc822-headers: only the header block
+        return email.message_from_string(payload).get('Message-ID')
+    return None
+
+
+def parse_message(raw):
+    # One (task_id, message_id, recipient, action, status, diagnostic, reported_at) per recipient block
+    # of a DSN, [] for any other mail, or None for mail that could not be parsed. Runs in the parser pool.
+    try:
+        msg = email.message_from_bytes(raw)
+        report = None
+        message_id = None
+        for part in msg.walk():
+            content_type = part.get_content_type()
+            if content_type == 'message/delivery-status' and report is None:
+                report = part
+            elif content_type in ORIGINAL_TYPES and message_id is None:
+                message_id = original_message_id(part)
+        if report is None:
+            return []
+        # Some MTAs return no copy of the original but do thread the DSN to it
+        message_id = message_id or msg.get('In-Reply-To') or msg.get('References')
+        message_id = ' '.join(str(message_id).split()) if message_id else None
+        task_id = task_id_from_message_id(message_id)
+        try:
+            reported_at = parsedate_to_datetime(msg['Date']).timestamp()
+        except (TypeError, ValueError):
+            reported_at = time.time()
+
+        outcomes = []
+        # The first block holds per-message fields, each one after it is a recipient
+        for block in report.get_payload()[1:]:
+            recipient = dsn_field(block, 'Final-Recipient') or dsn_field(block, 'Original-Recipient')
+            action = (block.get('Action') or '').strip().lower()
+            if not recipient or not action:
+                continue
+            status = STATUS_PATTERN.search(block.get('Status') or '')
+            outcomes.append((task_id, message_id, recipient.strip('<>'), action, status.group(0) if status else None,
+                             dsn_field(block, 'Diagnostic-Code'), reported_at))
+        return outcomes
+    except Exception:
+        return None
+
+
+def is_hard_bounce_outcome(outcome):
+    _, _, _, action, status, _, _ = outcome
+    return action == 'failed' and bool(status) and status.startswith(HARD_BOUNCE_STATUS_PREFIX)
+
+
+class MboxSource:
+    # The position is a byte offset, reset when the file is replaced or truncated (rotation). A message
+    # ends where the next "From " line starts; the last one is taken once the file has stopped changing.
+    def __init__(self, path, settle=BOUNCE_SETTLE_SECONDS):
+        self.path = path
+        self.settle = settle
+
+    def read(self, state, limit):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return [], state
+        offset = state.get('offset', 0)
+        if state.get('inode') != st.st_ino or st.st_size < offset:
+            offset = 0
+        settled = time.time() - st.st_mtime >= self.settle
+
+        messages = []
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            start = position = offset
+            lines = []
+            previous_blank = True
+            for line in f:
+                if line.startswith(b'From ') and previous_blank:
+                    if lines:
+                        messages.append(b''.join(lines))
+                    # The separator line is not part of the message; the next unread one starts here
+                    lines = []
+                    start = position
+                    if len(messages) == limit:
+                        break
+                else:
+                    lines.append(line)
+                position += len(line)
+                previous_blank = line in (b'\n', b'\r\n')
+            else:
+                if lines and settled and previous_blank:
+                    messages.append(b''.join(lines))
+                    start = position
+        return messages, {'inode': st.st_ino, 'offset': start}
+
+
+class MaildirSource:
+    # Messages are taken in (mtime, name) order and the position is the last one read, so no file is
+    # renamed or opened twice. Files are left alone until they are older than the settle time, so one
+    # still on its way from tmp/ with an earlier mtime is not passed over.
+    def __init__(self, path, settle=BOUNCE_SETTLE_SECONDS):
+        self.path = path
+        self.settle = settle
+
+    def _candidates(self, mark, cutoff):
+        for folder in ('new', 'cur'):
+            try:
+                entries = os.scandir(os.path.join(self.path, folder))
+            except FileNotFoundError:
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.name.startswith('.'):
+                        continue
+                    try:
+                        mtime = entry.stat().st_mtime_ns
+                    except FileNotFoundError:
+                        continue
+                    # A mail client moving new/ to cur/ adds an info suffix after ":"
+                    key = (mtime, entry.name.partition(':')[0])
+                    if mark < key and mtime <= cutoff:
+                        yield key, entry.path
+
+    def _read_file(self, path, name):
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+        # Moved to cur/ since the scan
+        cur = os.path.join(self.path, 'cur')
+        for found in os.listdir(cur):
+            if found.partition(':')[0] == name:
+                with open(os.path.join(cur, found), 'rb') as f:
+                    return f.read()
+        logging.warning(f'Bounce {name} disappeared before it was read')
+        return None
+
+    def read(self, state, limit):
+        mark = tuple(state.get('mark', (0, '')))
+        cutoff = time.time_ns() - int(self.settle * 1e9)
+        messages = []
+        for key, path in heapq.nsmallest(limit, self._candidates(mark, cutoff)):
+            raw = self._read_file(path, key[1])
+            if raw is not None:
+                messages.append(raw)
+            mark = key
+        return messages, {'mark': list(mark)}
+
+
+def open_source(path):
+    if os.path.isdir(path):
+        return MaildirSource(path)
+    return MboxSource(path)
+
+
+class DeliveryStore:
+    # Outcomes from DSNs, written a batch per transaction together with the mailbox position they were
+    # read up to, so a crash never records a bounce twice or loses one.
+    def __init__(self, path=DELIVERY_DB):
+        self.path = path
+        self._local = threading.local()
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(SCHEMA)
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def position(self, mailbox):
+        row = self._db().execute('SELECT state FROM mailbox_positions WHERE mailbox = ?', (mailbox,)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def record(self, mailbox, outcomes, state):
+        now = time.time()
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.executemany('INSERT INTO delivery_events (task_id, message_id, recipient, action, status, diagnostic, '
+                           'reported_at, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                           [outcome + (now,) for outcome in outcomes])
+            db.execute('INSERT INTO mailbox_positions (mailbox, state, updated_at) VALUES (?, ?, ?) '
+                       'ON CONFLICT (mailbox) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at',
+                       (mailbox, json.dumps(state), now))
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+
+    def for_task(self, task_id):
+        rows = self._db().execute('SELECT recipient, action, status, diagnostic, message_id, reported_at '
+                                  'FROM delivery_events WHERE task_id = ? ORDER BY id', (task_id,)).fetchall()
+        return [dict(zip(('recipient', 'action', 'status', 'diagnostic', 'message_id', 'reported_at'), row))
+                for row in rows]
+
+
+class BounceProcessor:
+    def __init__(self, mailbox, store=None, processes=BOUNCE_PARSE_PROCESSES, batch_size=BOUNCE_BATCH_SIZE,
+                 interval=BOUNCE_POLL_INTERVAL, suppress=BOUNCE_SUPPRESS):
+        self.mailbox = os.path.abspath(mailbox)
+        self.source = open_source(self.mailbox)
+        self.store = store or deliveries
+        self.processes = processes
+        self.batch_size = batch_size
+        self.interval = interval
+        self.suppress = suppress
+        self._executor = None
+
+    def _parse(self, messages):
+        if self.processes <= 1:
+            return [parse_message(raw) for raw in messages]
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.processes)
+        chunksize = max(1, len(messages) // (self.processes * 4))
+        return list(self._executor.map(parse_message, messages, chunksize=chunksize))
+
+    def process_batch(self):
+        # Returns the number of messages read; 0 once the mailbox has been read to the end
+        messages, state = self.source.read(self.store.position(self.mailbox), self.batch_size)
+        if not messages:
+            return 0
+        outcomes = []
+        for parsed in self._parse(messages):
+            if parsed is None:
+                BOUNCE_MESSAGES.inc('unparsed')
+            elif not parsed:
+                BOUNCE_MESSAGES.inc('other')
+            else:
+                BOUNCE_MESSAGES.inc('dsn')
+                outcomes.extend(parsed)
+
+        if self.suppress:
+            # Before the position moves on: a crash in between reads the batch again, and adding is idempotent
+            suppressions.add_many(((outcome[2], outcome[5] or outcome[4]) for outcome in outcomes
+                                   if is_hard_bounce_outcome(outcome)), 'dsn')
+        self.store.record(self.mailbox, outcomes, state)
+        for outcome in outcomes:
+            DELIVERY_EVENTS.inc(outcome[3])
+        correlated = sum(1 for outcome in outcomes if outcome[0])
+        logging.info(f'Read {len(messages)} bounces: {len(outcomes)} outcomes, {correlated} matched to a task')
+        return len(messages)
+
+    def run(self, stop=None, once=False):
+        stop = stop or threading.Event()
+        logging.info(f'Bounce processor reading {self.mailbox}')
+        try:
+            while not stop.is_set():
+                try:
+                    read = self.process_batch()
+                except (OSError, sqlite3.Error) as e:
+                    logging.error(f'Processing bounces from {self.mailbox} failed: {e}')
+                    read = 0
+                maybe_flush()
+                if not read:
+                    if once:
+                        return
+                    stop.wait(self.interval)
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+deliveries = DeliveryStore()
+
+
+def main():
+    from logging_config import configure_logging
+
+    parser = argparse.ArgumentParser(description='Record delivery status notifications from a maildir or mbox')
+    parser.add_argument('mailbox', nargs='?', default=BOUNCE_MAILBOX, help='defaults to BOUNCE_MAILBOX')
+    parser.add_argument('--once', action='store_true', help='exit once the mailbox has been read to the end')
+    args = parser.parse_args()
+    if not args.mailbox:
+        parser.error('a mailbox path or BOUNCE_MAILBOX is required')
+
+    configure_logging()
+    BounceProcessor(args.mailbox).run(once=args.once)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Shared by the workers (writers) and the web app (listing and replay) on this host
+DEAD_LETTER_DB = os.getenv('DEAD_LETTER_DB', 'dead_letters.db')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dead_letters (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    task_name TEXT NOT NULL,
+    args TEXT NOT NULL,
+    error TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    replayed_at REAL
+);
+CREATE INDEX IF NOT EXISTS dead_letters_pending ON dead_letters (replayed_at, id);
+"""
+
+
+class DeadLetterStore:
+    def __init__(self, path=DEAD_LETTER_DB):
+        self.path = path
+        self._local = threading.local()
+
+    def _db(self):
+        # One connection per thread and per process; sqlite connections must not cross either
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(SCHEMA)
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def add_many(self, entries):
+        # entries: iterable of (task_name, args, error, kind)
+        now = time.time()
+        rows = [(task_name, json.dumps(args), str(error), kind, now)
+                for task_name, args, error, kind in entries]
+        if not rows:
+            return
+        db = self._db()
+        with db:
+            db.executemany(
+                'INSERT INTO dead_letters (task_name, args, error, kind, created_at) VALUES (?, ?, ?, ?, ?)',
+                rows)
+
+    def add(self, task_name, args, error, kind):
+        self.add_many([(task_name, args, error, kind)])
+
+    def pending(self, limit=100, ids=None):
+        query = 'SELECT id, task_name, args, error, kind, created_at FROM dead_letters WHERE replayed_at IS NULL'
+        params = []
+        if ids:
+            query += f' AND id IN ({",".join("?" * len(ids))})'
+            params.extend(ids)
+        query += ' ORDER BY id LIMIT ?'
+        params.append(limit)
+        return [
+            {'id': row[0], 'task_name': row[1], 'args': json.loads(row[2]),
+             'error': row[3], 'kind': row[4], 'created_at': row[5]}
+            for row in self._db().execute(query, params)
+        ]
+
+    def mark_replayed(self, ids):
+        if not ids:
+            return
+        db = self._db()
+        with db:
+            db.executemany('UPDATE dead_letters SET replayed_at = ? WHERE id = ?',
+                           [(time.time(), entry_id) for entry_id in ids])
+
+
+dead_letters = DeadLetterStore()
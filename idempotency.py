@@ -0,0 +1,144 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+from metrics import IDEMPOTENCY_LOOKUPS
+
+# Load environment variables from .env file
+load_dotenv()
+
+# How long a key keeps pointing at its first task, in seconds
+IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', '86400'))
+# Requests without an Idempotency-Key header are deduplicated per recipient and template within this window
+IDEMPOTENCY_WINDOW = int(os.getenv('IDEMPOTENCY_WINDOW', '300'))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv('IDEMPOTENCY_CACHE_SIZE', '100000'))
+# Shared between the gunicorn workers on this host
+IDEMPOTENCY_DB = os.getenv('IDEMPOTENCY_DB', 'idempotency.db')
+# Expired keys are deleted every this many claims per process, at most IDEMPOTENCY_PRUNE_BATCH rows at a time
+IDEMPOTENCY_PRUNE_EVERY = int(os.getenv('IDEMPOTENCY_PRUNE_EVERY', '1000'))
+IDEMPOTENCY_PRUNE_BATCH = int(os.getenv('IDEMPOTENCY_PRUNE_BATCH', '10000'))
+
+
+def idempotency_key(header_value, recipient, template_id, now=None):
+    if header_value:
+        return f'header:{header_value}'
+    window = int((now or time.time()) // IDEMPOTENCY_WINDOW)
+    digest = hashlib.sha256(f'{recipient.strip().lower()}|{template_id}|{window}'.encode()).hexdigest()
+    return f'derived:{digest}'
+
+
+class SQLiteKeyStore:
+    # Derived keys include their time window and are never claimed again, so expired rows are pruned
+    # in the background of claims rather than only when their key comes back
+    def __init__(self, path=IDEMPOTENCY_DB, prune_every=IDEMPOTENCY_PRUNE_EVERY, prune_batch=IDEMPOTENCY_PRUNE_BATCH):
+        self.path = path
+        self.prune_every = prune_every
+        self.prune_batch = prune_batch
+        self._local = threading.local()
+        self._claims = 0
+        self._lock = threading.Lock()
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS idempotency_keys '
+                       '(key TEXT PRIMARY KEY, task_id TEXT NOT NULL, expires_at REAL NOT NULL)')
+            db.execute('CREATE INDEX IF NOT EXISTS idempotency_keys_expires ON idempotency_keys (expires_at)')
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def claim(self, key, task_id, ttl):
+        # Stores key -> task_id unless a live entry exists; returns the task id that owns the key
+        db = self._db()
+        now = time.time()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('DELETE FROM idempotency_keys WHERE key = ? AND expires_at < ?', (key, now))
+            db.execute('INSERT OR IGNORE INTO idempotency_keys (key, task_id, expires_at) VALUES (?, ?, ?)',
+                       (key, task_id, now + ttl))
+            row = db.execute('SELECT task_id, expires_at FROM idempotency_keys WHERE key = ?', (key,)).fetchone()
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        with self._lock:
+            self._claims += 1
+            prune = self._claims % self.prune_every == 0
+        if prune:
+            self.prune(now)
+        return row
+
+    def prune(self, now=None):
+        # Bounded, so the write lock is never held for long; returns the number of rows deleted
+        cursor = self._db().execute(
+            'DELETE FROM idempotency_keys WHERE rowid IN '
+            '(SELECT rowid FROM idempotency_keys WHERE expires_at < ? LIMIT ?)',
+            (now or time.time(), self.prune_batch))
+        return cursor.rowcount
+
+    def release(self, key, task_id):
+        self._db().execute('DELETE FROM idempotency_keys WHERE key = ? AND task_id = ?', (key, task_id))
+
+
+class IdempotencyGuard:
+    def __init__(self, store, ttl=IDEMPOTENCY_TTL, cache_size=IDEMPOTENCY_CACHE_SIZE):
+        self.store = store
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'local_hits': 0, 'shared_hits': 0, 'misses': 0}
+
+    def _cached(self, key):
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.time():
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            self._stats['local_hits'] += 1
+            return entry[0]
+
+    def _remember(self, key, task_id, expires_at):
+        with self._lock:
+            self._cache[key] = (task_id, expires_at)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def claim(self, key, task_id):
+        # Returns the id of an earlier task for this key, or None when task_id now owns it
+        existing = self._cached(key)
+        if existing is not None:
+            IDEMPOTENCY_LOOKUPS.inc('local_hit')
+            return existing
+        owner, expires_at = self.store.claim(key, task_id, self.ttl)
+        self._remember(key, owner, expires_at)
+        with self._lock:
+            self._stats['misses' if owner == task_id else 'shared_hits'] += 1
+        IDEMPOTENCY_LOOKUPS.inc('miss' if owner == task_id else 'shared_hit')
+        return None if owner == task_id else owner
+
+    def release(self, key, task_id):
+        # Undo a claim whose publish failed, so a retry of the request can go through
+        with self._lock:
+            self._cache.pop(key, None)
+        self.store.release(key, task_id)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = sum(stats.values())
+        stats['hit_rate'] = (stats['local_hits'] + stats['shared_hits']) / lookups if lookups else 0.0
+        return stats
+
+
+idempotency_guard = IdempotencyGuard(SQLiteKeyStore())
@@ -0,0 +1,314 @@
+import os
+import re
+import csv
+import json
+import time
+import codecs
+import hashlib
+import logging
+import sqlite3
+import argparse
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Streams a CSV or JSONL recipient file of any size into send_email_batch tasks:
+#   python ingest.py recipients.csv [--column email] [--grouped]
+# Progress is checkpointed after every chunk, so running the same command again resumes the import.
+
+# Recipients per send_email_batch task
+INGEST_CHUNK_SIZE = int(os.getenv('INGEST_CHUNK_SIZE', '500'))
+# Publishing pauses while the broker queue holds more than INGEST_MAX_QUEUE_DEPTH tasks,
+# and resumes once it has drained below INGEST_RESUME_QUEUE_DEPTH
+INGEST_MAX_QUEUE_DEPTH = int(os.getenv('INGEST_MAX_QUEUE_DEPTH', '200'))
+INGEST_RESUME_QUEUE_DEPTH = int(os.getenv('INGEST_RESUME_QUEUE_DEPTH', str(INGEST_MAX_QUEUE_DEPTH // 2)))
+# Seconds between queue depth samples
+INGEST_DEPTH_INTERVAL = float(os.getenv('INGEST_DEPTH_INTERVAL', '1'))
+# Offsets and the addresses already published, per import
+INGEST_CHECKPOINT_DB = os.getenv('INGEST_CHECKPOINT_DB', 'ingest.db')
+
+EMAIL_PATTERN = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ingest_jobs (
+    job TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    column_index INTEGER,
+    offset INTEGER NOT NULL,
+    rows INTEGER NOT NULL,
+    published INTEGER NOT NULL,
+    duplicates INTEGER NOT NULL,
+    invalid INTEGER NOT NULL,
+    tasks INTEGER NOT NULL,
+    updated_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS ingest_seen (
+    job TEXT NOT NULL,
+    address TEXT NOT NULL,
+    PRIMARY KEY (job, address)
+) WITHOUT ROWID;
+"""
+
+
+def normalize(email):
+    # Domains are case-insensitive; local parts are kept as given but compared case-insensitively
+    if not isinstance(email, str):
+        return None
+    local, _, domain = email.strip().rpartition('@')
+    email = f'{local}@{domain.lower()}'
+    return email if EMAIL_PATTERN.match(email) else None
+
+
+def read_lines(f, offset):
+    # Yields (line, end offset) from a binary file, so a checkpoint can seek straight back
+    f.seek(offset)
+    decoder = codecs.getincrementaldecoder('utf-8-sig' if offset == 0 else 'utf-8')('replace')
+    while True:
+        line = f.readline()
+        if not line:
+            return
+        offset += len(line)
+        yield decoder.decode(line), offset
+
+
+def read_csv(f, offset, column_index):
+    position = [offset]
+
+    def lines():
+        for line, end in read_lines(f, offset):
+            position[0] = end
+            yield line
+
+    # csv.reader pulls more lines for quoted fields spanning several lines; position is the end of the record
+    for row in csv.reader(lines()):
+        if row:
+            yield (row[column_index] if column_index < len(row) else None), position[0]
+
+
+def read_jsonl(f, offset):
+    for line, end in read_lines(f, offset):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            yield None, end
+            continue
+        yield (item.get('email') if isinstance(item, dict) else item), end
+
+
+def csv_header(f, column):
+    # Returns (column index, offset of the first data row); files without a header row use the first column
+    lines = read_lines(f, 0)
+    first = next(lines, None)
+    if first is None:
+        return 0, 0
+    row = next(csv.reader([first[0]]), [])
+    names = [name.strip().lower() for name in row]
+    if column.lower() in names:
+        return names.index(column.lower()), first[1]
+    if any('@' in value for value in row):
+        return 0, 0
+    raise SystemExit(f'CSV header has no {column!r} column: {row}')
+
+
+class Checkpoint:
+    def __init__(self, path=INGEST_CHECKPOINT_DB):
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+
+    def load(self, job):
+        row = self.db.execute(
+            'SELECT column_index, offset, rows, published, duplicates, invalid, tasks, finished_at '
+            'FROM ingest_jobs WHERE job = ?', (job,)).fetchone()
+        if row is None:
+            return None
+        keys = ('column_index', 'offset', 'rows', 'published', 'duplicates', 'invalid', 'tasks', 'finished_at')
+        return dict(zip(keys, row))
+
+    def start(self, job, path, column_index, offset):
+        with self.db:
+            self.db.execute('DELETE FROM ingest_seen WHERE job = ?', (job,))
+            self.db.execute(
+                'INSERT OR REPLACE INTO ingest_jobs (job, path, column_index, offset, rows, published, duplicates, '
+                'invalid, tasks, updated_at) VALUES (?, ?, ?, ?, 0, 0, 0, 0, 0, ?)',
+                (job, path, column_index, offset, time.time()))
+
+    def unseen(self, job, addresses):
+        # Addresses not yet published by this job, in order
+        keys = {address.lower(): address for address in addresses}
+        seen = set()
+        items = list(keys)
+        for i in range(0, len(items), 500):
+            part = items[i:i + 500]
+            seen.update(row[0] for row in self.db.execute(
+                f'SELECT address FROM ingest_seen WHERE job = ? AND address IN ({",".join("?" * len(part))})',
+                [job] + part))
+        return [address for key, address in keys.items() if key not in seen]
+
+    def commit(self, job, addresses, progress):
+        # Records a published chunk and the file position after it in one transaction
+        with self.db:
+            self.db.executemany('INSERT OR IGNORE INTO ingest_seen (job, address) VALUES (?, ?)',
+                                [(job, address.lower()) for address in addresses])
+            self.db.execute(
+                'UPDATE ingest_jobs SET offset = ?, rows = ?, published = ?, duplicates = ?, invalid = ?, tasks = ?, '
+                'updated_at = ? WHERE job = ?',
+                (progress['offset'], progress['rows'], progress['published'], progress['duplicates'],
+                 progress['invalid'], progress['tasks'], time.time(), job))
+
+    def finish(self, job):
+        with self.db:
+            self.db.execute('UPDATE ingest_jobs SET finished_at = ? WHERE job = ?', (time.time(), job))
+
+
+class QueueThrottle:
+    # Holds publishing back while the broker queue is deeper than max_depth tasks
+    def __init__(self, app, queue, max_depth=INGEST_MAX_QUEUE_DEPTH, resume_depth=INGEST_RESUME_QUEUE_DEPTH,
+                 interval=INGEST_DEPTH_INTERVAL):
+        self.app = app
+        self.queue = queue
+        self.max_depth = max_depth
+        self.resume_depth = resume_depth
+        self.interval = interval
+        self.paused_seconds = 0.0
+        self._sampled_at = 0.0
+        self._connection = None
+
+    def depth(self):
+        if self._connection is None:
+            self._connection = self.app.connection_for_write()
+        try:
+            # Passive declare reports the message count without creating the queue
+            _, messages, _ = self._connection.default_channel.queue_declare(queue=self.queue, passive=True)
+        except self._connection.channel_errors:
+            return 0
+        return messages
+
+    def wait(self):
+        now = time.monotonic()
+        if now - self._sampled_at < self.interval:
+            return
+        self._sampled_at = now
+        depth = self.depth()
+        if depth <= self.max_depth:
+            return
+        logging.info(f'Queue {self.queue} holds {depth} tasks, pausing ingestion')
+        started = time.monotonic()
+        while depth > self.resume_depth:
+            time.sleep(self.interval)
+            depth = self.depth()
+        self.paused_seconds += time.monotonic() - started
+        self._sampled_at = time.monotonic()
+        logging.info(f'Queue {self.queue} drained to {depth} tasks, resuming ingestion')
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.release()
+
+
+def job_name(path):
+    return hashlib.sha256(os.path.abspath(path).encode()).hexdigest()[:16]
+
+
+def ingest(path, fmt=None, column='email', grouped=False, chunk_size=INGEST_CHUNK_SIZE, job=None,
+           restart=False, checkpoint=None):
+    from tasks import send_email_batch, route, EMAIL_QUEUE_BULK
+    from recipient_groups import recipient_domain
+    from suppression import suppressions
+
+    fmt = fmt or ('jsonl' if path.endswith(('.jsonl', '.ndjson', '.json')) else 'csv')
+    job = job or job_name(path)
+    checkpoint = checkpoint or Checkpoint()
+
+    with open(path, 'rb') as f:
+        state = None if restart else checkpoint.load(job)
+        if state and state['offset'] > os.fstat(f.fileno()).st_size:
+            raise SystemExit(f'{path} is shorter than the checkpoint for job {job}; rerun with --restart')
+        if state is None:
+            column_index, offset = csv_header(f, column) if fmt == 'csv' else (None, 0)
+            checkpoint.start(job, os.path.abspath(path), column_index, offset)
+            state = checkpoint.load(job)
+        elif state['finished_at']:
+            logging.info(f'Job {job} already finished; rerun with --restart to import {path} again')
+            return state
+        else:
+            logging.info(f'Resuming job {job} at byte {state["offset"]} after {state["published"]} recipients')
+
+        progress = {key: state[key] for key in ('offset', 'rows', 'published', 'duplicates', 'invalid', 'tasks')}
+        # Not checkpointed: counts the suppressed addresses met by this run only
+        progress['suppressed'] = 0
+        app = send_email_batch.app
+        throttle = QueueThrottle(app, EMAIL_QUEUE_BULK)
+        if fmt == 'csv':
+            records = read_csv(f, state['offset'], state['column_index'])
+        else:
+            records = read_jsonl(f, state['offset'])
+
+        def publish(chunk, offset, producer):
+            addresses = checkpoint.unseen(job, chunk)
+            progress['duplicates'] += len(chunk) - len(addresses)
+            allowed, suppressed = suppressions.partition(addresses)
+            progress['suppressed'] += len(suppressed)
+            if allowed:
+                if grouped:
+                    # Keep each domain's recipients together so the chunk splits into as few groups as possible
+                    allowed.sort(key=recipient_domain)
+                throttle.wait()
+                send_email_batch.apply_async(args=[allowed], kwargs={'grouped': grouped}, producer=producer,
+                                             **route('bulk'))
+                progress['published'] += len(allowed)
+                progress['tasks'] += 1
+            # A crash between the publish above and this commit re-sends at most this one chunk on resume;
+            # suppressed addresses are marked seen too, so a resume does not look them up again
+            progress['offset'] = offset
+            checkpoint.commit(job, addresses, progress)
+            if addresses and progress['tasks'] % 100 == 0:
+                logging.info(f'Job {job}: {progress["rows"]} rows read, {progress["published"]} published')
+
+        # One pooled broker connection for the whole import instead of one per task
+        try:
+            with app.producer_or_acquire() as producer:
+                chunk = []
+                offset = state['offset']
+                for email, offset in records:
+                    progress['rows'] += 1
+                    email = normalize(email)
+                    if email is None:
+                        progress['invalid'] += 1
+                        continue
+                    chunk.append(email)
+                    if len(chunk) >= chunk_size:
+                        publish(chunk, offset, producer)
+                        chunk = []
+                publish(chunk, offset, producer)
+        finally:
+            throttle.close()
+
+    checkpoint.finish(job)
+    progress['paused_seconds'] = throttle.paused_seconds
+    logging.info(f'Job {job} finished: {progress}')
+    return progress
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Queue emails for every recipient in a CSV or JSONL file')
+    parser.add_argument('path')
+    parser.add_argument('--format', choices=('csv', 'jsonl'), help='defaults to the file extension')
+    parser.add_argument('--column', default='email', help='CSV column holding the address')
+    parser.add_argument('--grouped', action='store_true', help='send one SMTP transaction per domain group')
+    parser.add_argument('--chunk-size', type=int, default=INGEST_CHUNK_SIZE)
+    parser.add_argument('--job', help='checkpoint name, defaults to one derived from the file path')
+    parser.add_argument('--restart', action='store_true', help='ignore any checkpoint and start from the top')
+    args = parser.parse_args()
+
+    progress = ingest(args.path, fmt=args.format, column=args.column, grouped=args.grouped,
+                      chunk_size=args.chunk_size, job=args.job, restart=args.restart)
+    print(json.dumps(progress))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+import os
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+LOG_PATH = os.getenv('LOG_PATH', '/var/log/messaging_system.log')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# 'queue' hands records to a background thread for formatting and I/O; 'sync' writes inline
+LOG_MODE = os.getenv('LOG_MODE', 'queue')
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+_handlers = []
+_listener = None
+_queue_handler = None
+
+
+class DeferredQueueHandler(QueueHandler):
+    # Records never leave the process, so skip QueueHandler's eager formatting and leave it to the listener
+    def prepare(self, record):
+        return record
+
+
+def _start_listener():
+    global _listener
+    # Logging was shut down before this fork and already writes inline
+    if _queue_handler not in logging.getLogger().handlers:
+        return
+    log_queue = queue.SimpleQueue()
+    _queue_handler.queue = log_queue
+    _listener = QueueListener(log_queue, *_handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def shutdown_logging():
+    # Safe to call twice (the worker shutdown signal, then atexit); records logged afterwards are written inline
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    _listener = None
+    root = logging.getLogger()
+    root.removeHandler(_queue_handler)
+    for handler in _handlers:
+        root.addHandler(handler)
+
+
+def configure_logging():
+    global _queue_handler
+    if _handlers:
+        return
+
+    formatter = logging.Formatter(LOG_FORMAT)
+    file_handler = logging.FileHandler(LOG_PATH, mode='a')  # Append mode to prevent overwriting
+    console_handler = logging.StreamHandler()
+    for handler in (file_handler, console_handler):
+        handler.setFormatter(formatter)
+        _handlers.append(handler)
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    if LOG_MODE == 'queue':
+        _queue_handler = DeferredQueueHandler(None)
+        root.addHandler(_queue_handler)
+        _start_listener()
+        atexit.register(shutdown_logging)
+        # Forked Celery workers do not inherit the listener thread, so give each child its own
+        os.register_at_fork(after_in_child=_start_listener)
+    else:
+        for handler in _handlers:
+            root.addHandler(handler)
+    logging.info(f'Logging configured: path={LOG_PATH} level={LOG_LEVEL} mode={LOG_MODE}')
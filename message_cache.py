@@ -0,0 +1,119 @@
+import os
+import time
+import base64
+import socket
+import threading
+from collections import OrderedDict
+from email import policy
+from email.utils import formatdate, make_msgid
+from dotenv import load_dotenv
+
+from attachments import attachment_parts
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Number of compiled templates kept per process
+MESSAGE_CACHE_SIZE = int(os.getenv('MESSAGE_CACHE_SIZE', '128'))
+
+CRLF = b'\r\n'
+
+
+def encode_word(value):
+    # RFC 2047 base64 encoded-words of at most 68 characters, split on UTF-8 character boundaries;
+    # several times faster than email.header.Header for the short values used here
+    data = value.encode('utf-8')
+    words = []
+    while data:
+        cut = min(len(data), 42)
+        while cut < len(data) and data[cut] & 0xC0 == 0x80:
+            cut -= 1
+        words.append(b'=?utf-8?b?' + base64.b64encode(data[:cut]) + b'?=')
+        data = data[cut:]
+    return (CRLF + b' ').join(words)
+
+
+def encode_header(name, value):
+    # A line break would end the header and let the rest of the value start another one
+    if '\r' in value or '\n' in value:
+        raise ValueError(f'{name} header must not contain line breaks')
+    if not value.isascii():
+        return name.encode('ascii') + b': ' + encode_word(value) + CRLF
+    return f'{name}: {value}'.encode('ascii') + CRLF
+
+
+_date = (None, None)
+
+
+def current_date():
+    # Date header value, formatted at most once a second
+    global _date
+    now = int(time.time())
+    second, value = _date
+    if second != now:
+        value = formatdate(now, localtime=True)
+        _date = (now, value)
+    return value
+
+
+class CompiledMessage:
+    def __init__(self, msg, domain=None):
+        # Serialize the invariant part once; per-recipient headers are spliced in front of the body
+        for name in ('To', 'Message-ID', 'Date'):
+            del msg[name]
+        raw = msg.as_bytes(policy=policy.SMTP)
+        head, _, body = raw.partition(CRLF + CRLF)
+        self.head = head + CRLF
+        self.body = CRLF + body
+        # A multipart body minus its closing delimiter, so attachment parts can be appended
+        boundary = msg.get_boundary() if msg.is_multipart() else None
+        self.boundary = boundary.encode('ascii') if boundary else None
+        end = self.body.rfind(b'--' + self.boundary + b'--') if self.boundary else -1
+        self.open_body = self.body[:end] if end >= 0 else None
+        # make_msgid() would otherwise look up the FQDN on every call
+        self.domain = domain or socket.getfqdn()
+
+    def render(self, to, message_id=None, date=None, attachments=()):
+        # Bytes, or with attachments a list of parts for smtp_pool.send_message()
+        head = b''.join((
+            self.head,
+            encode_header('To', to),
+            encode_header('Message-ID', message_id or make_msgid(domain=self.domain)),
+            encode_header('Date', date or current_date()),
+        ))
+        if not attachments:
+            return head + self.body
+        if self.open_body is None:
+            raise ValueError('Attachments need a multipart message')
+        return [head + self.open_body] + attachment_parts(self.boundary, attachments)
+
+
+class MessageCache:
+    def __init__(self, max_size=MESSAGE_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, template_id, version, builder, domain=None):
+        key = (template_id, version)
+        with self._lock:
+            compiled = self._entries.get(key)
+            if compiled is not None:
+                self._entries.move_to_end(key)
+                return compiled
+
+        # Build outside the lock; a concurrent build of the same key is harmless
+        compiled = CompiledMessage(builder(), domain)
+        with self._lock:
+            self._entries[key] = compiled
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return compiled
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+message_cache = MessageCache()
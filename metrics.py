@@ -0,0 +1,297 @@
+import os
+import json
+import fcntl
+import time
+import bisect
+import logging
+import threading
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Every process (gunicorn and Celery children) writes its snapshot here so /metrics can add them up.
+# Leave unset to export only the serving process's own metrics.
+METRICS_DIR = os.getenv('METRICS_DIR')
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '1'))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+QUEUE_WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+_lock = threading.Lock()
+_metrics = {}
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        _metrics[name] = self
+
+    def inc(self, *labels, amount=1):
+        with _lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+        maybe_flush()
+
+    def snapshot(self):
+        return {json.dumps(labels): value for labels, value in self.values.items()}
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        _metrics[name] = self
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                # One slot per bucket plus +Inf; counts are per bucket, made cumulative on export
+                entry = self.values[labels] = {'buckets': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+            entry['buckets'][index] += 1
+            entry['sum'] += value
+            entry['count'] += 1
+        maybe_flush()
+
+    def snapshot(self):
+        return {json.dumps(labels): {'buckets': list(entry['buckets']), 'sum': entry['sum'], 'count': entry['count']}
+                for labels, entry in self.values.items()}
+
+
+def snapshot():
+    with _lock:
+        return {name: metric.snapshot() for name, metric in _metrics.items()}
+
+
+_last_flush = 0.0
+_flush_lock = threading.Lock()
+_snapshot_file = None
+
+# Snapshots of exited processes are folded into this one file, so the directory stops growing
+RETIRED_FILE = 'retired.json'
+
+
+def snapshot_filename():
+    # The pid and the process start time, so a new process that reuses a pid never overwrites the
+    # totals an exited one left behind
+    global _snapshot_file
+    pid = os.getpid()
+    if _snapshot_file is None or _snapshot_file[0] != pid:
+        _snapshot_file = (pid, f'{pid}-{time.time_ns()}.json')
+    return _snapshot_file[1]
+
+
+def maybe_flush(force=False):
+    # Called from inc() and observe(), so it never raises: a metrics write must not fail the send it counts
+    global _last_flush
+    if not METRICS_DIR:
+        return
+    # One writer at a time; a routine flush finding another in progress leaves it to that one
+    if not _flush_lock.acquire(blocking=force):
+        return
+    try:
+        now = time.monotonic()
+        if not force and now - _last_flush < METRICS_FLUSH_INTERVAL:
+            return
+        _last_flush = now
+        first_flush = _snapshot_file is None or _snapshot_file[0] != os.getpid()
+        path = os.path.join(METRICS_DIR, snapshot_filename())
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        try:
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump(snapshot(), f)
+            os.replace(tmp_path, path)
+            if first_flush:
+                fold_exited()
+        except (OSError, ValueError) as e:
+            logging.warning(f'Writing metrics snapshot {path} failed: {e}')
+    finally:
+        _flush_lock.release()
+
+
+def _snapshot_pid(filename):
+    # '{pid}-{time_ns}.json', or '{pid}.json' from before the start time was added
+    try:
+        return int(filename[:-len('.json')].split('-')[0])
+    except ValueError:
+        return None
+
+
+def _exited(pid):
+    # Only meaningful when METRICS_DIR is shared by processes in one pid namespace (one host or container)
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+def _read_retired():
+    try:
+        with open(os.path.join(METRICS_DIR, RETIRED_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'metrics': {}, 'folded': []}
+
+
+def fold_exited():
+    # Adds the snapshots of exited processes to RETIRED_FILE and deletes them. The names folded by the
+    # last run are kept in RETIRED_FILE, so a crash before the deletes never counts a snapshot twice.
+    own = snapshot_filename()
+    with open(os.path.join(METRICS_DIR, '.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        retired = _read_retired()
+        for filename in retired['folded']:
+            try:
+                os.unlink(os.path.join(METRICS_DIR, filename))
+            except FileNotFoundError:
+                pass
+        folded = []
+        for filename in sorted(os.listdir(METRICS_DIR)):
+            if not filename.endswith('.json') or filename in (own, RETIRED_FILE):
+                continue
+            pid = _snapshot_pid(filename)
+            if pid is None or not _exited(pid):
+                continue
+            try:
+                with open(os.path.join(METRICS_DIR, filename)) as f:
+                    data = json.load(f)
+            except ValueError:
+                data = {}
+            for name, values in data.items():
+                _merge(retired['metrics'], name, values)
+            folded.append(filename)
+        if not folded and not retired['folded']:
+            return
+        retired['folded'] = folded
+        path = os.path.join(METRICS_DIR, RETIRED_FILE)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(retired, f)
+        os.replace(tmp_path, path)
+        for filename in folded:
+            os.unlink(os.path.join(METRICS_DIR, filename))
+
+
+def _merge(total, name, values):
+    merged = total.setdefault(name, {})
+    for labels, value in values.items():
+        if isinstance(value, dict):
+            entry = merged.setdefault(labels, {'buckets': [0] * len(value['buckets']), 'sum': 0.0, 'count': 0})
+            entry['buckets'] = [a + b for a, b in zip(entry['buckets'], value['buckets'])]
+            entry['sum'] += value['sum']
+            entry['count'] += value['count']
+        else:
+            merged[labels] = merged.get(labels, 0) + value
+
+
+def _collect_files():
+    # RETIRED_FILE is read first: a snapshot folded after that read is either still on disk or
+    # already in RETIRED_FILE, which is then read again
+    own = snapshot_filename()
+    path = os.path.join(METRICS_DIR, RETIRED_FILE)
+    for _ in range(3):
+        try:
+            before = os.stat(path).st_ino
+        except FileNotFoundError:
+            before = None
+        try:
+            retired = _read_retired()
+        except (OSError, ValueError):
+            retired = {'metrics': {}, 'folded': []}
+        totals = [retired['metrics']]
+        for filename in os.listdir(METRICS_DIR):
+            if not filename.endswith('.json') or filename in (own, RETIRED_FILE) or filename in retired['folded']:
+                continue
+            try:
+                with open(os.path.join(METRICS_DIR, filename)) as f:
+                    totals.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        try:
+            after = os.stat(path).st_ino
+        except FileNotFoundError:
+            after = None
+        if before == after:
+            break
+    return totals
+
+
+def collect():
+    # This process's live values plus the last snapshot of every other process.
+    # Snapshots of exited processes are folded into RETIRED_FILE, as counters must never go backwards.
+    total = {}
+    for name, values in snapshot().items():
+        _merge(total, name, values)
+    if METRICS_DIR and os.path.isdir(METRICS_DIR):
+        for data in _collect_files():
+            for name, values in data.items():
+                if name in _metrics:
+                    _merge(total, name, values)
+    return total
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def render():
+    # Prometheus text exposition format
+    lines = []
+    for name, values in sorted(collect().items()):
+        metric = _metrics[name]
+        family = f'{name}_total' if metric.kind == 'counter' else name
+        lines.append(f'# HELP {family} {metric.documentation}')
+        lines.append(f'# TYPE {family} {metric.kind}')
+        for labels, value in sorted(values.items()):
+            labels = json.loads(labels)
+            if metric.kind == 'counter':
+                lines.append(f'{family}{_format_labels(metric.labelnames, labels)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets + ('+Inf',), value['buckets']):
+                cumulative += count
+                lines.append(f'{name}_bucket{_format_labels(metric.labelnames, labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(metric.labelnames, labels)} {value["sum"]}')
+            lines.append(f'{name}_count{_format_labels(metric.labelnames, labels)} {value["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+# Metrics shared by the web app and the workers
+EMAILS_SENT = Counter('email_sent', 'Messages accepted by the SMTP server', ['task'])
+EMAIL_FAILURES = Counter('email_failures', 'Failed delivery attempts by failure class', ['kind'])
+EMAIL_RETRIES = Counter('email_retries', 'Delivery retries scheduled by failure class', ['kind'])
+SMTP_PHASE_SECONDS = Histogram('smtp_phase_seconds', 'Time spent in each SMTP phase', ['phase'])
+QUEUE_WAIT_SECONDS = Histogram('email_queue_wait_seconds', 'Time from publish to task start', ['task'],
+                               buckets=QUEUE_WAIT_BUCKETS)
+IDEMPOTENCY_LOOKUPS = Counter('idempotency_lookups', 'Enqueue idempotency checks by outcome', ['result'])
+RELAY_EJECTIONS = Counter('smtp_relay_ejections', 'Times a relay was taken out of rotation', ['relay'])
+RELAY_FAILOVERS = Counter('smtp_relay_failovers', 'Sends moved to another relay after a relay failure', ['relay'])
+SCHEDULED_RELEASED = Counter('scheduled_sends_released', 'Scheduled sends published to the broker', ['task'])
+SCHEDULED_LAG_SECONDS = Histogram('scheduled_send_lag_seconds', 'Time from send_at to publish', ['task'],
+                                  buckets=QUEUE_WAIT_BUCKETS)
+TASKS_PUBLISHED = Counter('tasks_published', 'Tasks published to the broker', ['task', 'queue'])
+ADMISSION_REJECTED = Counter('admission_rejected', 'Sends turned away with 429 by admission control', ['route'])
+SUPPRESSED_RECIPIENTS = Counter('suppressed_recipients', 'Recipients dropped at enqueue as suppressed', ['route'])
+BOUNCE_MESSAGES = Counter('bounce_messages', 'Mailbox messages read by the bounce processor by result', ['result'])
+DELIVERY_EVENTS = Counter('delivery_events', 'Recipient outcomes recorded from DSNs by action', ['action'])
@@ -0,0 +1,258 @@
+import os
+import json
+import mmap
+import time
+import zlib
+import fcntl
+import struct
+import logging
+import threading
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# In outbox mode / appends each send to a local spool and returns; a flusher thread publishes it later
+OUTBOX_MODE = os.getenv('OUTBOX_MODE', 'false').lower() == 'true'
+OUTBOX_DIR = os.getenv('OUTBOX_DIR', 'outbox')
+OUTBOX_SEGMENT_BYTES = int(os.getenv('OUTBOX_SEGMENT_BYTES', str(64 * 1024 * 1024)))
+# Tasks published per flusher batch, and seconds between spool checks when idle
+OUTBOX_FLUSH_BATCH = int(os.getenv('OUTBOX_FLUSH_BATCH', '500'))
+OUTBOX_FLUSH_INTERVAL = float(os.getenv('OUTBOX_FLUSH_INTERVAL', '0.05'))
+# Upper bound on the wait before retrying a batch the broker did not take
+OUTBOX_RETRY_MAX_DELAY = float(os.getenv('OUTBOX_RETRY_MAX_DELAY', '30'))
+
+# Each record is length, crc32, then the JSON payload
+HEADER = struct.Struct('>II')
+
+
+def segment_name(seq):
+    return f'{seq:012d}.seg'
+
+
+def read_records(buffer, offset, limit):
+    # Yields (payload, end offset) for every intact record in buffer[offset:limit]
+    while offset + HEADER.size <= limit:
+        length, crc = HEADER.unpack_from(buffer, offset)
+        end = offset + HEADER.size + length
+        if end > limit:
+            return
+        payload = buffer[offset + HEADER.size:end]
+        if zlib.crc32(payload) != crc:
+            return
+        yield payload, end
+        offset = end
+
+
+class Outbox:
+    # Append-only spool of task messages in numbered segment files, one directory per process.
+    # Appends are fsynced in groups: while one thread syncs, the others' records pile up behind it
+    # and are covered by the next fsync. The cursor file records how far the broker has taken the
+    # spool; a crash before it is written republishes that batch, so delivery is at least once.
+    def __init__(self, app, directory=OUTBOX_DIR, segment_bytes=OUTBOX_SEGMENT_BYTES,
+                 flush_batch=OUTBOX_FLUSH_BATCH, flush_interval=OUTBOX_FLUSH_INTERVAL):
+        self.app = app
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.flush_batch = flush_batch
+        self.flush_interval = flush_interval
+        self._start_lock = threading.Lock()
+        self._pid = None
+
+    def _start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._write_lock = threading.Lock()
+            self._sync_lock = threading.Lock()
+            self._wakeup = threading.Event()
+            self._claim_slot()
+            self._recover()
+            self._pid = os.getpid()
+            threading.Thread(target=self._flush_forever, name='outbox-flusher', daemon=True).start()
+
+    def _claim_slot(self):
+        # gunicorn workers each take the first free slot; a restarted worker picks up the spool its predecessor left
+        slot = 0
+        while True:
+            path = os.path.join(self.directory, str(slot))
+            os.makedirs(path, exist_ok=True)
+            lock = open(os.path.join(path, 'lock'), 'a')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock.close()
+                slot += 1
+                continue
+            self._slot_lock = lock
+            self.path = path
+            return
+
+    def _read_cursor(self):
+        try:
+            with open(os.path.join(self.path, 'cursor')) as f:
+                seq, offset = f.read().split()
+            return int(seq), int(offset)
+        except (OSError, ValueError):
+            return 0, 0
+
+    def _write_cursor(self, position):
+        path = os.path.join(self.path, 'cursor')
+        with open(f'{path}.tmp', 'w') as f:
+            f.write(f'{position[0]} {position[1]}')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f'{path}.tmp', path)
+
+    def _segment_path(self, seq):
+        return os.path.join(self.path, segment_name(seq))
+
+    def _recover(self):
+        self._segments = sorted(int(name[:-4]) for name in os.listdir(self.path) if name.endswith('.seg'))
+        self._cursor = self._read_cursor()
+        if self._segments:
+            # Drop a torn record left by a crash mid-append
+            last = self._segment_path(self._segments[-1])
+            with open(last, 'rb') as f:
+                data = f.read()
+            end = 0
+            for _, end in read_records(data, 0, len(data)):
+                pass
+            if end < len(data):
+                logging.warning(f'Truncating {len(data) - end} bytes of a partial record from {last}')
+                os.truncate(last, end)
+        self._compact()
+        self._read_position = self._cursor
+        # Always append to a fresh segment; the recovered ones are only read from now on
+        self._open_segment(self._segments[-1] + 1 if self._segments else max(self._cursor[0], 1))
+        self._synced = self._written
+
+    def _open_segment(self, seq):
+        self._file = open(self._segment_path(seq), 'ab')
+        self._seq = seq
+        self._written = (seq, 0)
+        self._segments.append(seq)
+        # Make the new file's directory entry durable too
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def append(self, task_name, args=None, kwargs=None, task_id=None, options=None):
+        # Returns once the record is on disk, with an AsyncResult for the task it will become
+        self._start()
+        payload = json.dumps({'task': task_name, 'args': args or [], 'kwargs': kwargs or {},
+                              'task_id': task_id, 'options': options or {}}).encode()
+        record = HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._write_lock:
+            if self._written[1] and self._written[1] + len(record) > self.segment_bytes:
+                # Readers trust everything before the active segment, so it must be on disk before moving on
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._open_segment(self._seq + 1)
+            self._file.write(record)
+            self._file.flush()
+            self._written = (self._seq, self._written[1] + len(record))
+            position = self._written
+        self._sync(position)
+        self._wakeup.set()
+        return self.app.AsyncResult(task_id)
+
+    def _sync(self, position):
+        with self._sync_lock:
+            if self._synced >= position:
+                return
+            with self._write_lock:
+                target = self._written
+                # A duplicate stays valid if the segment is rotated and closed during the fsync
+                fd = os.dup(self._file.fileno())
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self._synced = target
+
+    def _read_batch(self):
+        # Reads synced records from the read position onwards through mmap
+        batch = []
+        seq, offset = self._read_position
+        while len(batch) < self.flush_batch:
+            with self._write_lock:
+                synced = self._synced
+                later = [s for s in self._segments if s > seq]
+            if seq > synced[0]:
+                break
+            path = self._segment_path(seq)
+            limit = synced[1] if seq == synced[0] else (os.path.getsize(path) if os.path.exists(path) else 0)
+            if limit > offset:
+                with open(path, 'rb') as f, mmap.mmap(f.fileno(), limit, access=mmap.ACCESS_READ) as data:
+                    for payload, end in read_records(data, offset, limit):
+                        batch.append((json.loads(payload), (seq, end)))
+                        offset = end
+                        if len(batch) >= self.flush_batch:
+                            break
+            if len(batch) >= self.flush_batch or seq == synced[0]:
+                break
+            if offset < limit:
+                logging.error(f'Skipping corrupt data after byte {offset} of outbox segment {path}')
+            if not later:
+                break
+            seq, offset = later[0], 0
+        self._read_position = (seq, offset)
+        return batch
+
+    def _publish(self, batch):
+        with self.app.producer_or_acquire() as producer:
+            for message, _ in batch:
+                self.app.send_task(message['task'], args=message['args'], kwargs=message['kwargs'],
+                                   task_id=message['task_id'], producer=producer, **message.get('options', {}))
+
+    def _compact(self):
+        # Delete segments the broker has fully taken
+        for seq in [s for s in self._segments if s < self._cursor[0] and s != getattr(self, '_seq', None)]:
+            try:
+                os.remove(self._segment_path(seq))
+            except FileNotFoundError:
+                pass
+            self._segments.remove(seq)
+
+    def _flush_forever(self):
+        failures = 0
+        while True:
+            start = self._read_position
+            self._wakeup.clear()
+            try:
+                batch = self._read_batch()
+                if not batch:
+                    self._wakeup.wait(self.flush_interval)
+                    continue
+                self._publish(batch)
+            except Exception as e:
+                # Broker unavailable or spool unreadable: keep the records and try the same batch again
+                failures += 1
+                # The exponent is capped: 2 ** 1024 as a float overflows, and this thread must not die
+                delay = min(OUTBOX_RETRY_MAX_DELAY, 0.1 * 2 ** min(failures, 16))
+                logging.error(f'Outbox flush failed, retrying in {delay:.1f}s: {e}')
+                self._read_position = start
+                time.sleep(delay)
+                continue
+            failures = 0
+            self._cursor = batch[-1][1]
+            self._write_cursor(self._cursor)
+            with self._write_lock:
+                self._compact()
+
+    def pending(self):
+        # Bytes appended but not yet taken by the broker, for monitoring
+        self._start()
+        with self._write_lock:
+            segments = list(self._segments)
+        total = 0
+        for seq in segments:
+            if seq >= self._cursor[0]:
+                try:
+                    total += os.path.getsize(self._segment_path(seq))
+                except FileNotFoundError:
+                    pass
+        return total - (self._cursor[1] if self._cursor[0] in segments else 0)
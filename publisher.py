@@ -0,0 +1,147 @@
+import os
+import time
+import queue
+import socket
+import logging
+import threading
+from concurrent.futures import Future
+from kombu import Producer
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Collect enqueue calls from request threads and publish them together on one broker channel
+ENQUEUE_BATCHING = os.getenv('ENQUEUE_BATCHING', 'false').lower() == 'true'
+# Longest a call waits for others to join its batch, in seconds
+ENQUEUE_BATCH_DELAY = float(os.getenv('ENQUEUE_BATCH_DELAY', '0.002'))
+ENQUEUE_BATCH_SIZE = int(os.getenv('ENQUEUE_BATCH_SIZE', '100'))
+# Longest a batch waits for the broker's publisher confirms, in seconds
+ENQUEUE_CONFIRM_TIMEOUT = float(os.getenv('ENQUEUE_CONFIRM_TIMEOUT', '10'))
+
+
+class PublishRequest:
+    def __init__(self, task, args, kwargs, options):
+        self.task = task
+        self.args = args
+        self.kwargs = kwargs
+        self.options = options
+        self.future = Future()
+
+
+class BatchPublisher:
+    # Request threads call publish(); one background thread per process drains the queue in batches.
+    # On AMQP the channel is put in confirm mode and a batch waits once for all its acks, instead of
+    # one round-trip per message; other transports are done as soon as the publish call returns.
+    def __init__(self, app, max_batch=ENQUEUE_BATCH_SIZE, max_delay=ENQUEUE_BATCH_DELAY,
+                 confirm_timeout=ENQUEUE_CONFIRM_TIMEOUT):
+        self.app = app
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.confirm_timeout = confirm_timeout
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._connection = None
+        self._producer = None
+        self._confirms = False
+        self._next_tag = 1
+        self._unconfirmed = {}
+
+    def _start(self):
+        # The thread, queue and broker connection belong to the process that started them
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._connection = None
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name='batch-publisher', daemon=True).start()
+        return self._queue
+
+    def submit(self, task, args=None, kwargs=None, **options):
+        request = PublishRequest(task, args, kwargs, options)
+        self._start().put(request)
+        return request.future
+
+    def publish(self, task, args=None, kwargs=None, **options):
+        # Blocks until the broker has the message; returns the AsyncResult like apply_async
+        return self.submit(task, args, kwargs, **options).result()
+
+    def _run(self):
+        requests = self._queue
+        while True:
+            batch = [requests.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(requests.get(timeout=remaining) if remaining > 0 else requests.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._publish_batch(batch)
+            except Exception as e:
+                logging.error(f'Failed to publish {len(batch)} tasks: {e}')
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                self._reset()
+
+    def _ensure_producer(self):
+        if self._connection is None:
+            self._connection = self.app.connection_for_write()
+            channel = self._connection.default_channel
+            self._producer = Producer(channel)
+            self._confirms = hasattr(channel, 'confirm_select')
+            if self._confirms:
+                channel.confirm_select()
+                channel.events['basic_ack'].add(self._on_ack)
+                channel.events['basic_nack'].add(self._on_nack)
+                self._next_tag = 1
+                self._unconfirmed = {}
+        return self._producer
+
+    def _reset(self):
+        connection, self._connection = self._connection, None
+        if connection is not None:
+            try:
+                connection.release()
+            except Exception:
+                pass
+
+    def _settle(self, delivery_tag, multiple, error=None):
+        tags = [tag for tag in self._unconfirmed if tag <= delivery_tag] if multiple else [delivery_tag]
+        for tag in tags:
+            request, result = self._unconfirmed.pop(tag, (None, None))
+            if request is None:
+                continue
+            if error is None:
+                request.future.set_result(result)
+            else:
+                request.future.set_exception(error)
+
+    def _on_ack(self, delivery_tag, multiple):
+        self._settle(delivery_tag, multiple)
+
+    def _on_nack(self, delivery_tag, multiple):
+        self._settle(delivery_tag, multiple, RuntimeError('Broker rejected the task message'))
+
+    def _publish_batch(self, batch):
+        producer = self._ensure_producer()
+        for request in batch:
+            result = request.task.apply_async(request.args, request.kwargs, producer=producer, **request.options)
+            if self._confirms:
+                self._unconfirmed[self._next_tag] = (request, result)
+                self._next_tag += 1
+            else:
+                request.future.set_result(result)
+
+        if self._unconfirmed:
+            try:
+                while self._unconfirmed:
+                    self._connection.drain_events(timeout=self.confirm_timeout)
+            except socket.timeout:
+                raise TimeoutError(f'No publisher confirm for {len(self._unconfirmed)} tasks '
+                                   f'within {self.confirm_timeout}s')
+            finally:
+                self._unconfirmed.clear()
@@ -0,0 +1,185 @@
+import os
+import re
+import json
+import time
+import fcntl
+import logging
+import smtplib
+import threading
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Token bucket settings per SMTP server, in messages per second
+SMTP_RATE_LIMIT = float(os.getenv('SMTP_RATE_LIMIT', '10'))
+SMTP_RATE_BURST = float(os.getenv('SMTP_RATE_BURST', '10'))
+SMTP_RATE_MIN = float(os.getenv('SMTP_RATE_MIN', '1'))
+SMTP_RATE_MAX = float(os.getenv('SMTP_RATE_MAX', '200'))
+# AIMD: each success adds SMTP_RATE_INCREASE / rate, a throttle reply multiplies by SMTP_RATE_DECREASE
+SMTP_RATE_INCREASE = float(os.getenv('SMTP_RATE_INCREASE', '1'))
+SMTP_RATE_DECREASE = float(os.getenv('SMTP_RATE_DECREASE', '0.5'))
+# 'file' shares buckets between worker processes on this host, 'local' keeps them per process
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'file')
+RATE_LIMIT_DIR = os.getenv('RATE_LIMIT_DIR', '/tmp/email-rate-limit')
+
+# Replies relays use to tell us to slow down
+THROTTLE_CODES = (421, 451)
+# A burst of throttle replies only counts as one decrease per interval
+DECREASE_INTERVAL = 1.0
+
+
+def is_throttled(exc):
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return any(code in THROTTLE_CODES for code, _ in exc.recipients.values())
+    return getattr(exc, 'smtp_code', None) in THROTTLE_CODES
+
+
+# Backends only need one operation: apply func to the stored state atomically and persist the result
+
+class LocalBackend:
+    def __init__(self):
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def update(self, key, func):
+        with self._lock:
+            state, result = func(self._states.get(key))
+            self._states[key] = state
+            return result
+
+
+class FileLockBackend:
+    def __init__(self, directory=RATE_LIMIT_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def update(self, key, func):
+        path = os.path.join(self.directory, re.sub(r'[^\w.-]', '_', key) + '.json')
+        with open(path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                data = f.read()
+                state, result = func(json.loads(data) if data else None)
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return result
+
+
+class AdaptiveRateLimiter:
+    def __init__(self, key, backend, rate=SMTP_RATE_LIMIT, burst=SMTP_RATE_BURST,
+                 min_rate=SMTP_RATE_MIN, max_rate=SMTP_RATE_MAX,
+                 increase=SMTP_RATE_INCREASE, decrease=SMTP_RATE_DECREASE):
+        self.key = key
+        self.backend = backend
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+
+    def _load(self, state):
+        if state is None:
+            state = {'rate': self.rate, 'tokens': self.burst, 'updated': time.time(), 'decreased_at': 0}
+        return state
+
+    def reserve(self):
+        # Takes a token and returns how long the caller must wait before using it
+        def take(state):
+            state = self._load(state)
+            now = time.time()
+            elapsed = max(0.0, now - state['updated'])
+            tokens = min(self.burst, state['tokens'] + elapsed * state['rate']) - 1
+            state['tokens'] = tokens
+            state['updated'] = now
+            return state, max(0.0, -tokens / state['rate'])
+
+        return self.backend.update(self.key, take)
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+    def on_success(self):
+        def increase(state):
+            state = self._load(state)
+            state['rate'] = min(self.max_rate, state['rate'] + self.increase / state['rate'])
+            return state, state['rate']
+
+        return self.backend.update(self.key, increase)
+
+    def on_throttle(self):
+        def decrease(state):
+            state = self._load(state)
+            now = time.time()
+            if now - state['decreased_at'] >= DECREASE_INTERVAL:
+                state['rate'] = max(self.min_rate, state['rate'] * self.decrease)
+                state['decreased_at'] = now
+                logging.warning(f'SMTP server {self.key} is throttling, rate lowered to {state["rate"]:.2f}/s')
+            return state, state['rate']
+
+        return self.backend.update(self.key, decrease)
+
+    def record(self, exc=None):
+        if exc is None:
+            self.on_success()
+        elif is_throttled(exc):
+            self.on_throttle()
+
+    def current_rate(self):
+        return self.backend.update(self.key, lambda state: (self._load(state), self._load(state)['rate']))
+
+
+class AdaptiveConcurrency:
+    # In-process AIMD limit on concurrent sessions, used by the asyncio delivery engine
+    def __init__(self, initial, minimum=1, maximum=None, decrease=SMTP_RATE_DECREASE):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum or initial
+        self.decrease = decrease
+        self._decreased_at = 0.0
+
+    def on_success(self):
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def on_throttle(self):
+        now = time.monotonic()
+        if now - self._decreased_at >= DECREASE_INTERVAL:
+            self.limit = max(self.minimum, self.limit * self.decrease)
+            self._decreased_at = now
+
+    def record(self, exc=None):
+        if exc is None:
+            self.on_success()
+        elif is_throttled(exc):
+            self.on_throttle()
+
+    def allowed(self):
+        return int(self.limit)
+
+
+BACKENDS = {
+    'local': LocalBackend,
+    'file': FileLockBackend,
+}
+
+_backend = None
+_limiters = {}
+
+
+def get_limiter(host, port):
+    global _backend
+    key = f'{host}:{port}'
+    limiter = _limiters.get(key)
+    if limiter is None:
+        if _backend is None:
+            _backend = BACKENDS[RATE_LIMIT_BACKEND]()
+        limiter = _limiters[key] = AdaptiveRateLimiter(key, _backend)
+    return limiter
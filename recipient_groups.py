@@ -0,0 +1,24 @@
+import os
+from itertools import groupby
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Most RCPT TO commands sent in one SMTP transaction
+MAX_RCPT_PER_TRANSACTION = int(os.getenv('MAX_RCPT_PER_TRANSACTION', '50'))
+
+
+def recipient_domain(email):
+    # Grouping key; swap in an MX lookup here to group by receiving host instead
+    return email.rpartition('@')[2].lower()
+
+
+def group_recipients(emails, max_rcpt=MAX_RCPT_PER_TRANSACTION, key=recipient_domain):
+    # Splits recipients into same-domain groups of at most max_rcpt addresses
+    groups = []
+    for _, members in groupby(sorted(emails, key=key), key=key):
+        members = list(members)
+        for i in range(0, len(members), max_rcpt):
+            groups.append(members[i:i + max_rcpt])
+    return groups
@@ -0,0 +1,215 @@
+import os
+import json
+import time
+import random
+import logging
+import smtplib
+import threading
+from collections import deque
+from dotenv import load_dotenv
+
+from smtp_pool import TRANSACTION_ERRORS
+from rate_limit import is_throttled
+from metrics import RELAY_EJECTIONS, RELAY_FAILOVERS
+
+# Load environment variables from .env file
+load_dotenv()
+
+# JSON list of relays: [{"host": "...", "port": 587, "username": "...", "password": "...", "weight": 2}, ...]
+# Unset means the single SMTP_SERVER / SMTP_PORT relay with the EMAIL / PASSWORD login
+SMTP_RELAYS = os.getenv('SMTP_RELAYS')
+# Health is judged on the outcomes of the last RELAY_HEALTH_WINDOW seconds
+RELAY_HEALTH_WINDOW = float(os.getenv('RELAY_HEALTH_WINDOW', '60'))
+# A relay is ejected when at least RELAY_MIN_SAMPLES outcomes show an error rate above RELAY_MAX_ERROR_RATE,
+# or after RELAY_MAX_CONSECUTIVE_FAILURES failures in a row
+RELAY_MIN_SAMPLES = int(os.getenv('RELAY_MIN_SAMPLES', '20'))
+RELAY_MAX_ERROR_RATE = float(os.getenv('RELAY_MAX_ERROR_RATE', '0.5'))
+RELAY_MAX_CONSECUTIVE_FAILURES = int(os.getenv('RELAY_MAX_CONSECUTIVE_FAILURES', '5'))
+# Ejection lasts RELAY_EJECT_SECONDS, doubling for each ejection in a row up to RELAY_EJECT_MAX_SECONDS
+RELAY_EJECT_SECONDS = float(os.getenv('RELAY_EJECT_SECONDS', '30'))
+RELAY_EJECT_MAX_SECONDS = float(os.getenv('RELAY_EJECT_MAX_SECONDS', '600'))
+# Relays tried for one message before the task falls back to a Celery retry
+RELAY_FAILOVER_ATTEMPTS = int(os.getenv('RELAY_FAILOVER_ATTEMPTS', '3'))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class NoRelayAvailable(smtplib.SMTPException):
+    pass
+
+
+def is_relay_failure(exc):
+    # Failures of the relay itself, worth another relay; refusals of this message or recipient are not
+    if is_throttled(exc) and not isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return True
+    return not isinstance(exc, TRANSACTION_ERRORS + (ValueError,))
+
+
+class Relay:
+    def __init__(self, host, port, username=None, password=None, weight=1):
+        self.host = host
+        self.port = int(port)
+        self.username = username
+        self.password = password
+        self.weight = float(weight)
+        self.name = f'{host}:{self.port}'
+        self.state = CLOSED
+        self.opened_until = 0.0
+        self.ejections = 0
+        self.consecutive_failures = 0
+        self.trial_running = False
+        # (time, ok, seconds) per outcome, oldest first
+        self.samples = deque()
+
+    def _trim(self, now):
+        while self.samples and self.samples[0][0] < now - RELAY_HEALTH_WINDOW:
+            self.samples.popleft()
+
+    def health(self, now=None):
+        now = now or time.monotonic()
+        self._trim(now)
+        total = len(self.samples)
+        errors = sum(1 for _, ok, _ in self.samples if not ok)
+        latencies = [seconds for _, ok, seconds in self.samples if ok]
+        return {
+            'relay': self.name,
+            'state': self.state,
+            'weight': self.weight,
+            'samples': total,
+            'error_rate': errors / total if total else 0.0,
+            'mean_latency': sum(latencies) / len(latencies) if latencies else None,
+        }
+
+
+class RelayPool:
+    # Weighted random choice over the relays whose circuit is closed. An ejected relay gets a single
+    # trial message once its ejection ends (half-open); success closes it, failure ejects it for longer.
+    # Health is tracked per worker process.
+    def __init__(self, relays):
+        if not relays:
+            raise ValueError('At least one SMTP relay is required')
+        self.relays = relays
+        self._lock = threading.Lock()
+
+    def choose(self, exclude=()):
+        now = time.monotonic()
+        with self._lock:
+            candidates = []
+            for relay in self.relays:
+                if relay in exclude:
+                    continue
+                if relay.state == OPEN and now >= relay.opened_until:
+                    relay.state = HALF_OPEN
+                    relay.trial_running = False
+                if relay.state == HALF_OPEN and not relay.trial_running:
+                    # The trial goes first, so a recovered relay is noticed quickly
+                    relay.trial_running = True
+                    return relay
+                if relay.state == CLOSED:
+                    candidates.append(relay)
+            if not candidates:
+                return None
+            return random.choices(candidates, weights=[relay.weight for relay in candidates])[0]
+
+    def record(self, relay, error=None, seconds=0.0):
+        now = time.monotonic()
+        failed = error is not None and is_relay_failure(error)
+        with self._lock:
+            relay.samples.append((now, not failed, seconds))
+            relay._trim(now)
+            if relay.state == HALF_OPEN:
+                relay.trial_running = False
+                if failed:
+                    self._eject(relay, now, 'trial message failed')
+                else:
+                    logging.info(f'SMTP relay {relay.name} recovered')
+                    relay.state = CLOSED
+                    relay.ejections = 0
+                    relay.consecutive_failures = 0
+                    relay.samples.clear()
+                return
+            if not failed:
+                relay.consecutive_failures = 0
+                return
+            relay.consecutive_failures += 1
+            if relay.state != CLOSED:
+                return
+            errors = sum(1 for _, ok, _ in relay.samples if not ok)
+            if relay.consecutive_failures >= RELAY_MAX_CONSECUTIVE_FAILURES:
+                self._eject(relay, now, f'{relay.consecutive_failures} failures in a row')
+            elif len(relay.samples) >= RELAY_MIN_SAMPLES and errors / len(relay.samples) > RELAY_MAX_ERROR_RATE:
+                self._eject(relay, now, f'error rate {errors}/{len(relay.samples)}')
+
+    def _eject(self, relay, now, reason):
+        # The exponent is capped so a long-flapping relay cannot overflow the float
+        duration = min(RELAY_EJECT_MAX_SECONDS, RELAY_EJECT_SECONDS * 2 ** min(relay.ejections, 16))
+        relay.state = OPEN
+        relay.opened_until = now + duration
+        relay.ejections += 1
+        RELAY_EJECTIONS.inc(relay.name)
+        logging.warning(f'Ejecting SMTP relay {relay.name} for {duration:.0f}s: {reason}')
+
+    def send(self, deliver, attempts=RELAY_FAILOVER_ATTEMPTS):
+        # Calls deliver(relay) on up to `attempts` relays until one does not fail as a relay
+        tried = []
+        error = None
+        while len(tried) < attempts:
+            relay = self.choose(exclude=tried)
+            if relay is None:
+                break
+            if tried:
+                RELAY_FAILOVERS.inc(tried[-1].name)
+                logging.warning(f'Failing over from {tried[-1].name} to {relay.name}: {error}')
+            started = time.monotonic()
+            try:
+                result = deliver(relay)
+            except Exception as e:
+                self.record(relay, e, time.monotonic() - started)
+                if not is_relay_failure(e):
+                    raise
+                tried.append(relay)
+                error = e
+                continue
+            self.record(relay, None, time.monotonic() - started)
+            return result
+        raise error or NoRelayAvailable('Every SMTP relay is ejected')
+
+    def send_batch(self, deliver, emails, attempts=RELAY_FAILOVER_ATTEMPTS):
+        # deliver(relay, emails) returns {email: None or error}; recipients that hit relay
+        # failures are handed to the next relay, the rest keep their first result
+        results = {}
+        pending = list(emails)
+        tried = []
+        while pending and len(tried) < attempts:
+            relay = self.choose(exclude=tried)
+            if relay is None:
+                break
+            if tried:
+                RELAY_FAILOVERS.inc(tried[-1].name)
+                logging.warning(f'Failing over {len(pending)} recipients from {tried[-1].name} to {relay.name}')
+            started = time.monotonic()
+            outcome = deliver(relay, pending)
+            seconds = (time.monotonic() - started) / max(len(outcome), 1)
+            for email, error in outcome.items():
+                self.record(relay, error, seconds)
+            results.update(outcome)
+            tried.append(relay)
+            pending = [email for email, error in outcome.items() if error is not None and is_relay_failure(error)]
+        if not tried:
+            error = NoRelayAvailable('Every SMTP relay is ejected')
+            results.update((email, error) for email in pending)
+        return results
+
+    def health(self):
+        now = time.monotonic()
+        with self._lock:
+            return [relay.health(now) for relay in self.relays]
+
+
+def load_relays(default_host=None, default_port=None, default_username=None, default_password=None):
+    if SMTP_RELAYS:
+        return [Relay(entry['host'], entry.get('port', 25), entry.get('username'), entry.get('password'),
+                      entry.get('weight', 1)) for entry in json.loads(SMTP_RELAYS)]
+    return [Relay(default_host, default_port, default_username, default_password)]
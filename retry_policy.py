@@ -0,0 +1,49 @@
+import os
+import random
+import smtplib
+from dotenv import load_dotenv
+
+from rate_limit import is_throttled
+from blob_store import BlobNotFound
+
+# Load environment variables from .env file
+load_dotenv()
+
+RETRY_MAX_ATTEMPTS = int(os.getenv('RETRY_MAX_ATTEMPTS', '5'))
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', '30'))
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', '1800'))
+# Throttled sends start further back so the relay gets time to recover
+THROTTLE_BASE_DELAY = float(os.getenv('THROTTLE_BASE_DELAY', '120'))
+
+PERMANENT = 'permanent'
+TRANSIENT = 'transient'
+THROTTLED = 'throttled'
+
+
+def classify(exc):
+    if is_throttled(exc):
+        return THROTTLED
+    if isinstance(exc, (ValueError, BlobNotFound)):
+        # A bad address, template, attachment or encoding, or missing content, will be the same on retry
+        # (TemplateError, AttachmentError and UnicodeError are all ValueErrors)
+        return PERMANENT
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in exc.recipients.values()]
+        return PERMANENT if codes and all(code >= 500 for code in codes) else TRANSIENT
+    code = getattr(exc, 'smtp_code', None)
+    if isinstance(code, int) and 500 <= code < 600:
+        return PERMANENT
+    # 4xx replies, dropped connections, timeouts and anything unexpected are worth another try
+    return TRANSIENT
+
+
+def should_retry(kind, retries, max_retries=RETRY_MAX_ATTEMPTS):
+    return kind != PERMANENT and retries < max_retries
+
+
+def backoff(retries, kind=TRANSIENT):
+    # Exponential backoff, jittered between half the base delay and the ceiling, so retries from one
+    # incident do not arrive together and none comes back at once
+    base = THROTTLE_BASE_DELAY if kind == THROTTLED else RETRY_BASE_DELAY
+    ceiling = min(RETRY_MAX_DELAY, base * 2 ** retries)
+    return random.uniform(base / 2, ceiling)
@@ -0,0 +1,236 @@
+import os
+import json
+import math
+import time
+import logging
+import sqlite3
+import threading
+from collections import deque
+from dotenv import load_dotenv
+
+from metrics import SCHEDULED_RELEASED, SCHEDULED_LAG_SECONDS, maybe_flush
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Releases sends enqueued with send_at to the broker when they fall due:
+#   python scheduler.py
+# Run one scheduler per SCHEDULER_DB; the web tier only writes to it.
+
+# Future sends, shared between the gunicorn workers and the scheduler on this host
+SCHEDULER_DB = os.getenv('SCHEDULER_DB', 'scheduler.db')
+# Resolution of the timing wheel, in seconds; sends are released at most this late
+SCHEDULER_TICK = float(os.getenv('SCHEDULER_TICK', '1'))
+# Only sends due within SCHEDULER_HORIZON seconds are held in memory; the rest stay on disk
+SCHEDULER_HORIZON = float(os.getenv('SCHEDULER_HORIZON', '3600'))
+# Tasks published per producer checkout
+SCHEDULER_BATCH = int(os.getenv('SCHEDULER_BATCH', '500'))
+# Furthest in the future a send may be scheduled, in seconds
+SCHEDULER_MAX_DELAY = float(os.getenv('SCHEDULER_MAX_DELAY', str(90 * 86400)))
+# Upper bound on the wait before retrying a batch the broker did not take
+SCHEDULER_RETRY_MAX_DELAY = float(os.getenv('SCHEDULER_RETRY_MAX_DELAY', '30'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scheduled_sends (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    task_id TEXT NOT NULL UNIQUE,
+    due REAL NOT NULL,
+    task TEXT NOT NULL,
+    args TEXT NOT NULL,
+    kwargs TEXT NOT NULL,
+    options TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS scheduled_sends_due ON scheduled_sends (due);
+"""
+
+
+class ScheduleStore:
+    # Every pending send, indexed by due time. A row is deleted only after the broker has its task,
+    # so a scheduler crash republishes at most the batch in flight, under the same task id.
+    def __init__(self, path=SCHEDULER_DB):
+        self.path = path
+        self._local = threading.local()
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(SCHEMA)
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def add(self, task_id, task_name, args=None, kwargs=None, due=None, options=None):
+        self._db().execute('INSERT INTO scheduled_sends (task_id, due, task, args, kwargs, options) '
+                           'VALUES (?, ?, ?, ?, ?, ?)', (task_id, due, task_name, json.dumps(args or []),
+                                                         json.dumps(kwargs or {}), json.dumps(options or {})))
+
+    def last_id(self):
+        return self._db().execute('SELECT COALESCE(MAX(id), 0) FROM scheduled_sends').fetchone()[0]
+
+    def added(self, after_id, upto_id, due_before):
+        # Rows inserted since the last poll that fall inside the loaded window
+        return self._db().execute('SELECT id, task_id, due, task, args, kwargs, options FROM scheduled_sends '
+                                  'WHERE id > ? AND id <= ? AND due < ?', (after_id, upto_id, due_before)).fetchall()
+
+    def due_between(self, start, end):
+        return self._db().execute('SELECT id, task_id, due, task, args, kwargs, options FROM scheduled_sends '
+                                  'WHERE due >= ? AND due < ?', (start, end)).fetchall()
+
+    def remove(self, ids):
+        db = self._db()
+        db.execute('BEGIN')
+        try:
+            db.executemany('DELETE FROM scheduled_sends WHERE id = ?', ((i,) for i in ids))
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+
+    def pending(self):
+        return self._db().execute('SELECT COUNT(*) FROM scheduled_sends').fetchone()[0]
+
+
+class TimingWheel:
+    # Hierarchical timing wheel: level 0 has one slot per tick, each higher level one slot per full turn
+    # of the level below. Adding is O(1); an entry moves down a level when its slot comes round,
+    # so each one is touched at most once per level before it expires.
+    def __init__(self, tick=SCHEDULER_TICK, slots=64, levels=4, now=None):
+        self.tick = tick
+        self.slots = slots
+        self.levels = [[[] for _ in range(slots)] for _ in range(levels)]
+        self.current = int((now or time.time()) // tick)
+        self.size = 0
+
+    def add(self, due, item):
+        # Rounded up, so nothing is released before it is due
+        self._place(max(math.ceil(due / self.tick), self.current), item)
+        self.size += 1
+
+    def _place(self, tick, item):
+        delta = tick - self.current
+        level = 0
+        span = self.slots
+        # Entries beyond the top level's range sit in its slot and are re-placed each time it comes round
+        while delta >= span and level < len(self.levels) - 1:
+            span *= self.slots
+            level += 1
+        width = span // self.slots
+        self.levels[level][(tick // width) % self.slots].append((tick, item))
+
+    def advance(self, now=None):
+        # Moves the wheel to now and returns the items that fell due, oldest first
+        target = int((now or time.time()) // self.tick)
+        expired = []
+        expired.extend(item for _, item in self._take(0, self.current))
+        while self.current < target:
+            self.current += 1
+            width = self.slots
+            for level in range(1, len(self.levels)):
+                if self.current % width:
+                    break
+                for tick, item in self._take(level, (self.current // width) % self.slots):
+                    self._place(tick, item)
+                width *= self.slots
+            expired.extend(item for _, item in self._take(0, self.current))
+        self.size -= len(expired)
+        return expired
+
+    def _take(self, level, index):
+        if level == 0:
+            index %= self.slots
+        bucket = self.levels[level][index]
+        self.levels[level][index] = []
+        return bucket
+
+
+class Scheduler:
+    def __init__(self, app, store=None, tick=SCHEDULER_TICK, horizon=SCHEDULER_HORIZON, batch_size=SCHEDULER_BATCH):
+        self.app = app
+        self.store = store or ScheduleStore()
+        self.tick = tick
+        self.horizon = horizon
+        self.batch_size = batch_size
+        self.wheel = TimingWheel(tick)
+        self._ready = deque()
+        # Ids in the wheel or waiting to publish, so overlapping loads do not double up
+        self._loaded = set()
+        self._last_id = 0
+        self._loaded_until = float('-inf')
+        self._failures = 0
+
+    def _load(self, rows):
+        for row in rows:
+            if row[0] not in self._loaded:
+                self._loaded.add(row[0])
+                self.wheel.add(row[2], row)
+
+    def poll(self, now):
+        upto = self.store.last_id()
+        if upto > self._last_id:
+            self._load(self.store.added(self._last_id, upto, self._loaded_until))
+            self._last_id = upto
+        if now + self.horizon / 2 >= self._loaded_until:
+            # Pull the next stretch of the index into memory well before it is needed
+            until = now + self.horizon
+            self._load(self.store.due_between(self._loaded_until, until))
+            self._loaded_until = until
+
+    def release(self, now):
+        self._ready.extend(self.wheel.advance(now))
+        while self._ready:
+            batch = [self._ready.popleft() for _ in range(min(self.batch_size, len(self._ready)))]
+            try:
+                self._publish(batch)
+            except Exception as e:
+                # Broker unavailable: keep the batch at the front and try again after a pause
+                self._ready.extendleft(reversed(batch))
+                self._failures += 1
+                # The exponent is capped so a long broker outage cannot overflow the float
+                delay = min(SCHEDULER_RETRY_MAX_DELAY, self.tick * 2 ** min(self._failures, 16))
+                logging.error(f'Publishing {len(batch)} scheduled sends failed, retrying in {delay:.1f}s: {e}')
+                return delay
+            self._failures = 0
+            ids = [row[0] for row in batch]
+            self.store.remove(ids)
+            self._loaded.difference_update(ids)
+        return 0
+
+    def _publish(self, batch):
+        now = time.time()
+        with self.app.producer_or_acquire() as producer:
+            for _, task_id, due, task, args, kwargs, options in batch:
+                self.app.send_task(task, args=json.loads(args), kwargs=json.loads(kwargs),
+                                   task_id=task_id, producer=producer, **json.loads(options))
+                SCHEDULED_RELEASED.inc(task)
+                SCHEDULED_LAG_SECONDS.observe(max(0.0, now - due), task)
+        logging.info(f'Released {len(batch)} scheduled sends')
+
+    def run(self, stop=None):
+        stop = stop or threading.Event()
+        logging.info(f'Scheduler started with {self.store.pending()} pending sends')
+        while not stop.is_set():
+            now = time.time()
+            delay = 0
+            try:
+                self.poll(now)
+            except sqlite3.Error as e:
+                logging.error(f'Reading scheduled sends failed: {e}')
+            else:
+                delay = self.release(now)
+            maybe_flush()
+            # Wake on the next tick boundary
+            stop.wait(max(delay, self.tick - time.time() % self.tick))
+
+
+scheduled_sends = ScheduleStore()
+
+
+def main():
+    from tasks import celery
+    Scheduler(celery).run()
+
+
+if __name__ == '__main__':
+    main()
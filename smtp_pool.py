@@ -0,0 +1,273 @@
+import os
+import time
+import socket
+import smtplib
+import logging
+import threading
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Pool settings (per worker process)
+SMTP_POOL_SIZE = int(os.getenv('SMTP_POOL_SIZE', '2'))
+SMTP_POOL_MAX_MESSAGES = int(os.getenv('SMTP_POOL_MAX_MESSAGES', '100'))
+SMTP_POOL_MAX_AGE = float(os.getenv('SMTP_POOL_MAX_AGE', '300'))
+SMTP_POOL_IDLE_CHECK = float(os.getenv('SMTP_POOL_IDLE_CHECK', '15'))
+SMTP_TIMEOUT = float(os.getenv('SMTP_TIMEOUT', '30'))
+# Only turn this off for relays on a trusted network that do not offer STARTTLS
+SMTP_STARTTLS = os.getenv('SMTP_STARTTLS', 'true').lower() != 'false'
+
+# Errors that only fail the current transaction; the session itself is still usable
+TRANSACTION_ERRORS = (
+    smtplib.SMTPRecipientsRefused,
+    smtplib.SMTPSenderRefused,
+    smtplib.SMTPDataError,
+)
+
+
+# Callables taking (phase, seconds); notified for dns, connect, starttls, login and send
+phase_observers = []
+
+
+@contextmanager
+def timed_phase(phase):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if phase_observers:
+            elapsed = time.perf_counter() - started
+            for observer in phase_observers:
+                observer(phase, elapsed)
+
+
+class TimedSMTP(smtplib.SMTP):
+    # Splits connection setup into DNS resolution and TCP connect so each can be timed
+    def _get_socket(self, host, port, timeout):
+        with timed_phase('dns'):
+            addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        error = OSError(f'No addresses found for {host}')
+        with timed_phase('connect'):
+            for family, socktype, proto, _, address in addresses:
+                sock = socket.socket(family, socktype, proto)
+                try:
+                    if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                        sock.settimeout(timeout)
+                    if self.source_address:
+                        sock.bind(self.source_address)
+                    sock.connect(address)
+                    return sock
+                except OSError as e:
+                    error = e
+                    sock.close()
+        raise error
+
+
+def send_message(server, from_addr, to_addrs, msg):
+    # Like server.sendmail(), but msg may also be a list of parts. Byte strings are dot-stuffed as usual;
+    # memoryviews (cached base64 attachment parts, whose lines never start with a dot) go to the
+    # socket as they are, so large shared parts are not copied into every message.
+    if isinstance(msg, (bytes, str)):
+        return server.sendmail(from_addr, to_addrs, msg)
+    if isinstance(to_addrs, str):
+        to_addrs = [to_addrs]
+    server.ehlo_or_helo_if_needed()
+    code, resp = server.mail(from_addr)
+    if code != 250:
+        raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+    refused = {}
+    for addr in to_addrs:
+        code, resp = server.rcpt(addr)
+        if code not in (250, 251):
+            refused[addr] = (code, resp)
+    if len(refused) == len(to_addrs):
+        raise smtplib.SMTPRecipientsRefused(refused)
+    code, resp = server.docmd('data')
+    if code != 354:
+        raise smtplib.SMTPDataError(code, resp)
+    ending = b''
+    for part in msg:
+        if not isinstance(part, memoryview):
+            part = smtplib._quote_periods(part)
+        if part:
+            server.send(part)
+            ending = bytes(part[-2:])
+    server.send(b'.\r\n' if ending == b'\r\n' else b'\r\n.\r\n')
+    code, resp = server.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+
+class PooledConnection:
+    def __init__(self, server):
+        self.server = server
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.messages = 0
+
+    def expired(self, max_messages, max_age):
+        return (self.messages >= max_messages or
+                time.monotonic() - self.created_at >= max_age)
+
+    def close(self):
+        try:
+            self.server.quit()
+        except Exception:
+            try:
+                self.server.close()
+            except Exception:
+                pass
+
+
+class SMTPConnectionPool:
+    def __init__(self, host, port, username, password,
+                 max_size=SMTP_POOL_SIZE, max_messages=SMTP_POOL_MAX_MESSAGES,
+                 max_age=SMTP_POOL_MAX_AGE, idle_check=SMTP_POOL_IDLE_CHECK,
+                 timeout=SMTP_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.max_size = max_size
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self.idle_check = idle_check
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'created': 0,
+            'retired': 0,
+            'broken': 0,
+        }
+
+    def _connect(self):
+        server = TimedSMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if SMTP_STARTTLS:
+                with timed_phase('starttls'):
+                    server.starttls()
+            if self.username:
+                with timed_phase('login'):
+                    server.login(self.username, self.password)
+        except Exception:
+            server.close()
+            raise
+        self._count('created')
+        return PooledConnection(server)
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def _healthy(self, conn):
+        # Only probe connections that sat idle long enough for the server to drop them
+        if time.monotonic() - conn.last_used < self.idle_check:
+            return True
+        try:
+            return conn.server.noop()[0] == 250
+        except Exception:
+            return False
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                self._count('misses')
+                return self._connect()
+            if conn.expired(self.max_messages, self.max_age):
+                self._count('retired')
+                conn.close()
+                continue
+            if not self._healthy(conn):
+                self._count('broken')
+                conn.close()
+                continue
+            self._count('hits')
+            return conn
+
+    def release(self, conn, reset=False):
+        if reset:
+            try:
+                conn.server.rset()
+            except Exception:
+                self.discard(conn)
+                return
+        conn.last_used = time.monotonic()
+        if conn.expired(self.max_messages, self.max_age):
+            self._count('retired')
+            conn.close()
+            return
+        with self._lock:
+            if len(self._idle) < self.max_size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def discard(self, conn):
+        self._count('broken')
+        conn.close()
+
+    @contextmanager
+    def session(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except TRANSACTION_ERRORS:
+            self.release(conn, reset=True)
+            raise
+        except Exception:
+            self.discard(conn)
+            raise
+        self.release(conn)
+
+    @contextmanager
+    def connection(self):
+        with self.session() as conn:
+            yield conn.server
+            conn.messages += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = len(self._idle)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+# One pool per worker process; prefork children must not share sockets with the parent
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(host, port, username, password):
+    key = (os.getpid(), host, port, username)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = SMTPConnectionPool(host, port, username, password)
+            _pools[key] = pool
+            logging.debug(f'Created SMTP connection pool for {host}:{port}')
+        return pool
+
+
+def close_pools():
+    with _pools_lock:
+        pools = [pool for key, pool in _pools.items() if key[0] == os.getpid()]
+        _pools.clear()
+    for pool in pools:
+        logging.info(f'Closing SMTP pool for {pool.host}:{pool.port}: {pool.stats()}')
+        pool.close_all()
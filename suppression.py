@@ -0,0 +1,238 @@
+import os
+import json
+import math
+import time
+import sqlite3
+import hashlib
+import logging
+import smtplib
+import threading
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Addresses that must not be mailed (hard bounces, unsubscribes), shared by the web tier and the workers
+SUPPRESSION_DB = os.getenv('SUPPRESSION_DB', 'suppressions.db')
+# Seconds between checks for entries added by other processes
+SUPPRESSION_REFRESH_INTERVAL = float(os.getenv('SUPPRESSION_REFRESH_INTERVAL', '5'))
+# Bloom filter false positive rate; a false positive only costs one indexed lookup
+SUPPRESSION_FALSE_POSITIVE_RATE = float(os.getenv('SUPPRESSION_FALSE_POSITIVE_RATE', '0.001'))
+SUPPRESSION_MIN_CAPACITY = int(os.getenv('SUPPRESSION_MIN_CAPACITY', '100000'))
+# The filter is saved next to SUPPRESSION_DB so a new process loads it instead of reading every row;
+# it is saved again once this many rows have been folded in since
+SUPPRESSION_SNAPSHOT_ROWS = int(os.getenv('SUPPRESSION_SNAPSHOT_ROWS', '10000'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS suppressions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    address TEXT NOT NULL UNIQUE,
+    reason TEXT NOT NULL,
+    source TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+"""
+
+# RCPT TO replies meaning the mailbox does not exist or will never accept mail; other 5xx replies
+# (policy, content, sender reputation) are about this message, not the address
+HARD_BOUNCE_CODES = (550, 551, 553)
+
+
+def normalize_address(address):
+    return address.strip().lower()
+
+
+def is_hard_bounce(exc):
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in exc.recipients.values()]
+        return bool(codes) and all(code in HARD_BOUNCE_CODES for code in codes)
+    return False
+
+
+class BloomFilter:
+    # k bit positions per key from two 64-bit halves of one blake2b digest (double hashing)
+    def __init__(self, capacity, false_positive_rate=SUPPRESSION_FALSE_POSITIVE_RATE):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        a = int.from_bytes(digest[:8], 'little')
+        b = int.from_bytes(digest[8:], 'little') | 1
+        size = self.size
+        return [(a + i * b) % size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def update(self, keys):
+        # add() for many keys, with the lookups hoisted out of the loop
+        bits, size, rounds, blake2b = self.bits, self.size, range(self.hashes), hashlib.blake2b
+        for key in keys:
+            digest = int.from_bytes(blake2b(key.encode(), digest_size=16).digest(), 'little')
+            a, b = digest & 0xFFFFFFFFFFFFFFFF, (digest >> 64) | 1
+            for i in rounds:
+                position = (a + i * b) % size
+                bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for position in self._positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class SuppressionList:
+    # The table is authoritative; each process keeps a Bloom filter of it, so the common case (not
+    # suppressed) never touches SQLite. New rows are folded into the filter by id every refresh interval,
+    # and the filter is rebuilt at twice the size once it fills up. Removed rows stay in the filter
+    # as false positives, which the exact lookup on a hit filters out.
+    def __init__(self, path=SUPPRESSION_DB, refresh_interval=SUPPRESSION_REFRESH_INTERVAL):
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._filter = None
+        self._last_id = 0
+        self._snapshot_id = 0
+        self._refreshed_at = 0.0
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(SCHEMA)
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def _rebuild(self):
+        db = self._db()
+        count, last_id = db.execute('SELECT COUNT(*), COALESCE(MAX(id), 0) FROM suppressions').fetchone()
+        bloom = BloomFilter(max(SUPPRESSION_MIN_CAPACITY, count * 2))
+        bloom.update(address for (address,) in db.execute('SELECT address FROM suppressions WHERE id <= ?',
+                                                          (last_id,)))
+        self._filter = bloom
+        self._last_id = last_id
+        logging.info(f'Suppression filter built: {count} addresses, {len(bloom.bits)} bytes')
+        self._save_snapshot()
+
+    def _load_snapshot(self):
+        try:
+            with open(f'{self.path}.bloom', 'rb') as f:
+                header = json.loads(f.readline())
+                bits = bytearray(f.read())
+        except (OSError, ValueError):
+            return False
+        last_id = self._db().execute('SELECT COALESCE(MAX(id), 0) FROM suppressions').fetchone()[0]
+        bloom = BloomFilter(header['capacity'], header['false_positive_rate'])
+        if header['last_id'] > last_id or len(bits) != len(bloom.bits):
+            # Left by another database, or by other settings
+            return False
+        bloom.bits = bits
+        bloom.count = header['count']
+        self._filter = bloom
+        self._last_id = self._snapshot_id = header['last_id']
+        return True
+
+    def _save_snapshot(self):
+        bloom = self._filter
+        header = {'capacity': bloom.capacity, 'false_positive_rate': SUPPRESSION_FALSE_POSITIVE_RATE,
+                  'count': bloom.count, 'last_id': self._last_id}
+        path = f'{self.path}.bloom'
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(json.dumps(header).encode() + b'\n')
+                f.write(bloom.bits)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f'Could not save the suppression filter: {e}')
+        self._snapshot_id = self._last_id
+
+    def _refresh(self, force=False):
+        now = time.monotonic()
+        if not force and self._pid == os.getpid() and now - self._refreshed_at < self.refresh_interval:
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                if not self._load_snapshot():
+                    self._rebuild()
+                self._pid = os.getpid()
+            rows = self._db().execute('SELECT id, address FROM suppressions WHERE id > ? ORDER BY id',
+                                      (self._last_id,)).fetchall()
+            if self._filter.count + len(rows) > self._filter.capacity:
+                self._rebuild()
+            elif rows:
+                self._filter.update(address for _, address in rows)
+                self._last_id = rows[-1][0]
+                if self._last_id - self._snapshot_id >= SUPPRESSION_SNAPSHOT_ROWS:
+                    self._save_snapshot()
+            self._refreshed_at = now
+
+    def is_suppressed(self, address):
+        key = normalize_address(address)
+        self._refresh()
+        if key not in self._filter:
+            return False
+        return self._db().execute('SELECT 1 FROM suppressions WHERE address = ?', (key,)).fetchone() is not None
+
+    def partition(self, addresses):
+        # Returns (allowed, suppressed), keeping the order of addresses
+        self._refresh()
+        candidates = [address for address in addresses if normalize_address(address) in self._filter]
+        if not candidates:
+            return list(addresses), []
+        found = set()
+        keys = sorted({normalize_address(address) for address in candidates})
+        db = self._db()
+        for i in range(0, len(keys), 500):
+            part = keys[i:i + 500]
+            found.update(row[0] for row in db.execute(
+                f'SELECT address FROM suppressions WHERE address IN ({",".join("?" * len(part))})', part))
+        allowed = [address for address in addresses if normalize_address(address) not in found]
+        suppressed = [address for address in addresses if normalize_address(address) in found]
+        return allowed, suppressed
+
+    def add_many(self, entries, source):
+        # entries: iterable of (address, reason)
+        now = time.time()
+        rows = [(normalize_address(address), reason, source, now) for address, reason in entries]
+        if not rows:
+            return
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.executemany('INSERT OR IGNORE INTO suppressions (address, reason, source, created_at) '
+                           'VALUES (?, ?, ?, ?)', rows)
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        # Visible to this process at once; other processes pick it up on their next refresh.
+        # Forced, so each new row reaches the filter (and its count) once, by id.
+        self._refresh(force=True)
+
+    def add(self, address, reason, source):
+        self.add_many([(address, reason)], source)
+
+    def remove(self, address):
+        cursor = self._db().execute('DELETE FROM suppressions WHERE address = ?', (normalize_address(address),))
+        return cursor.rowcount > 0
+
+    def get(self, address):
+        row = self._db().execute('SELECT address, reason, source, created_at FROM suppressions WHERE address = ?',
+                                 (normalize_address(address),)).fetchone()
+        return dict(zip(('address', 'reason', 'source', 'created_at'), row)) if row else None
+
+
+suppressions = SuppressionList()
@@ -0,0 +1,155 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from celery import states
+from celery.result import AsyncResult
+from celery.backends.base import KeyValueStoreBackend
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Finished tasks never change state, so their status can be served from memory
+TERMINAL_STATES = (states.SUCCESS, states.FAILURE)
+STATUS_CACHE_SIZE = int(os.getenv('STATUS_CACHE_SIZE', '50000'))
+STATUS_CACHE_TTL = float(os.getenv('STATUS_CACHE_TTL', '3600'))
+
+
+class TerminalStateCache:
+    def __init__(self, max_size=STATUS_CACHE_SIZE, ttl=STATUS_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, task_id):
+        with self._lock:
+            entry = self._entries.get(task_id)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[task_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(task_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, task_id, state, result):
+        if state not in TERMINAL_STATES:
+            return
+        with self._lock:
+            self._entries[task_id] = (time.monotonic() + self.ttl, (state, result))
+            self._entries.move_to_end(task_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+status_cache = TerminalStateCache()
+
+
+def _fetch_many(celery_app, task_ids):
+    backend = celery_app.backend
+    if getattr(type(backend), 'mget', KeyValueStoreBackend.mget) is KeyValueStoreBackend.mget:
+        # Backends without multi-get (database, rpc) or that inherit the base one, which raises
+        # NotImplementedError (S3, for one), fall back to one lookup per id
+        results = {}
+        for task_id in task_ids:
+            result = AsyncResult(task_id, app=celery_app)
+            results[task_id] = (result.state, result.result)
+        return results
+
+    keys = [backend.get_key_for_task(task_id) for task_id in task_ids]
+    values = backend.mget(keys)
+    if hasattr(values, 'get'):
+        # Memcached-style clients return a mapping that omits missing keys
+        values = [values.get(key) for key in keys]
+
+    results = {}
+    for task_id, value in zip(task_ids, values):
+        if value is None:
+            results[task_id] = (states.PENDING, None)
+            continue
+        meta = backend.decode_result(value)
+        results[task_id] = (meta['status'], meta['result'])
+    return results
+
+
+def fetch_states(celery_app, task_ids):
+    # Maps each task id to (state, result), hitting the backend only for ids not already finished
+    found = {}
+    missing = []
+    for task_id in task_ids:
+        cached = status_cache.get(task_id)
+        if cached is None:
+            missing.append(task_id)
+        else:
+            found[task_id] = cached
+
+    if missing:
+        for task_id, (state, result) in _fetch_many(celery_app, missing).items():
+            status_cache.put(task_id, state, result)
+            found[task_id] = (state, result)
+    return found
+
+
+# Long-poll and SSE clients all share one background poller per process
+STATUS_WATCH_INTERVAL = float(os.getenv('STATUS_WATCH_INTERVAL', '0.5'))
+
+
+class StatusWatcher:
+    def __init__(self, celery_app, interval=STATUS_WATCH_INTERVAL):
+        self.celery_app = celery_app
+        self.interval = interval
+        self._watchers = {}
+        self._states = {}
+        self._cond = threading.Condition()
+        self._pid = None
+
+    def _ensure_started(self):
+        # Started lazily, and again after a fork, since threads do not survive fork()
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        threading.Thread(target=self._run, name='status-watcher', daemon=True).start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._watchers:
+                    self._cond.wait()
+                task_ids = list(self._watchers)
+            try:
+                found = fetch_states(self.celery_app, task_ids)
+            except Exception as e:
+                logging.error(f'Status watcher lookup failed: {e}')
+                found = {}
+            with self._cond:
+                for task_id, state in found.items():
+                    if task_id in self._watchers:
+                        self._states[task_id] = state
+                self._cond.notify_all()
+            time.sleep(self.interval)
+
+    def wait(self, task_id, last_state=None, timeout=30):
+        # Blocks until the task's state differs from last_state; returns (state, result) or None on timeout
+        def changed():
+            current = self._states.get(task_id)
+            return current is not None and current[0] != last_state
+
+        with self._cond:
+            self._ensure_started()
+            self._watchers[task_id] = self._watchers.get(task_id, 0) + 1
+            self._cond.notify_all()
+            try:
+                if self._cond.wait_for(changed, timeout):
+                    return self._states[task_id]
+                return None
+            finally:
+                self._watchers[task_id] -= 1
+                if not self._watchers[task_id]:
+                    del self._watchers[task_id]
+                    self._states.pop(task_id, None)
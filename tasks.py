@@ -1,10 +1,30 @@
 import os
+import time
 import smtplib
 import logging
 from celery import Celery
+from kombu import Queue
+from celery.signals import setup_logging, worker_process_shutdown, before_task_publish, task_prerun, task_postrun
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from datetime import datetime
 from dotenv import load_dotenv
+from logging_config import configure_logging, shutdown_logging
+import smtp_pool
+from smtp_pool import get_pool, close_pools, timed_phase, send_message, TRANSACTION_ERRORS
+from message_cache import message_cache
+from template_engine import templates
+from attachments import attachment_cache
+from async_delivery import deliver_batch
+from rate_limit import get_limiter
+from retry_policy import classify, should_retry, backoff, PERMANENT, TRANSIENT, THROTTLED, RETRY_MAX_ATTEMPTS
+from dead_letter import dead_letters
+from suppression import suppressions, is_hard_bounce
+from bounces import make_message_id
+from recipient_groups import group_recipients
+from relays import RelayPool, load_relays
+from metrics import (EMAILS_SENT, EMAIL_FAILURES, EMAIL_RETRIES, SMTP_PHASE_SECONDS, QUEUE_WAIT_SECONDS,
+                     TASKS_PUBLISHED, maybe_flush)
 
 # Load environment variables from .env file
 load_dotenv()
@@ -16,56 +36,310 @@ celery = Celery(
     backend=os.getenv('CELERY_RESULT_BACKEND')
 )
 
+# Broker connections each process keeps for publishing; give the web tier at least one per request thread
+celery.conf.broker_pool_limit = int(os.getenv('BROKER_POOL_LIMIT', '10'))
+
+# Transactional mail (password resets, receipts) and bulk mail (newsletters, imports) use separate queues,
+# so a bulk backlog never sits in front of a transactional send; see workers.py for the worker profiles
+EMAIL_QUEUE_TRANSACTIONAL = os.getenv('EMAIL_QUEUE_TRANSACTIONAL', 'email.transactional')
+EMAIL_QUEUE_BULK = os.getenv('EMAIL_QUEUE_BULK', 'email.bulk')
+# Class of sends that do not name one
+DEFAULT_PRIORITY = os.getenv('DEFAULT_PRIORITY', 'bulk')
+# Above 0, queues are declared with this x-max-priority and transactional sends carry it, which
+# puts them first when both classes share a queue (RabbitMQ needs the queues declared fresh for this)
+EMAIL_QUEUE_MAX_PRIORITY = int(os.getenv('EMAIL_QUEUE_MAX_PRIORITY', '0'))
+PRIORITY_QUEUES = {'transactional': EMAIL_QUEUE_TRANSACTIONAL, 'bulk': EMAIL_QUEUE_BULK}
+
+celery.conf.task_queues = [
+    Queue(name, routing_key=name,
+          queue_arguments={'x-max-priority': EMAIL_QUEUE_MAX_PRIORITY} if EMAIL_QUEUE_MAX_PRIORITY else None)
+    for name in dict.fromkeys(PRIORITY_QUEUES.values())
+]
+celery.conf.task_default_queue = EMAIL_QUEUE_BULK
+celery.conf.task_default_exchange = 'email'
+celery.conf.task_default_routing_key = EMAIL_QUEUE_BULK
+
+def route(priority=None):
+    # apply_async options for a priority class; retries keep the queue and priority they arrived with
+    priority = priority or DEFAULT_PRIORITY
+    if priority not in PRIORITY_QUEUES:
+        raise ValueError(f'priority must be one of: {", ".join(PRIORITY_QUEUES)}.')
+    options = {'queue': PRIORITY_QUEUES[priority]}
+    if EMAIL_QUEUE_MAX_PRIORITY:
+        options['priority'] = EMAIL_QUEUE_MAX_PRIORITY if priority == 'transactional' else 0
+    return options
+
 EMAIL = os.getenv('EMAIL')
 PASSWORD = os.getenv('PASSWORD')
 SMTP_SERVER = os.getenv('SMTP_SERVER')
 SMTP_PORT = int(os.getenv('SMTP_PORT'))
-
-# Configure logging
-log_path = '/var/log/messaging_system.log'
-print(f"Log file path: {log_path}")
-
-logging.basicConfig(
-    filename=log_path,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    level=logging.DEBUG,  # Set to DEBUG to capture all log levels
-    filemode='a'  # Append mode to prevent overwriting
-)
-
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.DEBUG)  # Set to DEBUG to capture all log levels
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-console_handler.setFormatter(formatter)
-logging.getLogger().addHandler(console_handler)
-
-print("Logging is configured")
+EMAIL_DOMAIN = EMAIL.rpartition('@')[2] if EMAIL else None
+# SMTP_RELAYS lists several relays to balance across; otherwise SMTP_SERVER / SMTP_PORT is the only one
+relay_pool = RelayPool(load_relays(SMTP_SERVER, SMTP_PORT, EMAIL, PASSWORD))
+# 'sync' delivers a batch over one pooled session, 'async' runs ASYNC_SMTP_CONCURRENCY sessions at once
+DELIVERY_ENGINE = os.getenv('DELIVERY_ENGINE', 'sync')
+
+# Configure logging (see logging_config.py for LOG_PATH, LOG_LEVEL and LOG_MODE)
+configure_logging()
+
+@setup_logging.connect
+def keep_logging_config(**kwargs):
+    # Connecting this signal stops the worker from replacing the root logger's handlers
+    configure_logging()
+
+@worker_process_shutdown.connect
+def close_smtp_connections(**kwargs):
+    close_pools()
+    maybe_flush(force=True)
+    shutdown_logging()
+
+# Per-phase SMTP latency for /metrics (see metrics.py)
+smtp_pool.phase_observers.append(lambda phase, seconds: SMTP_PHASE_SECONDS.observe(seconds, phase))
+
+@before_task_publish.connect
+def stamp_publish_time(headers=None, routing_key=None, **kwargs):
+    # Queue wait is measured from when the task became runnable, so a retry countdown is not counted
+    eta = headers.get('eta')
+    headers['published_at'] = datetime.fromisoformat(eta).timestamp() if eta else time.time()
+    # By queue, so admission control counts only what feeds the queue it samples
+    TASKS_PUBLISHED.inc(headers.get('task'), routing_key)
+
+@task_prerun.connect
+def observe_queue_wait(task=None, **kwargs):
+    published_at = getattr(task.request, 'published_at', None)
+    if published_at:
+        QUEUE_WAIT_SECONDS.observe(max(0.0, time.time() - published_at), task.name)
+
+@task_postrun.connect
+def flush_metrics(**kwargs):
+    # Workers may then sit idle, so write the snapshot /metrics reads after every task
+    maybe_flush(force=True)
+
+# Bump the version whenever the default message below changes
+DEFAULT_TEMPLATE = ('hng_stage3', 1)
+
+def build_default_message():
+    msg = MIMEMultipart()
+    msg['From'] = EMAIL
+    msg['Subject'] = "Subject: Test"
+    body = "This is the stage 3 task given by HNG internship."
+    msg.attach(MIMEText(body, 'plain'))
+    return msg
+
+def build_message(email, template=None, version=None, variables=None, attachments=None, content=None,
+                  message_id=None):
+    # Attachments are encoded once per worker and shared by every message that carries them
+    parts = attachment_cache.get_many(attachments)
+    if content:
+        # Content travels as a blob store digest; it is fetched and compiled once per worker
+        return templates.content(content, domain=EMAIL_DOMAIN).render_message(
+            EMAIL, email, variables, message_id=message_id, attachments=parts)
+    if template:
+        # Personalized: the template is compiled once per worker, rendering is string joins
+        return templates.get(template, version, domain=EMAIL_DOMAIN).render_message(
+            EMAIL, email, variables, message_id=message_id, attachments=parts)
+    # The invariant part is serialized once per worker; only To, Message-ID and Date vary
+    compiled = message_cache.get(*DEFAULT_TEMPLATE, build_default_message, domain=EMAIL_DOMAIN)
+    return compiled.render(email, message_id=message_id, attachments=parts)
+
+# To header for multi-recipient transactions, so no recipient sees the others
+UNDISCLOSED_RECIPIENTS = 'undisclosed-recipients:;'
 
 @celery.task(bind=True)
-def send_email(self, email):
+def send_email(self, email, template=None, version=None, variables=None, attachments=None, content=None):
     try:
-        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-        server.starttls()
-        server.login(EMAIL, PASSWORD)
-        
-        msg = MIMEMultipart()
-        msg['From'] = EMAIL
-        msg['To'] = email
-        msg['Subject'] = "Subject: Test"
-        body = "This is the stage 3 task given by HNG internship."
-        msg.attach(MIMEText(body, 'plain'))
-
-        server.sendmail(EMAIL, email, msg.as_string())
-        server.quit()
-        
+        # The Message-ID carries the task id, so bounces.py can match a DSN to this task
+        msg = build_message(email, template, version, variables, attachments, content,
+                            message_id=make_message_id(self.request.id))
+
+        def deliver(relay):
+            # Wait for a token from the per-relay rate limit shared by all workers
+            limiter = get_limiter(relay.host, relay.port)
+            limiter.acquire()
+
+            # Reuse an authenticated session from this worker's pool
+            pool = get_pool(relay.host, relay.port, relay.username, relay.password)
+            try:
+                with pool.connection() as server, timed_phase('send'):
+                    send_message(server, EMAIL, email, msg)
+            except Exception as e:
+                limiter.record(e)
+                raise
+            limiter.record()
+            logging.debug(f'SMTP pool stats for {relay.name}: {pool.stats()}')
+
+        # A relay that fails is skipped for another one before this attempt counts as failed
+        relay_pool.send(deliver)
+        EMAILS_SENT.inc(self.name)
+
         logging.info(f'Email sent to {email}')
-        print(f"Email sent to {email}")
         return {'status': 'SUCCESS', 'email': email}  # Return the email address as the result
     except Exception as e:
-        logging.error(f'Failed to send email to {email}: {e}')
-        print(f"Failed to send email to {email}: {e}")
-        self.retry(exc=e, countdown=60, max_retries=3)
-        return {'status': 'FAILURE', 'error': str(e)}
+        kind = classify(e)
+        logging.error(f'Failed to send email to {email} ({kind}): {e}')
+        EMAIL_FAILURES.inc(kind)
+        if should_retry(kind, self.request.retries):
+            EMAIL_RETRIES.inc(kind)
+            raise self.retry(exc=e, countdown=backoff(self.request.retries, kind), max_retries=RETRY_MAX_ATTEMPTS)
+        if is_hard_bounce(e):
+            # The mailbox does not exist; later sends to it are stopped at enqueue
+            suppressions.add(email, str(e), 'bounce')
+        # Permanent rejection or out of retries: park it for a manual replay
+        extras = template or attachments or content
+        args = [email, template, version, variables, attachments, content] if extras else [email]
+        dead_letters.add(self.name, args, e, kind)
+        raise
+
+def deliver_batch_sync(relay, emails, content=None, task_id=None):
+    results = {}
+    pool = get_pool(relay.host, relay.port, relay.username, relay.password)
+    limiter = get_limiter(relay.host, relay.port)
+    try:
+        # Deliver the whole chunk over a single SMTP session
+        with pool.session() as conn:
+            for email in emails:
+                limiter.acquire()
+                try:
+                    with timed_phase('send'):
+                        conn.server.sendmail(EMAIL, email, build_message(
+                            email, content=content, message_id=make_message_id(task_id, recipient=email)))
+                    conn.messages += 1
+                    results[email] = None
+                    limiter.record()
+                except TRANSACTION_ERRORS as e:
+                    # Rejected recipient: reset the transaction and carry on with the chunk
+                    limiter.record(e)
+                    results[email] = e
+                    conn.server.rset()
+                except (UnicodeError, ValueError) as e:
+                    # This address or message cannot be encoded (a non-ASCII local part, a line break); it
+                    # failed before reaching the server, so it is this recipient's error, not the session's
+                    results[email] = e
+                    conn.server.rset()
+    except Exception as e:
+        # The session broke; every recipient not reached yet shares its error
+        limiter.record(e)
+        logging.error(f'Batch session interrupted after {len(results)} emails: {e}')
+        for email in emails:
+            results.setdefault(email, e)
+    return results
+
+def deliver_grouped_sync(relay, emails, content=None, task_id=None):
+    # One transaction per same-domain group: a single DATA transfer with many RCPT TO commands
+    results = {}
+    pool = get_pool(relay.host, relay.port, relay.username, relay.password)
+    limiter = get_limiter(relay.host, relay.port)
+    msg = build_message(UNDISCLOSED_RECIPIENTS, content=content, message_id=make_message_id(task_id))
+    try:
+        with pool.session() as conn:
+            for recipients in group_recipients(emails):
+                # smtplib cannot put a non-ASCII address in RCPT TO; left in, it would fail the whole group
+                for email in [email for email in recipients if not email.isascii()]:
+                    results[email] = ValueError(f'{email} cannot be sent without SMTPUTF8')
+                    recipients.remove(email)
+                if not recipients:
+                    continue
+                limiter.acquire()
+                try:
+                    with timed_phase('send'):
+                        refused = conn.server.sendmail(EMAIL, recipients, msg)
+                    conn.messages += 1
+                    limiter.record()
+                except TRANSACTION_ERRORS as e:
+                    limiter.record(e)
+                    conn.server.rset()
+                    if not isinstance(e, smtplib.SMTPRecipientsRefused):
+                        # MAIL FROM or DATA failed: one error for the whole group, not a refusal of each address
+                        for email in recipients:
+                            results[email] = e
+                        continue
+                    refused = e.recipients
+                for email in recipients:
+                    if email in refused:
+                        # Wrap each RCPT reply on its own so it is classified per recipient
+                        results[email] = smtplib.SMTPRecipientsRefused({email: refused[email]})
+                    else:
+                        results[email] = None
+    except Exception as e:
+        limiter.record(e)
+        logging.error(f'Grouped batch session interrupted after {len(results)} emails: {e}')
+        for email in emails:
+            results.setdefault(email, e)
+    return results
+
+def rcpt_reply(error):
+    if error is None:
+        return [250, 'accepted']
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        code, reply = next(iter(error.recipients.values()))
+        return [code, reply.decode('utf-8', 'replace') if isinstance(reply, bytes) else str(reply)]
+    if isinstance(error, smtplib.SMTPResponseException):
+        reply = error.smtp_error
+        return [error.smtp_code, reply.decode('utf-8', 'replace') if isinstance(reply, bytes) else str(reply)]
+    return [None, str(error)]
+
+def deliver_batch_async(relay, emails, content=None, task_id=None):
+    return deliver_batch(relay.host, relay.port, relay.username, relay.password, EMAIL,
+                         ((email, build_message(email, content=content,
+                                                message_id=make_message_id(task_id, recipient=email)))
+                          for email in emails),
+                         limiter=get_limiter(relay.host, relay.port))
+
+def dead_letter_args(email, content=None):
+    # send_email arguments that replay one recipient of a batch
+    return [email, None, None, None, None, content] if content else [email]
 
+@celery.task(bind=True)
+def send_email_batch(self, emails, grouped=False, content=None):
+    if grouped:
+        deliver = deliver_grouped_sync
+    elif DELIVERY_ENGINE == 'async':
+        deliver = deliver_batch_async
+    else:
+        deliver = deliver_batch_sync
+    # Recipients cut off by a relay failure are handed to the next healthy relay
+    results = relay_pool.send_batch(lambda relay, pending: deliver(relay, pending, content, self.request.id),
+                                    emails)
+
+    sent = 0
+    failed = {}
+    retryable = {}
+    for email, error in results.items():
+        if error is None:
+            sent += 1
+            continue
+        kind = classify(error)
+        EMAIL_FAILURES.inc(kind)
+        if kind == PERMANENT:
+            failed[email] = (error, kind)
+        else:
+            retryable[email] = (error, kind)
+    suppressions.add_many(((email, str(error)) for email, (error, _) in failed.items() if is_hard_bounce(error)),
+                          'bounce')
+
+    if retryable:
+        kinds = {kind for _, kind in retryable.values()}
+        kind = THROTTLED if THROTTLED in kinds else TRANSIENT
+        if should_retry(kind, self.request.retries):
+            EMAILS_SENT.inc(self.name, amount=sent)
+            EMAIL_RETRIES.inc(kind, amount=len(retryable))
+            dead_letters.add_many((send_email.name, dead_letter_args(email, content), error, kind)
+                                  for email, (error, kind) in failed.items())
+            logging.warning(f'Batch sent {sent} emails, retrying {len(retryable)} ({kind})')
+            raise self.retry(args=[list(retryable)], kwargs={'grouped': grouped, 'content': content},
+                             countdown=backoff(self.request.retries, kind), max_retries=RETRY_MAX_ATTEMPTS)
+        failed.update(retryable)
+
+    # Dead-letter entries are per recipient so a replay does not resend the rest of the chunk
+    dead_letters.add_many((send_email.name, dead_letter_args(email, content), error, kind)
+                          for email, (error, kind) in failed.items())
+    EMAILS_SENT.inc(self.name, amount=sent)
+    logging.info(f'Batch sent {sent} emails, {len(failed)} failed')
+    result = {'status': 'SUCCESS', 'sent': sent, 'failed': {email: str(error) for email, (error, _) in failed.items()}}
+    if grouped:
+        # RCPT TO outcome for every recipient handled in this attempt
+        result['rcpt'] = {email: rcpt_reply(error) for email, error in results.items()}
+    return result
 
 
 
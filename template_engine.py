@@ -0,0 +1,203 @@
+import os
+import re
+import json
+import html
+import socket
+import binascii
+import logging
+import threading
+from collections import OrderedDict
+from email.utils import make_msgid
+from dotenv import load_dotenv
+
+from attachments import attachment_parts
+from blob_store import blobs, BlobNotFound
+from message_cache import CRLF, encode_header, current_date
+
+# Load environment variables from .env file
+load_dotenv()
+
+# One <template_id>.json per template: {"version": 1, "subject": "...", "text": "...", "html": "..."}
+TEMPLATE_DIR = os.getenv('TEMPLATE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'email_templates'))
+# Number of compiled templates kept per process
+TEMPLATE_CACHE_SIZE = int(os.getenv('TEMPLATE_CACHE_SIZE', '256'))
+
+TEMPLATE_ID = re.compile(r'^[A-Za-z0-9_-]+$')
+PLACEHOLDER = re.compile(r'{{\s*([A-Za-z_][A-Za-z0-9_]*)\s*}}')
+
+
+class TemplateError(ValueError):
+    pass
+
+
+def single_line(value):
+    # Variables rendered into a header must not be able to start another one
+    return str(value).replace('\r', ' ').replace('\n', ' ')
+
+
+def html_value(value):
+    return html.escape(str(value))
+
+
+def compile_source(source, escape=str):
+    # Turns "Hi {{ name }}!" into lambda V: ''.join(('Hi ', E(V['name']), '!')); returns it with the names used
+    pieces = PLACEHOLDER.split(source)
+    literals, names = pieces[0::2], pieces[1::2]
+    if not names:
+        return (lambda variables: source), set()
+    terms = []
+    for i, literal in enumerate(literals):
+        if literal:
+            terms.append(f'L[{i}]')
+        if i < len(names):
+            terms.append(f'E(V[{names[i]!r}])')
+    render = eval(f"lambda V: ''.join(({', '.join(terms)},))", {'L': tuple(literals), 'E': escape})
+    return render, set(names)
+
+
+def quoted_printable(text):
+    # Body lines are CRLF-terminated and kept under the 998 octet SMTP limit
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return binascii.b2a_qp(text.encode('utf-8'), istext=True).replace(b'\n', CRLF)
+
+
+class CompiledTemplate:
+    def __init__(self, template_id, definition, domain=None):
+        self.id = template_id
+        self.version = definition['version']
+        # Content stored before the API checked it, or a hand-edited template file, must not add header lines
+        if any('\r' in field or '\n' in field for field in (definition['subject'], definition.get('from') or '')):
+            raise TemplateError(f'Template {template_id} has a line break in its subject or from')
+        self.from_addr = definition.get('from')
+        self._subject, subject_names = compile_source(definition['subject'], single_line)
+        self._text, text_names = compile_source(definition['text'])
+        self._html, html_names = compile_source(definition['html'], html_value) if definition.get('html') else (None, set())
+        self.variables = subject_names | text_names | html_names
+        # make_msgid() would otherwise look up the FQDN on every call
+        self.domain = domain or socket.getfqdn()
+        self.boundary = f'=_{template_id}_{self.version}_{os.urandom(8).hex()}'
+
+    def missing(self, variables):
+        return sorted(self.variables - set(variables or ()))
+
+    def render(self, variables):
+        # Returns (subject, text, html); html is None for text-only templates
+        try:
+            return (self._subject(variables), self._text(variables),
+                    self._html(variables) if self._html else None)
+        except KeyError as e:
+            raise TemplateError(f'Template {self.id} needs variable {e.args[0]!r}') from None
+
+    def render_message(self, from_addr, to, variables, message_id=None, date=None, attachments=()):
+        # bytes, or with attachments a list of bytes and the cached parts' memoryviews for smtp_pool.send_message
+        subject, text, html_body = self.render(variables or {})
+        head = b''.join((
+            encode_header('From', self.from_addr or from_addr),
+            encode_header('To', to),
+            encode_header('Subject', subject),
+            encode_header('Message-ID', message_id or make_msgid(domain=self.domain)),
+            encode_header('Date', date or current_date()),
+            b'MIME-Version: 1.0' + CRLF,
+        ))
+        body = (b'Content-Type: text/plain; charset="utf-8"' + CRLF +
+                b'Content-Transfer-Encoding: quoted-printable' + CRLF + CRLF + quoted_printable(text) + CRLF)
+        if html_body is not None:
+            boundary = self.boundary.encode('ascii')
+            body = b''.join((
+                b'Content-Type: multipart/alternative; boundary="' + boundary + b'"' + CRLF + CRLF,
+                b'--' + boundary + CRLF, body,
+                b'--' + boundary + CRLF,
+                b'Content-Type: text/html; charset="utf-8"' + CRLF,
+                b'Content-Transfer-Encoding: quoted-printable' + CRLF + CRLF, quoted_printable(html_body), CRLF,
+                b'--' + boundary + b'--' + CRLF,
+            ))
+        if not attachments:
+            return head + body
+        mixed = f'{self.boundary}_mixed'.encode('ascii')
+        return [b''.join((
+            head,
+            b'Content-Type: multipart/mixed; boundary="' + mixed + b'"' + CRLF + CRLF,
+            b'--' + mixed + CRLF, body,
+        ))] + attachment_parts(mixed, attachments)
+
+
+class TemplateRegistry:
+    # Definitions are read from TEMPLATE_DIR and re-read when the file changes; compiled templates
+    # are cached per (id, version), so bumping "version" in the file is what invalidates them
+    def __init__(self, directory=TEMPLATE_DIR, max_size=TEMPLATE_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self._definitions = {}
+        self._compiled = OrderedDict()
+        self._lock = threading.Lock()
+
+    def definition(self, template_id):
+        if not TEMPLATE_ID.match(template_id or ''):
+            raise TemplateError(f'Invalid template id: {template_id!r}')
+        path = os.path.join(self.directory, f'{template_id}.json')
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            raise TemplateError(f'Unknown template: {template_id}') from None
+        cached = self._definitions.get(template_id)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        with open(path) as f:
+            definition = json.load(f)
+        for field in ('version', 'subject', 'text'):
+            if field not in definition:
+                raise TemplateError(f'Template {template_id} has no {field!r}')
+        self._definitions[template_id] = (mtime, definition)
+        return definition
+
+    def get(self, template_id, version=None, domain=None):
+        # Latest version when version is None
+        if version is None:
+            version = self.definition(template_id)['version']
+        key = (template_id, version)
+        compiled = self._cached(key)
+        if compiled is not None:
+            return compiled
+
+        definition = self.definition(template_id)
+        if definition['version'] != version:
+            # Only the latest definition is kept on disk; a task enqueued before an edit gets the edit
+            logging.warning(f'Template {template_id} version {version} is gone, using {definition["version"]}')
+            key = (template_id, definition['version'])
+        # Compile outside the lock; a concurrent compile of the same key is harmless
+        return self._remember(key, CompiledTemplate(template_id, definition, domain))
+
+    def content(self, digest, domain=None):
+        # Ad hoc content from the blob store ({"subject", "text", "html"}); the digest doubles as its version
+        key = ('blob', digest)
+        compiled = self._cached(key)
+        if compiled is not None:
+            return compiled
+        try:
+            definition = blobs.get_json(digest)
+        except BlobNotFound:
+            raise TemplateError(f'Unknown content: {digest}') from None
+        return self._remember(key, CompiledTemplate('content', dict(definition, version=digest[:12]), domain))
+
+    def _cached(self, key):
+        with self._lock:
+            compiled = self._compiled.get(key)
+            if compiled is not None:
+                self._compiled.move_to_end(key)
+            return compiled
+
+    def _remember(self, key, compiled):
+        with self._lock:
+            self._compiled[key] = compiled
+            self._compiled.move_to_end(key)
+            while len(self._compiled) > self.max_size:
+                self._compiled.popitem(last=False)
+        return compiled
+
+    def clear(self):
+        with self._lock:
+            self._compiled.clear()
+            self._definitions.clear()
+
+
+templates = TemplateRegistry()
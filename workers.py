@@ -0,0 +1,52 @@
+import os
+import sys
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Starts a Celery worker for one class of mail:
+#   python workers.py transactional [extra celery worker options]
+#   python workers.py bulk
+# Transactional workers take one task at a time per process, so a slow send never holds others in its
+# prefetch buffer; bulk workers prefetch more for throughput. Plain `celery -A tasks worker` still
+# consumes both queues.
+
+WORKER_PROFILES = {
+    'transactional': {
+        'concurrency': int(os.getenv('TRANSACTIONAL_WORKER_CONCURRENCY', '16')),
+        'prefetch_multiplier': int(os.getenv('TRANSACTIONAL_WORKER_PREFETCH', '1')),
+    },
+    'bulk': {
+        'concurrency': int(os.getenv('BULK_WORKER_CONCURRENCY', '8')),
+        'prefetch_multiplier': int(os.getenv('BULK_WORKER_PREFETCH', '8')),
+    },
+}
+
+
+def worker_argv(profile, extra=()):
+    from tasks import PRIORITY_QUEUES
+
+    settings = WORKER_PROFILES[profile]
+    return [
+        'worker',
+        '--queues', PRIORITY_QUEUES[profile],
+        '--concurrency', str(settings['concurrency']),
+        '--prefetch-multiplier', str(settings['prefetch_multiplier']),
+        # Hand tasks only to processes that are free, rather than queueing them behind busy ones
+        '--optimization', 'fair',
+        '--hostname', f'{profile}@%h',
+        *extra,
+    ]
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in WORKER_PROFILES:
+        raise SystemExit(f'usage: python workers.py {{{"|".join(WORKER_PROFILES)}}} [celery worker options]')
+    from tasks import celery
+
+    celery.worker_main(worker_argv(sys.argv[1], sys.argv[2:]))
+
+
+if __name__ == '__main__':
+    main()